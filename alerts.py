@@ -0,0 +1,319 @@
+import copy
+import hashlib
+import json
+import operator
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import kpi_metrics
+
+# Rule set shared by every role view
+ALERT_RULES_FILE = os.environ.get("KPI_ALERT_RULES", "alert_rules.json")
+
+# Used when the rules file does not exist; the dashboard's original thresholds
+DEFAULT_RULES = {
+    "rules": [
+        {"name": "low_uptime", "column": "uptime", "op": "<", "threshold": 95.0,
+         "message": "Low Uptime Detected: {count} occurrences below {threshold}%"},
+        {"name": "high_energy", "column": "energy_consumption", "op": ">", "threshold": 700.0,
+         "message": "High Energy Consumption Detected: {count} occurrences above {threshold} kWh"},
+        {"name": "high_alarms", "column": "alarm_count", "op": ">", "threshold": 5,
+         "message": "High Alarm Count Detected: {count} occurrences above {threshold}"},
+    ],
+    "overrides": {"sites": {}, "locations": {}},
+}
+
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+RULE_TYPES = ("threshold", "rate_of_change")
+RULE_COLUMNS = ['uptime', 'energy_consumption', 'alarm_count', 'signal_strength']
+NUMERIC_PARAMS = ("threshold", "min_consecutive")
+
+# Columns of an alert table; a rule set without rules gives empty ones
+TABLE_COLUMNS = {'site_id': np.int32, 'timestamp': "datetime64[ns]", 'rule': np.int16, 'value': np.float32}
+
+# Evaluated segments kept per (segment, rule set, preceding segments);
+# segments never change
+SEGMENT_CACHE_SIZE = 64
+_segment_alerts = OrderedDict()
+_segment_lock = threading.Lock()
+_rules_cache = {}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# Raise ValueError for a threshold that is not a number or a min_consecutive
+# that is not a whole number of at least 1; where names the rule or override
+def _check_param(where, name, value):
+    if not _is_number(value):
+        raise ValueError(f"{where}: {name} {value!r} is not a number")
+    if name == "min_consecutive" and (value < 1 or value != int(value)):
+        raise ValueError(f"{where}: min_consecutive {value!r} is not a whole number of at least 1")
+
+
+def _check_dict(where, value):
+    if not isinstance(value, dict):
+        raise ValueError(f"{where} must be an object, not {value!r}")
+    return value
+
+
+# A validated rule set: rules, per-site/per-location overrides and a key that
+# changes whenever the configuration does
+class AlertRules:
+    def __init__(self, config):
+        if not isinstance(config, dict) or not isinstance(config.get("rules"), list):
+            raise ValueError("Alert rules must be an object with a \"rules\" list")
+        self.rules = []
+        for rule in config["rules"]:
+            if not isinstance(rule, dict) or "name" not in rule:
+                raise ValueError(f"Alert rule {rule!r} has no name")
+            rule = dict(rule)
+            rule.setdefault("type", "threshold")
+            rule.setdefault("min_consecutive", 1)
+            missing = [key for key in ("column", "op", "threshold") if key not in rule]
+            if missing:
+                raise ValueError(f"Alert rule '{rule['name']}': missing {', '.join(missing)}")
+            if rule["column"] not in RULE_COLUMNS:
+                raise ValueError(f"Alert rule '{rule['name']}': unknown column {rule['column']!r}, expected one of {', '.join(RULE_COLUMNS)}")
+            if rule["op"] not in OPERATORS:
+                raise ValueError(f"Alert rule '{rule['name']}': unknown operator {rule['op']!r}")
+            if rule["type"] not in RULE_TYPES:
+                raise ValueError(f"Alert rule '{rule['name']}': unknown type {rule['type']!r}")
+            if rule["name"] in [other["name"] for other in self.rules]:
+                raise ValueError(f"Alert rule '{rule['name']}' is defined more than once")
+            for name in NUMERIC_PARAMS:
+                _check_param(f"Alert rule '{rule['name']}'", name, rule[name])
+            rule.setdefault("label", f"{rule['column']}{' change' if rule['type'] == 'rate_of_change' else ''} {rule['op']} {rule['threshold']}")
+            rule.setdefault("message", f"{rule['label']}: {{count}} occurrences")
+            try:
+                rule["message"].format(count=0, threshold=0)
+            except (KeyError, IndexError, ValueError, AttributeError) as e:
+                raise ValueError(f"Alert rule '{rule['name']}': message {rule['message']!r} may only use {{count}} and {{threshold}}") from e
+            self.rules.append(rule)
+        self.names = [rule["name"] for rule in self.rules]
+        overrides = _check_dict("Alert rule overrides", config.get("overrides", {}))
+        self.site_overrides = _check_dict("Alert rule overrides.sites", overrides.get("sites", {}))
+        self.location_overrides = _check_dict("Alert rule overrides.locations", overrides.get("locations", {}))
+        for kind, by_key in (("site", self.site_overrides), ("location", self.location_overrides)):
+            for key, rule_overrides in by_key.items():
+                for rule_name, params in _check_dict(f"Override for {kind} '{key}'", rule_overrides).items():
+                    where = f"Override for {kind} '{key}', rule '{rule_name}'"
+                    if rule_name not in self.names:
+                        raise ValueError(f"Override for {kind} '{key}': unknown alert rule '{rule_name}'")
+                    for name, value in _check_dict(where, params).items():
+                        if name in NUMERIC_PARAMS:
+                            _check_param(where, name, value)
+        self.key = hashlib.blake2b(json.dumps(config, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+    # Effective value of a rule parameter for one site: site override first,
+    # then its location's override, then the rule default
+    def param(self, rule, name, site=None, location=None):
+        for overrides, key in ((self.site_overrides, site), (self.location_overrides, location)):
+            value = overrides.get(key, {}).get(rule["name"], {}).get(name)
+            if value is not None:
+                return value
+        return rule[name]
+
+    # Per-row values of a rule parameter with overrides applied
+    def row_param(self, rule, name, segment, dataset_categories):
+        values = np.full(segment.rows, float(rule[name]))
+        for column, overrides in (('location', self.location_overrides), ('site_id', self.site_overrides)):
+            if column not in segment.df.columns:
+                continue
+            categories = pd.Index(dataset_categories[column])
+            by_code = np.full(len(categories) + 1, np.nan)  # Last slot for missing values
+            for key, rule_overrides in overrides.items():
+                value = rule_overrides.get(rule["name"], {}).get(name)
+                if value is not None and key in categories:
+                    by_code[categories.get_loc(key)] = value
+            if np.isnan(by_code).all():
+                continue
+            codes = segment.df[column].cat.codes.to_numpy()
+            row_values = by_code[np.where(codes >= 0, codes, len(categories))]
+            values = np.where(np.isnan(row_values), values, row_values)
+        return values
+
+
+# The built-in rule set, shared so its results stay cached
+def default_rules():
+    return _rules_cache.setdefault(None, AlertRules(copy.deepcopy(DEFAULT_RULES)))
+
+
+# Load the rule set from ALERT_RULES_FILE, re-reading it only when it changes.
+# Raises ValueError naming the file if it is not valid JSON or not a valid
+# rule set.
+def load_rules(path=None):
+    path = path or ALERT_RULES_FILE
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return default_rules()
+    cached = _rules_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r") as f:
+            try:
+                cached = (mtime, AlertRules(json.load(f)))
+            except ValueError as e:  # Including json.JSONDecodeError
+                raise ValueError(f"{path}: {e}") from e
+        _rules_cache[path] = cached
+    return cached[1]
+
+
+# Length of the run of consecutive True values ending at each row, restarting
+# at every site boundary. A run starting at a site's first row continues the
+# site's carried run length from the previous segment.
+def _run_lengths(condition, codes, site_start, carried):
+    index = np.arange(len(condition))
+    previous = np.zeros(len(condition), dtype=bool)
+    previous[1:] = condition[:-1]
+    run_start = condition & (site_start | ~previous)
+    start_index = np.maximum.accumulate(np.where(run_start, index, 0))
+    carry_in = np.where(site_start & condition, carried[codes], 0)
+    return np.where(condition, index - start_index + 1 + carry_in[start_index], 0)
+
+
+# Evaluate every rule over one segment in vectorized passes. Rows are sorted
+# by (site, time), so rate-of-change and consecutive-interval conditions are
+# computed within each site. carry holds, per site, the last value of each
+# rule column and the run length each rule's condition ended the preceding
+# segments with, so the month partitions evaluate like one history. Returns
+# the alerts and the carry for the next segment.
+def _evaluate_segment(segment, rules, dataset_categories, carry):
+    instrumentation.count("rows_scanned", segment.rows)
+    n_sites = len(dataset_categories['site_id'])
+    codes = np.where(segment.codes >= 0, segment.codes, 0).astype(np.intp)
+    timestamps = segment.timestamps
+    site_start = np.ones(segment.rows, dtype=bool)
+    site_start[1:] = codes[1:] != codes[:-1]
+    # Each site's last row in this segment
+    site_end = np.flatnonzero(np.append(site_start[1:], True)) if segment.rows else np.zeros(0, dtype=np.intp)
+    carry = carry or {"values": {}, "runs": {}}
+    next_carry = {"values": dict(carry["values"]), "runs": dict(carry["runs"])}
+
+    parts = [{name: np.zeros(0, dtype=dtype) for name, dtype in TABLE_COLUMNS.items()}]
+    for rule_index, rule in enumerate(rules.rules):
+        raw = kpi_metrics.kpi_values(segment.df[rule["column"]].to_numpy())
+        values = raw
+        if rule["type"] == "rate_of_change":
+            previous = np.empty_like(raw)
+            previous[1:] = raw[:-1]
+            previous[site_start] = carry["values"].get(rule["column"], np.full(n_sites, np.nan))[codes[site_start]]
+            values = raw - previous
+        last_values = next_carry["values"].setdefault(rule["column"], np.full(n_sites, np.nan)).copy()
+        last_values[codes[site_end]] = raw[site_end]
+        next_carry["values"][rule["column"]] = last_values
+
+        threshold = rules.row_param(rule, "threshold", segment, dataset_categories)
+        with np.errstate(invalid="ignore"):
+            condition = OPERATORS[rule["op"]](values, threshold) & (segment.codes >= 0)
+        min_consecutive = rules.row_param(rule, "min_consecutive", segment, dataset_categories)
+        if (min_consecutive > 1).any():
+            runs = _run_lengths(condition, codes, site_start, carry["runs"].get(rule_index, np.zeros(n_sites, dtype=np.int64)))
+            last_runs = next_carry["runs"].get(rule_index, np.zeros(n_sites, dtype=np.int64)).copy()
+            last_runs[codes[site_end]] = runs[site_end]
+            next_carry["runs"][rule_index] = last_runs
+            condition &= runs >= min_consecutive
+
+        hits = np.flatnonzero(condition)
+        parts.append({
+            'site_id': codes[hits].astype(np.int32),
+            'timestamp': timestamps[hits],
+            'rule': np.full(len(hits), rule_index, dtype=np.int16),
+            'value': values[hits].astype(np.float32),
+        })
+    result = {name: np.concatenate([part[name] for part in parts]) for name in TABLE_COLUMNS}
+    return result, next_carry
+
+
+# Alerts of a segment given the key and carry of the segments before it
+def _segment_result(segment, rules, dataset_categories, previous_key, carry):
+    key = (segment.path, segment.span, rules.key, tuple(len(values) for values in dataset_categories.values()), previous_key)
+    with _segment_lock:
+        if key in _segment_alerts:
+            _segment_alerts.move_to_end(key)
+            return key, _segment_alerts[key]
+    result = _evaluate_segment(segment, rules, dataset_categories, carry)
+    with _segment_lock:
+        _segment_alerts[key] = result
+        while len(_segment_alerts) > SEGMENT_CACHE_SIZE:
+            _segment_alerts.popitem(last=False)
+    return key, result
+
+
+# Compact table of every alert in a dataset, sorted by (site, time), with a
+# per-site offset table. All role views and the fleet overview read from it.
+class AlertTable:
+    def __init__(self, dataset, rules=None):
+        self.rules = rules or load_rules()
+        self.sites = dataset.sites
+        # Segments are evaluated oldest first, each continuing the ones before
+        results = []
+        key, carry = None, None
+        for segment in dataset.segments:
+            key, (result, carry) = _segment_result(segment, self.rules, dataset.categories, key, carry)
+            results.append(result)
+        columns = {name: np.concatenate([result[name] for result in results]) for name in TABLE_COLUMNS}
+        order = np.lexsort((columns['rule'], columns['timestamp'], columns['site_id']))
+        self.columns = {name: values[order] for name, values in columns.items()}
+        self.offsets = np.searchsorted(self.columns['site_id'], np.arange(len(self.sites) + 1), side="left")
+
+    def __len__(self):
+        return len(self.columns['site_id'])
+
+    def _bounds(self, site, start, end):
+        if site not in self.sites:
+            return 0, 0
+        code = self.sites.get_loc(site)
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        site_times = self.columns['timestamp'][lo:hi]
+        first = lo + np.searchsorted(site_times, np.datetime64(start, "ns"), side="left")
+        last = lo + np.searchsorted(site_times, np.datetime64(end, "ns"), side="right")
+        return first, last
+
+    # Alert count per rule for one site with start <= timestamp <= end
+    def counts(self, site, start, end):
+        first, last = self._bounds(site, start, end)
+        counts = np.bincount(self.columns['rule'][first:last], minlength=len(self.rules.rules))
+        return pd.Series(counts, index=self.rules.names)
+
+    # Alert rows of one site with start <= timestamp <= end
+    def rows(self, site, start, end):
+        first, last = self._bounds(site, start, end)
+        return pd.DataFrame({
+            'timestamp': self.columns['timestamp'][first:last],
+            'rule': np.asarray(self.rules.names, dtype=object)[self.columns['rule'][first:last]],
+            'value': self.columns['value'][first:last],
+        })
+
+    # Sites x rules alert counts with start <= timestamp <= end
+    def fleet_counts(self, start=None, end=None):
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.columns['timestamp'] >= np.datetime64(start, "ns")
+        if end is not None:
+            mask &= self.columns['timestamp'] <= np.datetime64(end, "ns")
+        n_rules = len(self.rules.rules)
+        flat = self.columns['site_id'][mask].astype(np.intp) * n_rules + self.columns['rule'][mask]
+        counts = np.bincount(flat, minlength=len(self.sites) * n_rules).reshape(len(self.sites), n_rules)
+        return pd.DataFrame(counts, index=pd.Index(self.sites, name='site_id'), columns=self.rules.names)
+
+    # Warning lines for one site, with that site's effective thresholds
+    def messages(self, site, start, end, location=None):
+        return messages(self.rules, self.counts(site, start, end), site, location)
+
+
+# Warning lines for one site's alert count per rule
+def messages(rules, counts, site, location=None):
+    lines = []
+    for rule in rules.rules:
+        count = int(counts[rule["name"]])
+        if count:
+            threshold = rules.param(rule, "threshold", site, location)
+            lines.append(rule["message"].format(count=count, threshold=threshold))
+    return lines
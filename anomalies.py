@@ -0,0 +1,453 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import kpi_metrics
+import rollups
+
+# KPIs checked for anomalies
+ANOMALY_COLUMNS = ['uptime', 'energy_consumption', 'alarm_count', 'signal_strength']
+
+# Detectors, in the order of their codes in the anomaly table
+DETECTORS = ['zscore', 'ewma', 'seasonal']
+
+# Rolling z-score: each row against the previous ROLLING_WINDOW rows of its site
+ROLLING_WINDOW = 24
+
+# EWMA control chart: smoothing weight of the level, which is compared with
+# the mean of the site's first BASELINE_DAYS of rows. Catches slow drifts
+# that no single row or threshold shows. Its spread is that of all the
+# site's earlier rows, which a short baseline cannot estimate reliably.
+EWMA_ALPHA = 0.2
+BASELINE_DAYS = 14
+
+# |score| (in standard deviations) above which a row is anomalous
+Z_LIMIT = 4.0
+EWMA_LIMIT = 3.5
+
+# Rows of history a window or baseline needs, and samples a seasonal slot
+# (hour of day, or weekday for daily data) needs, before anything is flagged
+MIN_HISTORY = 8
+MIN_SEASON_SAMPLES = 4
+
+# Standard deviations are floored at this fraction of the spread of the
+# site's earlier rows, so a flat window (alarm_count stuck at 0) does not make every change an anomaly
+STD_FLOOR = 0.1
+
+# Rows per detection block. Blocks hold whole sites and are small enough for
+# their working arrays to stay in CPU cache.
+BLOCK_ROWS = 2**16
+
+NANOSECONDS_PER_DAY = 86_400 * 10**9
+
+# Columns of the anomaly table
+TABLE_COLUMNS = {'site_id': np.int32, 'timestamp': 'datetime64[ns]', 'column': np.int8, 'detector': np.int8, 'value': np.float32, 'score': np.float32}
+
+
+# Per-site state carried from one segment to the next; every array has sites
+# on its last axis and the checked KPIs on its first. Values are centred on
+# each site's first value ('shift'). 'moments' are the count, sum and sum of
+# squares of all rows so far, 'tail' the last ROLLING_WINDOW rows
+# (right-aligned), 'baseline' the count and sum of the baseline rows,
+# 'residuals' the moments of the seasonal residuals and 'cells' the count and
+# sum of each seasonal slot.
+def _new_carry(n_columns, n_sites, n_slots):
+    return {
+        'seen': np.zeros(n_sites, dtype=np.int64),
+        'first_time': np.full(n_sites, np.datetime64("NaT"), dtype="datetime64[ns]"),
+        'shift': np.full((n_columns, n_sites), np.nan),
+        'moments': np.zeros((n_columns, 3, n_sites)),
+        'tail': np.full((n_columns, ROLLING_WINDOW, n_sites), np.nan),
+        'level': np.zeros((n_columns, n_sites)),
+        'baseline': np.zeros((n_columns, 2, n_sites)),
+        'residuals': np.zeros((n_columns, 3, n_sites)),
+        'cells': np.zeros((n_columns, 2, n_slots, n_sites)),
+    }
+
+
+# A carry extended with fresh state for sites added since it was made
+def _grown_carry(carry, n_sites):
+    n_columns, _, n_slots, carried_sites = carry['cells'].shape
+    if carried_sites == n_sites:
+        return carry
+    fresh = _new_carry(n_columns, n_sites - carried_sites, n_slots)
+    return {name: np.concatenate((values, fresh[name]), axis=-1) for name, values in carry.items()}
+
+
+# Row ranges [first, last) of whole sites holding about BLOCK_ROWS rows each
+def _blocks(ends):
+    total = int(ends[-1]) if len(ends) else 0
+    targets = np.arange(BLOCK_ROWS, total, BLOCK_ROWS)
+    edges = np.unique(np.concatenate(([0], ends[np.searchsorted(ends, targets)], [total])))
+    return zip(edges[:-1].tolist(), edges[1:].tolist())
+
+
+# Running count, sum and sum of squares of a column in (site, time) order,
+# NaN skipped, with a leading zero: rows [first, last) of a site have the
+# moments sums[:, last] - sums[:, first]
+def _running_sums(values):
+    valid = ~np.isnan(values)
+    sums = np.zeros((3, len(values) + 1))
+    if valid.all():
+        sums[0, 1:] = np.arange(1, len(values) + 1)
+        filled = values.copy()
+    else:
+        np.cumsum(valid, out=sums[0, 1:])
+        filled = np.where(valid, values, 0.0)
+    np.cumsum(filled, out=sums[1, 1:])
+    filled *= filled
+    np.cumsum(filled, out=sums[2, 1:])
+    return sums
+
+
+# Sample standard deviation from (count, sum, sum of squares), NaN below two samples
+def _std(count, total, squares):
+    variance = total * total
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance /= count
+        np.subtract(squares, variance, out=variance)
+        variance /= count - 1
+    np.maximum(variance, 0.0, out=variance)
+    return np.sqrt(variance, out=variance)
+
+
+# Each row against the mean and spread of the previous ROLLING_WINDOW rows of
+# its site, given the running sums before the row and before its window
+def _rolling_scores(centered, before, window_before, floor):
+    count, total, squares = before - window_before
+    std = np.fmax(_std(count, total, squares), floor)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = (centered - total / count) / std
+    scores[count < MIN_HISTORY] = np.nan
+    return scores
+
+
+# EWMA levels of several centred columns (one per row of centered), each
+# site's continuing from its initial level. The recursion steps through
+# position within site for all sites and columns at once, longest sites first
+# so the sites still running are a prefix.
+def _ewma_levels(centered, starts, lengths, initial):
+    by_length = np.argsort(-lengths, kind="stable")
+    descending = -lengths[by_length]
+    sorted_starts = starts[by_length]
+    level = initial[:, by_length]
+    levels = np.empty_like(centered)
+    has_nan = np.isnan(centered).any()
+    running = np.searchsorted(descending, -np.arange(-descending[0]), side="left")
+    for position, alive in enumerate(running.tolist()):
+        rows = sorted_starts[:alive] + position
+        values = centered[:, rows]
+        current = level[:, :alive]
+        if has_nan:
+            values = np.where(np.isnan(values), current, values)  # Missing rows keep the level
+        current *= 1 - EWMA_ALPHA
+        current += EWMA_ALPHA * values
+        levels[:, rows] = current
+    return levels
+
+
+# EWMA level of each row against its site's baseline mean, in standard
+# deviations of the level; rows within the baseline are not scored
+def _ewma_scores(levels, centered, in_baseline, baseline_count, baseline_mean, site_std):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Spread of the level around a baseline mean that is itself estimated
+        level_std = site_std * np.sqrt(EWMA_ALPHA / (2 - EWMA_ALPHA) + 1 / baseline_count)
+        scores = (levels - baseline_mean) / level_std
+    scores[in_baseline | (baseline_count < MIN_HISTORY) | np.isnan(centered)] = np.nan
+    return scores
+
+
+# Seasonal slot of each row: hour of day for sub-daily data, weekday for daily data
+def _season_slots(timestamps, sub_daily):
+    ticks = timestamps.view(np.int64)
+    if sub_daily:
+        return (ticks // (3600 * 10**9)) % 24, 24
+    return (ticks // NANOSECONDS_PER_DAY + 3) % 7, 7  # 1970-01-01 was a Thursday
+
+
+# Sum of values over the earlier rows of the same group, given the rows
+# sorted stably by group and the sorted position of each group's first row
+def _preceding_sums(values, order, group_first):
+    sorted_values = values[order]
+    running = np.cumsum(sorted_values) - sorted_values
+    preceding = np.empty_like(running)
+    preceding[order] = running - running[group_first]
+    return preceding
+
+
+# Anomalous rows of one block of whole sites, in (site, time) order with
+# dataset site codes. Each row is scored against its site's earlier rows
+# only, starting from carry; the block's sites' state after it is written to
+# next_carry. Per-site values reach the rows with np.repeat, which is much
+# faster than indexing by site code. Yields (rows, column index, detector
+# index, scores).
+def _block_anomalies(codes, timestamps, columns, carry, next_carry):
+    first_site = int(codes[0])
+    n_local = int(codes[-1]) + 1 - first_site
+    sites = slice(first_site, first_site + n_local)
+    local = codes - first_site
+    lengths = np.bincount(local, minlength=n_local)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    row = np.arange(len(codes))
+    rank = row - np.repeat(starts, lengths)
+
+    # Running sums run over each site's carried last rows followed by its
+    # rows in the block
+    seen = carry['seen'][sites]
+    carried = np.minimum(seen, ROLLING_WINDOW)
+    carried_ends = np.cumsum(carried)
+    extended_ends = np.cumsum(carried + lengths)
+    block_firsts = extended_ends - lengths
+    positions = row + np.repeat(block_firsts - starts, lengths)
+    tail_sites = np.repeat(np.arange(n_local), carried)
+    tail_positions = np.arange(len(tail_sites)) + np.repeat(block_firsts - carried_ends, carried)
+    tail_slots = np.arange(len(tail_sites)) + np.repeat(ROLLING_WINDOW - carried_ends, carried)
+    window_first = positions - np.minimum(np.repeat(carried, lengths) + rank, ROLLING_WINDOW)
+    last_positions = extended_ends[:, None] - ROLLING_WINDOW + np.arange(ROLLING_WINDOW)
+    last_kept = last_positions >= (block_firsts - carried)[:, None]
+
+    first_time = carry['first_time'][sites].copy()
+    new_sites = np.isnat(first_time) & (lengths > 0)
+    first_time[new_sites] = timestamps[starts[new_sites]]
+    in_baseline = timestamps < np.repeat(first_time + np.timedelta64(BASELINE_DAYS, "D"), lengths)
+    n_slots = carry['cells'].shape[2]
+    slots, _ = _season_slots(timestamps, n_slots == 24)
+    # Site-major, so the rows are already nearly sorted by cell
+    cells = local * n_slots + slots
+    cell_order = np.argsort(cells, kind="stable")
+    sorted_cells = cells[cell_order]
+    cell_start = np.ones(len(cells), dtype=bool)
+    cell_start[1:] = sorted_cells[1:] != sorted_cells[:-1]
+    cell_first = np.maximum.accumulate(np.where(cell_start, row, 0))
+    # Earlier rows in the same cell, which columns without NaN all share
+    cell_rank = np.empty(len(cells))
+    cell_rank[cell_order] = row - cell_first
+
+    ewma = []
+    for column, (column_index, values) in enumerate(columns.items()):
+        valid = ~np.isnan(values)
+        # Centre on the site's first value so the running sums stay precise
+        shift = carry['shift'][column, sites].copy()
+        if np.isnan(shift[lengths > 0]).any():
+            valid_rows = np.flatnonzero(valid)
+            first_valid = valid_rows[np.flatnonzero(np.diff(local[valid_rows], prepend=-1))]
+            unset = np.isnan(shift[local[first_valid]])
+            shift[local[first_valid[unset]]] = values[first_valid[unset]]
+        centered = values - np.repeat(shift, lengths)
+        filled = np.where(valid, centered, 0.0)
+
+        extended = np.empty(len(tail_sites) + len(codes))
+        extended[positions] = centered
+        extended[tail_positions] = carry['tail'][column, tail_slots, first_site + tail_sites]
+        sums = _running_sums(extended)
+        before = np.take(sums, positions, axis=1)
+        # Moments of every earlier row of the site
+        moments = carry['moments'][column, :, sites]
+        site_std = _std(*(before + np.repeat(moments - sums[:, block_firsts], lengths, axis=1)))
+        floor = np.nan_to_num(STD_FLOOR * site_std)
+
+        yield _hits(column_index, 0, _rolling_scores(centered, before, np.take(sums, window_first, axis=1), floor), Z_LIMIT)
+
+        # Each row against the mean of the site's earlier rows in the same
+        # seasonal slot, in standard deviations of the site's earlier
+        # deviations from its slot means. A slot holds few rows, too few for
+        # a spread of its own.
+        cell_sums = carry['cells'][column, :, :, sites].transpose(0, 2, 1).reshape(2, -1)
+        cell_count = cell_sums[0, cells] + (cell_rank if valid.all() else _preceding_sums(valid.astype(np.float64), cell_order, cell_first))
+        cell_total = cell_sums[1, cells] + _preceding_sums(filled, cell_order, cell_first)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            residuals = centered - cell_total / cell_count
+        residuals[cell_count < MIN_SEASON_SAMPLES] = np.nan
+        residual_sums = _running_sums(residuals)
+        residual_moments = carry['residuals'][column, :, sites]
+        earlier = residual_sums[:, :-1] + np.repeat(residual_moments - residual_sums[:, starts], lengths, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores = residuals / np.fmax(_std(*earlier), floor)
+        scores[earlier[0] < MIN_HISTORY] = np.nan
+        yield _hits(column_index, 2, scores, Z_LIMIT)
+
+        baseline_rows = valid & in_baseline
+        baseline_count = carry['baseline'][column, 0, sites] + np.bincount(local, weights=baseline_rows, minlength=n_local)
+        baseline_total = carry['baseline'][column, 1, sites] + np.bincount(local, weights=np.where(baseline_rows, filled, 0.0), minlength=n_local)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ewma.append((column, column_index, centered, baseline_count, baseline_total / baseline_count, site_std))
+
+        next_carry['shift'][column, sites] = shift
+        next_carry['moments'][column, :, sites] = moments + sums[:, extended_ends] - sums[:, block_firsts]
+        next_carry['tail'][column, :, sites] = np.where(last_kept, extended[np.maximum(last_positions, 0)], np.nan).T
+        next_carry['baseline'][column, :, sites] = baseline_count, baseline_total
+        next_carry['residuals'][column, :, sites] = residual_moments + residual_sums[:, ends] - residual_sums[:, starts]
+        next_carry['cells'][column, 0, :, sites] += np.bincount(cells, weights=valid, minlength=n_local * n_slots).reshape(n_local, n_slots).T
+        next_carry['cells'][column, 1, :, sites] += np.bincount(cells, weights=filled, minlength=n_local * n_slots).reshape(n_local, n_slots).T
+
+    # One EWMA recursion for all columns
+    if ewma:
+        initial = carry['level'][[entry[0] for entry in ewma], sites]
+        levels = _ewma_levels(np.array([entry[2] for entry in ewma]), starts, lengths, initial)
+        present = lengths > 0
+        for (column, column_index, centered, baseline_count, baseline_mean, site_std), column_levels in zip(ewma, levels):
+            next_carry['level'][column, first_site + np.flatnonzero(present)] = column_levels[ends[present] - 1]
+            scores = _ewma_scores(column_levels, centered, in_baseline, np.repeat(baseline_count, lengths), np.repeat(baseline_mean, lengths), site_std)
+            yield _hits(column_index, 1, scores, EWMA_LIMIT)
+
+    next_carry['seen'][sites] = seen + lengths
+    next_carry['first_time'][sites] = first_time
+
+
+# Rows of scores beyond limit, as yielded by _block_anomalies
+def _hits(column_index, detector_index, scores, limit):
+    with np.errstate(invalid="ignore"):
+        hits = np.flatnonzero(np.abs(scores) > limit)
+    return hits, column_index, detector_index, scores[hits]
+
+
+# Anomalies of one segment given the carry of the segments before it (None
+# for the first), in blocks of whole sites. Returns the anomalies and the
+# carry for the next segment.
+def _evaluate_segment(segment, column_indices, n_sites, carry):
+    instrumentation.count("rows_scanned", segment.rows)
+    if carry is None:
+        sub_daily = bool((segment.timestamps.view(np.int64) % NANOSECONDS_PER_DAY != 0).any())
+        carry = _new_carry(len(column_indices), n_sites, 24 if sub_daily else 7)
+    carry = _grown_carry(carry, n_sites)
+    next_carry = {name: values.copy() for name, values in carry.items()}
+    raw = {column_index: segment.df[ANOMALY_COLUMNS[column_index]].to_numpy() for column_index in column_indices}
+    offsets = np.asarray(segment.offsets, dtype=np.int64)
+    first_row = int(offsets[0])  # Rows without a site sort first
+
+    parts = [{name: np.zeros(0, dtype=dtype) for name, dtype in TABLE_COLUMNS.items()}]
+    for first, last in _blocks(offsets[1:] - first_row):
+        rows = slice(first_row + first, first_row + last)
+        codes = segment.codes[rows].astype(np.intp)
+        timestamps = segment.timestamps[rows]
+        columns = {column_index: kpi_metrics.kpi_values(array[rows]) for column_index, array in raw.items()}
+        for hits, column_index, detector_index, scores in _block_anomalies(codes, timestamps, columns, carry, next_carry):
+            parts.append({
+                'site_id': codes[hits].astype(np.int32),
+                'timestamp': timestamps[hits],
+                'column': np.full(len(hits), column_index, dtype=np.int8),
+                'detector': np.full(len(hits), detector_index, dtype=np.int8),
+                'value': columns[column_index][hits].astype(np.float32),
+                'score': scores.astype(np.float32),
+            })
+    return {name: np.concatenate([part[name] for part in parts]) for name in TABLE_COLUMNS}, next_carry
+
+
+# Every anomalous row of a dataset, found by all detectors for all KPIs.
+# Segments are evaluated oldest first, each continuing the per-site state of
+# the ones before the way alerts.AlertTable does, so only one segment's rows
+# are in memory at a time. Sorted by (site, time) with a per-site offset
+# table, like alerts.AlertTable. resume takes saved() states of tables of
+# earlier versions of the dataset: the one covering the most of this
+# version's first segments is continued, so after an append only the
+# appended segments are evaluated.
+class AnomalyTable:
+    def __init__(self, dataset, columns=None, resume=()):
+        self.sites = dataset.sites
+        n_sites = len(self.sites)
+        if columns is not None:
+            # Sorted columns saved from an earlier table of the same dataset version
+            self.columns = columns
+            self.offsets = np.searchsorted(columns['site_id'], np.arange(n_sites + 1), side="left")
+            return
+        column_indices = [ANOMALY_COLUMNS.index(column) for column in ANOMALY_COLUMNS if column in dataset.segments[0].df.columns]
+        segment_names = [segment.name for segment in dataset.segments]
+
+        results, carry, done = [], None, 0
+        for state in resume:
+            names = state['segments'].tolist()
+            if done < len(names) and segment_names[:len(names)] == names and state['kpis'].tolist() == column_indices:
+                results = [{name: state[name] for name in TABLE_COLUMNS}]
+                carry = {name[len("carry_"):]: values for name, values in state.items() if name.startswith("carry_")}
+                done = len(names)
+        for segment in dataset.segments[done:]:
+            result, carry = _evaluate_segment(segment, column_indices, n_sites, carry)
+            results.append(result)
+        columns = {name: np.concatenate([result[name] for result in results]) for name in TABLE_COLUMNS}
+        order = np.lexsort((columns['detector'], columns['column'], columns['timestamp'], columns['site_id']))
+        self.columns = {name: values[order] for name, values in columns.items()}
+        self.offsets = np.searchsorted(self.columns['site_id'], np.arange(n_sites + 1), side="left")
+        self._state = {'segments': np.array(segment_names), 'kpis': np.array(column_indices, dtype=np.int8)}
+        self._state.update({f"carry_{name}": values for name, values in carry.items()})
+
+    # Columns and carried state to save, for a later version's resume
+    def saved(self):
+        return {**self.columns, **self._state}
+
+    def __len__(self):
+        return len(self.columns['site_id'])
+
+    def _bounds(self, site, start, end):
+        if site not in self.sites:
+            return 0, 0
+        code = self.sites.get_loc(site)
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        site_times = self.columns['timestamp'][lo:hi]
+        first = lo + np.searchsorted(site_times, np.datetime64(start, "ns"), side="left")
+        last = lo + np.searchsorted(site_times, np.datetime64(end, "ns"), side="right")
+        return first, last
+
+    def _frame(self, rows):
+        return pd.DataFrame({
+            'timestamp': self.columns['timestamp'][rows],
+            'kpi': np.asarray(ANOMALY_COLUMNS, dtype=object)[self.columns['column'][rows]],
+            'detector': np.asarray(DETECTORS, dtype=object)[self.columns['detector'][rows]],
+            'value': self.columns['value'][rows],
+            'score': self.columns['score'][rows],
+        })
+
+    # Anomalous rows of one site with start <= timestamp <= end, optionally of one KPI
+    def rows(self, site, start, end, column=None):
+        first, last = self._bounds(site, start, end)
+        rows = np.arange(first, last)
+        if column is not None:
+            rows = rows[self.columns['column'][rows] == ANOMALY_COLUMNS.index(column)]
+        return self._frame(rows)
+
+    # One row per site and KPI with anomalies with start <= timestamp <= end:
+    # their count, detectors, latest time and largest |score|, worst first
+    def fleet_list(self, start=None, end=None):
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.columns['timestamp'] >= np.datetime64(start, "ns")
+        if end is not None:
+            mask &= self.columns['timestamp'] <= np.datetime64(end, "ns")
+        rows = np.flatnonzero(mask)
+        keys = self.columns['site_id'][rows].astype(np.int64) * len(ANOMALY_COLUMNS) + self.columns['column'][rows]
+        groups, group = np.unique(keys, return_inverse=True)
+        last_seen = np.full(len(groups), np.iinfo(np.int64).min)
+        np.maximum.at(last_seen, group, self.columns['timestamp'][rows].view(np.int64))
+        max_score = np.zeros(len(groups), dtype=np.float32)
+        np.maximum.at(max_score, group, np.abs(self.columns['score'][rows]))
+        detector_bits = np.zeros(len(groups), dtype=np.int64)
+        np.bitwise_or.at(detector_bits, group, np.left_shift(1, self.columns['detector'][rows].astype(np.int64)))
+        # Detector bit sets to names, e.g. 0b101 -> "zscore, seasonal"
+        names = [", ".join(name for bit, name in enumerate(DETECTORS) if bits >> bit & 1) for bits in range(2 ** len(DETECTORS))]
+        fleet = pd.DataFrame({
+            'site_id': self.sites[groups // len(ANOMALY_COLUMNS)],
+            'kpi': np.asarray(ANOMALY_COLUMNS, dtype=object)[groups % len(ANOMALY_COLUMNS)],
+            'anomalies': np.bincount(group, minlength=len(groups)),
+            'detectors': np.asarray(names, dtype=object)[detector_bits],
+            'last_seen': last_seen.view('datetime64[ns]'),
+            'max_score': max_score,
+        })
+        return fleet.sort_values(['max_score', 'anomalies'], ascending=False, ignore_index=True)
+
+
+# Marker positions for one KPI's anomalies on a rollups.chart_frame of the
+# given resolution label: one per anomalous row at its value, or one per
+# rollup bucket at the bucket's value
+def chart_markers(rows, chart_df, column, resolution):
+    rows = rows[rows['kpi'] == column]
+    freqs = {label: freq for freq, label in rollups.ROLLUP_FREQUENCIES.items()}
+    if resolution in freqs:
+        rows = rows.assign(timestamp=rollups.bucket_starts(rows['timestamp'].to_numpy(), freqs[resolution]))
+    markers = rows.groupby('timestamp', sort=True).agg(
+        anomalies=('detector', 'size'),
+        detectors=('detector', lambda detectors: ", ".join(sorted(set(detectors)))),
+        value=('value', 'first'),
+    )
+    if resolution in freqs:
+        markers['value'] = chart_df.set_index('timestamp')[column].reindex(markers.index).to_numpy()
+    return markers.reset_index()
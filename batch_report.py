@@ -0,0 +1,148 @@
+# Compute every site's KPI metrics, alert counts and forecasts without the
+# dashboard, e.g. for a nightly reporting job
+import argparse
+import glob
+import hashlib
+import importlib.util
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+import alerts
+import forecast
+import kpi_metrics
+import kpi_store
+import snapshots
+
+OUTPUT_FORMATS = ("csv", "json", "parquet")
+
+# Site partitions per worker, so uneven partitions still keep every core busy
+PARTITIONS_PER_WORKER = 4
+
+_worker_dataset = None
+_worker_rules = None
+
+
+# Store for a CSV file, a directory of CSV files or an existing store
+# directory. A directory becomes one store keyed by all of its files: the
+# first file by name is ingested and the others appended to it.
+def open_store(source, progress=None):
+    if kpi_store.is_store(source):
+        return source
+    if not os.path.isdir(source):
+        return kpi_store.ingest_file(source, progress=progress)
+
+    files = sorted(glob.glob(os.path.join(source, "*.csv")))
+    if not files:
+        raise ValueError(f"No CSV files found in {source}.")
+    digest = hashlib.blake2b(digest_size=16)
+    for path in files:
+        digest.update(kpi_store.hash_upload(path).encode())
+    path = kpi_store.ingest_file(files[0], key=digest.hexdigest(), progress=progress)
+    for delta_path in files[1:]:
+        kpi_store.append_file(path, delta_path)
+    return path
+
+
+# Contiguous site code ranges holding about the same number of rows each
+def site_partitions(dataset, n_partitions):
+    rows = np.zeros(len(dataset.sites), dtype=np.int64)
+    for segment in dataset.segments:
+        counts = np.diff(segment.offsets)
+        rows[:len(counts)] += counts
+    cumulative = np.cumsum(rows)
+    targets = cumulative[-1] * np.arange(1, n_partitions) / n_partitions
+    edges = np.unique(np.concatenate(([0], np.searchsorted(cumulative, targets, side="right"), [len(rows)])))
+    return [(int(first), int(last)) for first, last in zip(edges[:-1], edges[1:])]
+
+
+# One row per site: the dashboard's metrics, alert counts per rule and the
+# next-step forecast with its 95% band for each forecast target
+def site_report(dataset, start, end, rules):
+    alert_table = alerts.AlertTable(dataset, rules)
+    report = kpi_metrics.fleet_summary(dataset, start, end, alert_table)
+    engine = forecast.ForecastEngine(dataset, start, end)
+    for target, fits in engine.fits.items():
+        columns = fits[['prediction', 'lower', 'upper', 'slope_per_day']]
+        report = report.join(columns.add_prefix(f"{target}_"))
+    report.insert(0, 'location', kpi_metrics.site_locations(dataset, start, end).reindex(report.index))
+    return report
+
+
+def _init_worker(path, rules_path):
+    global _worker_dataset, _worker_rules
+    _worker_dataset = kpi_store.KpiDataset(path)
+    _worker_rules = alerts.load_rules(rules_path)
+
+
+def _report_partition(first, last, start, end):
+    return site_report(_worker_dataset.partition(first, last), start, end, _worker_rules)
+
+
+# Report for every site of a store, split by site across a process pool.
+# Sites are independent, so the result equals a single-process run. A start
+# or end left out is that of the dashboard's default date range, which ends at
+# midnight of the last day; all_rows covers every row instead.
+def build_report(path, start=None, end=None, rules_path=None, workers=None, all_rows=False):
+    workers = workers or os.cpu_count() or 1
+    dataset = kpi_store.KpiDataset(path)
+    if not all_rows:
+        default_start, default_end = snapshots.default_range(dataset)
+        start = default_start if start is None else start
+        end = default_end if end is None else end
+    if workers == 1:
+        return site_report(dataset, start, end, alerts.load_rules(rules_path))
+
+    partitions = site_partitions(dataset, workers * PARTITIONS_PER_WORKER)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(path, rules_path)) as pool:
+        firsts, lasts = zip(*partitions)
+        parts = list(pool.map(_report_partition, firsts, lasts, repeat(start), repeat(end)))
+    return pd.concat(parts)
+
+
+def write_report(report, output, fmt):
+    if fmt == "csv":
+        report.to_csv(output)
+    elif fmt == "json":
+        report.reset_index().to_json(output, orient="records", indent=1)
+    else:
+        report.to_parquet(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute KPI metrics, alert counts and forecasts for every site.")
+    parser.add_argument("source", help="KPI CSV file, directory of KPI CSV files or KPI store directory")
+    parser.add_argument("output", help="Report file to write")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, help="Report format; defaults to the output file's extension")
+    parser.add_argument("--start", help="First date to include, as picked in the dashboard's date range (default: the first day)")
+    parser.add_argument("--end", help="Last date to include, as picked in the dashboard's date range (default: the last day)")
+    parser.add_argument("--all-rows", action="store_true", help="Cover every row, including those after midnight of the last day, which the dashboard's default range leaves out")
+    parser.add_argument("--rules", help=f"Alert rules file (default: {alerts.ALERT_RULES_FILE})")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    fmt = args.format or os.path.splitext(args.output)[1].lstrip(".").lower()
+    if fmt not in OUTPUT_FORMATS:
+        parser.error(f"Cannot infer the report format from {args.output}; use --format")
+    if fmt == "parquet" and not any(importlib.util.find_spec(engine) for engine in ("pyarrow", "fastparquet")):
+        parser.error("Parquet output needs pyarrow or fastparquet installed")
+
+    started = time.perf_counter()
+    try:
+        path = open_store(args.source)
+    except (OSError, ValueError) as e:
+        sys.exit(f"{args.source}: {e}")
+    start = pd.to_datetime(args.start) if args.start else None
+    end = pd.to_datetime(args.end) if args.end else None
+    report = build_report(path, start, end, args.rules, args.workers, args.all_rows)
+    write_report(report, args.output, fmt)
+    print(f"{len(report)} sites written to {args.output} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
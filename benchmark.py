@@ -0,0 +1,374 @@
+# Benchmark the dashboard's data paths on synthetic fleets of any size and
+# save timings and peak memory as JSON, so runs can be compared
+import argparse
+import copy
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not recorded
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+# Fleet sizes (rows) benchmarked by default; pass --rows 50000000 for the large run
+DEFAULT_ROWS = [10_000, 1_000_000]
+DEFAULT_SITES = 1000
+DEFAULT_INTERVAL = "1h"
+
+# Sites sampled for the per-site stages (filter, metrics, figures)
+SAMPLE_SITES = 20
+
+RESULTS_DIR = "benchmark_results"
+
+# Rows written per CSV chunk by the generator
+GENERATOR_CHUNK_ROWS = 1_000_000
+
+# Dashboard script whose cold start is measured, and the fresh interpreters
+# the measurement is repeated in
+DASHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telecom_dashboard.py")
+STARTUP_RUNS = 3
+
+# Run in a fresh interpreter under -X importtime: import Streamlit as the
+# server would and render the login page of a new session once. The markers
+# pick the render's imports out of the log. The modules the dashboard defers
+# past the login page are then imported and timed one by one, as its first
+# logged-in run would import them.
+STARTUP_SCRIPT = """
+import ast, importlib, json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+print("-- first render --", file=sys.stderr, flush=True)
+app = AppTest.from_file(sys.argv[1], default_timeout=120).run()
+rendered = time.perf_counter()
+print("-- rendered --", file=sys.stderr, flush=True)
+modules = []
+for node in ast.walk(ast.parse(open(sys.argv[1]).read())):
+    if isinstance(node, ast.Import):
+        modules += [alias.name for alias in node.names]
+    elif isinstance(node, ast.ImportFrom) and not node.level:
+        modules.append(node.module)
+deferred = {}
+for name in modules:
+    if name not in sys.modules:
+        before = time.perf_counter()
+        importlib.import_module(name)
+        deferred[name] = time.perf_counter() - before
+print(json.dumps({"import_streamlit": imported - started, "login_render": rendered - imported, "modules": modules, "deferred": deferred, "exception": bool(app.exception)}))
+"""
+
+
+# Write a synthetic KPI CSV with the dashboard's schema: n_sites sites, one row
+# per site every interval for periods intervals, sorted by time like an NMS
+# export. Uptime has occasional outage dips and energy drifts per site, so
+# alerts and forecasts have something to find.
+def generate_fleet(path, n_sites, periods, interval=DEFAULT_INTERVAL, start="2024-01-01", seed=0):
+    rng = np.random.default_rng(seed)
+    sites = np.array([f"Site_{i}" for i in range(n_sites)], dtype=object)
+    locations = np.array([f"Location_{i % 25}" for i in range(n_sites)], dtype=object)
+    base_energy = rng.uniform(300, 650, n_sites)
+    drift = rng.normal(0, 0.05, n_sites)
+    times = pd.date_range(start, periods=periods, freq=interval)
+
+    periods_per_chunk = max(1, GENERATOR_CHUNK_ROWS // n_sites)
+    with open(path, "w", newline="") as f:
+        f.write("site_id,location,timestamp,uptime,energy_consumption,alarm_count,signal_strength\n")
+        for first in range(0, periods, periods_per_chunk):
+            step = np.arange(first, min(first + periods_per_chunk, periods))
+            n = len(step) * n_sites
+            uptime = rng.uniform(96, 100, n)
+            outages = rng.random(n) < 0.02
+            uptime[outages] = rng.uniform(70, 95, outages.sum())
+            chunk = pd.DataFrame({
+                'site_id': np.tile(sites, len(step)),
+                'location': np.tile(locations, len(step)),
+                'timestamp': np.repeat(times[step].strftime("%Y-%m-%d %H:%M:%S"), n_sites),
+                'uptime': uptime.round(2),
+                'energy_consumption': (np.tile(base_energy, len(step)) + np.repeat(step, n_sites) * np.tile(drift, len(step)) + rng.normal(0, 60, n)).round(1),
+                'alarm_count': rng.poisson(np.where(outages, 8, 1)),
+                'signal_strength': rng.normal(-75, 8, n).round(1),
+            })
+            chunk.to_csv(f, header=False, index=False)
+
+
+# Peak resident set size of this process in bytes
+def _peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+# Time one stage, then run it again under tracemalloc for its peak
+# allocation; tracing slows allocation-heavy stages several times over, so
+# the timed run is untraced. reset() undoes what the timed run left behind
+# (a store, a cache) so the traced run does the same work.
+def _timed(results, stage, func, calls=1, reset=None):
+    started = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - started
+
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    func()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results.append({
+        'stage': stage,
+        'seconds': seconds,
+        'calls': calls,
+        'seconds_per_call': seconds / calls,
+        'peak_bytes': peak_bytes,
+    })
+    return value
+
+
+# Benchmark every data path on one fleet size. Runs in a fresh process so the
+# peak RSS belongs to this size alone.
+def run_size(rows, n_sites, interval, data_dir, seed=0):
+    periods = max(2, math.ceil(rows / n_sites))
+    csv_path = os.path.join(data_dir, f"fleet-{n_sites}x{periods}-{interval}-{seed}.csv")
+    generated = None
+    if not os.path.exists(csv_path):
+        started = time.perf_counter()
+        generate_fleet(csv_path + ".tmp", n_sites, periods, interval, seed=seed)
+        os.replace(csv_path + ".tmp", csv_path)
+        generated = time.perf_counter() - started
+
+    # Fresh store per run so ingest is measured, not the cached store
+    import kpi_store
+    kpi_store.STORE_DIR = tempfile.mkdtemp(prefix="kpi-bench-", dir=data_dir)
+    try:
+        return _run_stages(csv_path, periods, interval, generated, seed)
+    finally:
+        shutil.rmtree(kpi_store.STORE_DIR, ignore_errors=True)
+
+
+def _run_stages(csv_path, periods, interval, generated, seed):
+    import alerts
+    import anomalies
+    import forecast
+    import kpi_metrics
+    import kpi_store
+    import rollups
+    import plotly.express as px
+
+    results = []
+    path = _timed(results, "ingest_csv", lambda: kpi_store.ingest_file(csv_path), reset=lambda: shutil.rmtree(kpi_store.ingest_file(csv_path)))
+    dataset = _timed(results, "open_store", lambda: kpi_store.KpiDataset(path))
+
+    rng = np.random.default_rng(seed)
+    sample = list(dataset.sites[rng.choice(len(dataset.sites), min(SAMPLE_SITES, len(dataset.sites)), replace=False)])
+    start, end = dataset.min_time, dataset.max_time
+    week_start = max(start, end - pd.Timedelta(days=7))
+
+    _timed(results, "filter_site_full_range", lambda: [dataset.select(site, start, end) for site in sample], len(sample))
+    _timed(results, "filter_site_last_week", lambda: [dataset.select(site, week_start, end) for site in sample], len(sample))
+    frames = [dataset.select(site, start, end) for site in sample]
+    _timed(results, "site_metrics", lambda: [kpi_metrics.site_metrics(frame) for frame in frames], len(sample))
+    _timed(results, "fleet_summary_full_range", lambda: kpi_metrics.fleet_summary(dataset))
+    _timed(results, "fleet_summary_last_week", lambda: kpi_metrics.fleet_summary(dataset, week_start, end))
+
+    rules = alerts.AlertRules(copy.deepcopy(alerts.DEFAULT_RULES))
+    alerts._segment_alerts.clear()
+    alert_table = _timed(results, "alert_table", lambda: alerts.AlertTable(dataset, rules), reset=alerts._segment_alerts.clear)
+    _timed(results, "alert_messages", lambda: [alert_table.messages(site, start, end) for site in sample], len(sample))
+
+    _timed(results, "forecast_full_range", lambda: forecast.ForecastEngine(dataset))
+    _timed(results, "forecast_last_week", lambda: forecast.ForecastEngine(dataset, week_start, end))
+    anomaly_table = _timed(results, "anomaly_table", lambda: anomalies.AnomalyTable(dataset))
+    _timed(results, "anomaly_fleet_list", lambda: anomaly_table.fleet_list(week_start, end))
+
+    def figures():
+        for site in sample:
+            chart_df, _ = rollups.chart_frame(dataset, site, start, end)
+            px.line(chart_df, x='timestamp', y='uptime')
+            px.bar(chart_df, x='timestamp', y='energy_consumption')
+    _timed(results, "figures", figures, len(sample))
+
+    return {
+        'rows': dataset.rows,
+        'sites': len(dataset.sites),
+        'periods': periods,
+        'interval': interval,
+        'csv_bytes': os.path.getsize(csv_path),
+        'generate_seconds': generated,
+        'peak_rss_bytes': _peak_rss(),
+        'stages': results,
+    }
+
+
+# Cumulative first-import seconds of the given modules, from the
+# -X importtime log between the markers
+def _first_imports(log, modules):
+    imports = {}
+    lines = log.splitlines()
+    for line in lines[lines.index("-- first render --") + 1:lines.index("-- rendered --")]:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() in modules:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return imports
+
+
+# Cold start of the dashboard: Streamlit import, time until a new session's
+# login page has rendered (the script's own imports included) and the first
+# import time of every module the script imports, on the login page or
+# deferred to later runs, as the median over fresh interpreters. The store
+# and account files go to a scratch directory.
+def run_startup(runs=STARTUP_RUNS, dashboard=DASHBOARD):
+    samples = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory(prefix="kpi-startup-") as scratch:
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(dashboard), KPI_STORE_DIR=os.path.join(scratch, "kpi_store"), KPI_USER_DB=os.path.join(scratch, "users.db"))
+            env.pop("KPI_METRICS_FILE", None)
+            child = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT, dashboard],
+                cwd=scratch, env=env, capture_output=True, text=True, check=True,
+            )
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        if result["exception"]:
+            raise RuntimeError("The dashboard raised an exception while rendering the login page")
+        samples.append({"import_streamlit": result["import_streamlit"], "login_render": result["login_render"]})
+        samples[-1].update({f"import:{name}": seconds for name, seconds in _first_imports(child.stderr, result["modules"]).items()})
+        samples[-1].update({f"deferred_import:{name}": seconds for name, seconds in result["deferred"].items()})
+
+    stages = []
+    for stage in samples[0]:
+        seconds = statistics.median(sample.get(stage, 0.0) for sample in samples)
+        stages.append({'stage': stage, 'seconds': seconds, 'calls': 1, 'seconds_per_call': seconds, 'peak_bytes': None})
+    return stages
+
+
+def run_benchmark(sizes, n_sites, interval, data_dir, seed=0, startup_runs=STARTUP_RUNS):
+    os.makedirs(data_dir, exist_ok=True)
+    runs = []
+    for rows in sizes:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            run = pool.submit(run_size, rows, min(n_sites, rows), interval, data_dir, seed).result()
+        runs.append(run)
+        peak = f"{run['peak_rss_bytes'] / 2**20:.1f} MiB" if run['peak_rss_bytes'] else "n/a"
+        print(f"{run['rows']:>12,} rows  peak RSS {peak}", file=sys.stderr)
+        for stage in run['stages']:
+            print(f"    {stage['stage']:<26} {stage['seconds_per_call'] * 1000:10.2f} ms/call", file=sys.stderr)
+    startup = run_startup(startup_runs) if startup_runs else []
+    if startup:
+        print(f"{'startup':>12}", file=sys.stderr)
+    for stage in startup:
+        print(f"    {stage['stage']:<26} {stage['seconds'] * 1000:10.2f} ms", file=sys.stderr)
+    return {
+        'created': pd.Timestamp.now(tz="UTC").isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpu_count': os.cpu_count(),
+        'runs': runs,
+        'startup': startup,
+    }
+
+
+# (fleet size, stage) of every timing in a result file; startup timings are
+# listed under "startup"
+def _stages(result):
+    for run in result['runs']:
+        for stage in run['stages']:
+            yield run['rows'], stage
+    for stage in result.get('startup', []):
+        yield "startup", stage
+
+
+COMPARE_COLUMNS = ['rows', 'stage', 'baseline_ms', 'current_ms', 'ratio', 'regression']
+
+
+# Per-stage time ratio of a new result file against a baseline, matched by
+# fleet size; ratios above threshold are flagged as regressions
+def compare(baseline, current, threshold=1.2):
+    before = {(rows, stage['stage']): stage for rows, stage in _stages(baseline)}
+    rows = []
+    for size, stage in _stages(current):
+        old = before.get((size, stage['stage']))
+        if old is None:
+            continue
+        ratio = stage['seconds_per_call'] / old['seconds_per_call'] if old['seconds_per_call'] else float("inf")
+        rows.append({
+            'rows': size,
+            'stage': stage['stage'],
+            'baseline_ms': old['seconds_per_call'] * 1000,
+            'current_ms': stage['seconds_per_call'] * 1000,
+            'ratio': ratio,
+            'regression': ratio > threshold,
+        })
+    return pd.DataFrame(rows, columns=COMPARE_COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard's data paths on synthetic KPI fleets.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Write a synthetic KPI CSV")
+    generate.add_argument("output", help="CSV file to write")
+    generate.add_argument("--sites", type=int, default=DEFAULT_SITES)
+    generate.add_argument("--interval", default=DEFAULT_INTERVAL, help="Sampling interval as a pandas frequency, e.g. 15min or 1h")
+    generate.add_argument("--days", type=float, default=30, help="History length in days")
+    generate.add_argument("--seed", type=int, default=0)
+
+    run = commands.add_parser("run", help="Benchmark fleets of the given sizes and save the results")
+    run.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="Fleet sizes in rows")
+    run.add_argument("--sites", type=int, default=DEFAULT_SITES)
+    run.add_argument("--interval", default=DEFAULT_INTERVAL, help="Sampling interval as a pandas frequency")
+    run.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "kpi-bench"), help="Where generated CSVs and stores are kept")
+    run.add_argument("--output", help=f"Result file (default: {RESULTS_DIR}/<timestamp>.json)")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--startup-runs", type=int, default=STARTUP_RUNS, help="Fresh interpreters the dashboard cold start is timed in (0 to skip)")
+
+    diff = commands.add_parser("compare", help="Compare a result file against a baseline")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    diff.add_argument("--threshold", type=float, default=1.2, help="Time ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        periods = max(2, int(pd.Timedelta(days=args.days) / pd.Timedelta(pd.tseries.frequencies.to_offset(args.interval))))
+        generate_fleet(args.output, args.sites, periods, args.interval, seed=args.seed)
+        print(f"{args.sites * periods:,} rows written to {args.output}", file=sys.stderr)
+    elif args.command == "run":
+        results = run_benchmark(args.rows, args.sites, args.interval, args.data_dir, args.seed, args.startup_runs)
+        output = args.output or os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"Results saved to {output}", file=sys.stderr)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        table = compare(baseline, current, args.threshold)
+        if table.empty:
+            print("No comparable stages: the result files share no fleet size and stage.", file=sys.stderr)
+            return
+        print(table.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+        if table['regression'].any():
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
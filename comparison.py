@@ -0,0 +1,77 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import kpi_metrics
+import rollups
+
+# Sites one comparison can hold
+MAX_COMPARE_SITES = 50
+
+# KPIs that add up within a time bucket; the others are averaged
+SUM_COLUMNS = ['energy_consumption', 'alarm_count']
+
+
+# Positions (index into sites), timestamps and values of column for the
+# selected sites with start <= timestamp <= end, gathered by binary search
+# within each site's rows of the segments overlapping the range
+def _gather(dataset, sites, start, end, column):
+    positions, timestamps, values = [], [], []
+    segments = dataset.segments_between(start, end) or dataset.segments[:1]
+    start, end = np.datetime64(start, "ns"), np.datetime64(end, "ns")
+    for segment in segments:
+        data = segment.df[column].to_numpy()
+        for position, site in enumerate(sites):
+            lo, hi = segment.bounds(dataset.site_code(site))
+            site_times = segment.timestamps[lo:hi]
+            first = lo + np.searchsorted(site_times, start, side="left")
+            last = lo + np.searchsorted(site_times, end, side="right")
+            positions.append(np.full(last - first, position, dtype=np.intp))
+            timestamps.append(segment.timestamps[first:last])
+            values.append(data[first:last])
+    positions = np.concatenate(positions)
+    instrumentation.count("rows_scanned", len(positions))
+    return positions, np.concatenate(timestamps), kpi_metrics.kpi_values(np.concatenate(values))
+
+
+# Time x site matrix of gathered rows, one row per timestamp ("raw") or per
+# day/week/month bucket, built with one bincount over (bucket, site) cells
+def _pivot(sites, positions, timestamps, values, column, freq):
+    buckets = timestamps if freq == "raw" else rollups.bucket_starts(timestamps, freq)
+    times, time_index = np.unique(buckets, return_inverse=True)
+    cells = len(times) * len(sites)
+    valid = ~np.isnan(values)
+    flat = time_index[valid] * len(sites) + positions[valid]
+    sums = np.bincount(flat, weights=values[valid], minlength=cells)
+    counts = np.bincount(flat, minlength=cells)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        matrix = sums if column in SUM_COLUMNS else sums / counts
+    matrix = np.where(counts > 0, matrix, np.nan).reshape(len(times), len(sites))
+    return pd.DataFrame(matrix, index=pd.DatetimeIndex(times, name='timestamp'), columns=pd.Index(sites, name='site_id'))
+
+
+# Aligned time x site matrix of one KPI with its resolution label, for a
+# multi-trace chart. "auto" keeps raw timestamps when they fit in max_points
+# per trace, otherwise uses the finest rollup that does; "raw" downsamples
+# with LTTB when there are too many rows.
+def site_matrix(dataset, sites, start, end, column, resolution="auto", max_points=rollups.MAX_CHART_POINTS):
+    gathered = _gather(dataset, sites, start, end, column)
+    if resolution in ("auto", "raw"):
+        matrix = _pivot(sites, *gathered, column, "raw")
+        if len(matrix) <= max_points:
+            return matrix, "raw"
+        if resolution == "raw":
+            # One set of rows for all traces, picked on the cross-site mean
+            x = matrix.index.to_numpy().view(np.int64)
+            with np.errstate(invalid="ignore"), warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mean = np.nanmean(matrix.to_numpy(), axis=1)
+            return matrix.iloc[rollups.lttb_indices(x, mean, max_points)], "downsampled"
+
+    for freq in rollups.ROLLUP_FREQUENCIES if resolution == "auto" else [resolution]:
+        matrix = _pivot(sites, *gathered, column, freq)
+        if resolution != "auto" or len(matrix) <= max_points:
+            break
+    return matrix, rollups.ROLLUP_FREQUENCIES[freq]
@@ -0,0 +1,120 @@
+import os
+import threading
+from collections import OrderedDict
+
+import kpi_store
+
+# Memory budget for datasets shared by all sessions of this server process
+CACHE_BUDGET_MB = float(os.environ.get("KPI_CACHE_MB", "1024"))
+
+
+# Process-wide LRU cache of loaded KPI datasets keyed on upload content hash.
+# Every session uploading the same file gets the same read-only KpiDataset.
+class DatasetCache:
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._used_bytes = 0  # Total nbytes of the entries
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the dataset for an upload, ingesting it on the first request.
+    # progress is forwarded to the ingest when the file is not cached yet;
+    # key is the upload's hash_upload() digest when the caller already has it.
+    def get(self, source, progress=None, key=None):
+        key = key or kpi_store.hash_upload(source)
+
+        with self._lock:
+            dataset = self._lookup(key)
+            if dataset is not None:
+                return dataset
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Only one session ingests a given file; the others wait for it
+        with key_lock:
+            with self._lock:
+                dataset = self._lookup(key)
+                if dataset is not None:
+                    return dataset
+                self.misses += 1
+            try:
+                dataset = kpi_store.KpiDataset(kpi_store.ingest_file(source, key, progress))
+                dataset.nbytes  # Sized outside the lock
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+            with self._lock:
+                self._put(key, dataset)
+                self._evict(keep=key)
+        return dataset
+
+    # Latest version of a dataset after appends by any session or process
+    def refresh(self, dataset):
+        if not dataset.is_stale():
+            return dataset
+        with self._lock:
+            cached = self._entries.get(dataset.store_key)
+        if cached is not None and cached is not dataset and not cached.is_stale():
+            return cached
+        fresh = kpi_store.KpiDataset(dataset.path)
+        fresh.nbytes  # Sized outside the lock
+        with self._lock:
+            self._put(dataset.store_key, fresh)
+            self._evict(keep=dataset.store_key)
+        return fresh
+
+    # Append a delta file of new KPI intervals to a dataset's store
+    def append(self, dataset, source, progress=None):
+        return kpi_store.append_file(dataset.path, source, progress)
+
+    # Look up a key and mark it most recently used; caller holds the lock
+    def _lookup(self, key):
+        dataset = self._entries.get(key)
+        if dataset is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return dataset
+
+    # Insert or replace an entry as most recently used; caller holds the lock
+    def _put(self, key, dataset):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._used_bytes -= previous.nbytes
+        self._entries[key] = dataset
+        self._used_bytes += dataset.nbytes
+
+    # Drop least recently used datasets until the budget is met
+    def _evict(self, keep):
+        while self._used_bytes > self.budget_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            self._used_bytes -= self._entries.pop(key).nbytes
+            self.evictions += 1
+
+    def used_bytes(self):
+        return self._used_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._used_bytes = 0
+
+    # Counters for monitoring
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "used_mb": round(self.used_bytes() / 2**20, 2),
+                "budget_mb": round(self.budget_bytes / 2**20, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Shared instance; modules are imported once per Streamlit server process
+DATASET_CACHE = DatasetCache(int(CACHE_BUDGET_MB * 2**20))
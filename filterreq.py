@@ -2,7 +2,7 @@
 import subprocess
 
 # List of required libraries
-required_libraries = ["streamlit", "pandas", "plotly", "scikit-learn", "numpy"]
+required_libraries = ["streamlit", "pandas", "plotly", "numpy"]
 
 # Run `pip freeze` and capture the output
 result = subprocess.run(["pip", "freeze"], stdout=subprocess.PIPE, text=True)
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# KPI columns the engine fits a linear trend for
+FORECAST_TARGETS = ['uptime', 'energy_consumption']
+
+# Two-sided 95% normal quantile for the prediction band
+BAND_Z = 1.96
+
+NANOSECONDS_PER_DAY = 86_400 * 10**9
+
+
+# Per-group count, means and centered second moments of (x, y), plus the
+# first and last x. x is in days, codes are group ids in [0, n_groups), rows
+# are time-ordered within each group.
+def trend_moments(codes, x, y, n_groups):
+    valid = ~np.isnan(y)
+    codes, x, y = codes[valid], x[valid], y[valid].astype(np.float64)
+
+    n = np.bincount(codes, minlength=n_groups).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.bincount(codes, weights=x, minlength=n_groups) / n
+        y_mean = np.bincount(codes, weights=y, minlength=n_groups) / n
+
+    # Center per group before taking second moments for numerical stability
+    dx = x - x_mean[codes]
+    dy = y - y_mean[codes]
+    first_x = np.full(n_groups, np.nan)
+    last_x = np.full(n_groups, np.nan)
+    present, first_idx = np.unique(codes, return_index=True)
+    first_x[present] = x[first_idx]
+    last_x[present] = x[len(codes) - 1 - np.unique(codes[::-1], return_index=True)[1]]
+    return {
+        'n': n,
+        'x_mean': np.nan_to_num(x_mean),
+        'y_mean': np.nan_to_num(y_mean),
+        'sxx': np.bincount(codes, weights=dx * dx, minlength=n_groups),
+        'sxy': np.bincount(codes, weights=dx * dy, minlength=n_groups),
+        'syy': np.bincount(codes, weights=dy * dy, minlength=n_groups),
+        'first_x': first_x,
+        'last_x': last_x,
+    }
+
+
+# Merge the moments of two disjoint row sets (pairwise update of Chan et al.)
+def combine_moments(a, b):
+    n = a['n'] + b['n']
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.where(n > 0, a['n'] * b['n'] / n, 0.0)
+        share = np.where(n > 0, b['n'] / n, 0.0)
+    dx = b['x_mean'] - a['x_mean']
+    dy = b['y_mean'] - a['y_mean']
+    return {
+        'n': n,
+        'x_mean': a['x_mean'] + dx * share,
+        'y_mean': a['y_mean'] + dy * share,
+        'sxx': a['sxx'] + b['sxx'] + dx * dx * weight,
+        'sxy': a['sxy'] + b['sxy'] + dx * dy * weight,
+        'syy': a['syy'] + b['syy'] + dy * dy * weight,
+        'first_x': np.fmin(a['first_x'], b['first_x']),
+        'last_x': np.fmax(a['last_x'], b['last_x']),
+    }
+
+
+# Closed-form least-squares line, next-step prediction and 95% band per group
+def fit_from_moments(m):
+    n, x_mean, sxx, sxy = m['n'], m['x_mean'], m['sxx'], m['sxy']
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = np.where(sxx > 0, sxy / sxx, np.nan)
+        intercept = m['y_mean'] - slope * x_mean
+        sse = np.maximum(m['syy'] - slope * sxy, 0.0)
+        resid_std = np.where(n > 2, np.sqrt(sse / (n - 2)), np.nan)
+
+        # Next step is one average sampling interval after the last observation
+        next_x = m['last_x'] + (m['last_x'] - m['first_x']) / (n - 1)
+        prediction = intercept + slope * next_x
+        band = BAND_Z * resid_std * np.sqrt(1 + 1 / n + (next_x - x_mean) ** 2 / sxx)
+
+    return pd.DataFrame({
+        'n': n.astype(np.int64),
+        'slope_per_day': slope,
+        'intercept': intercept,
+        'x_mean': x_mean,
+        'sxx': sxx,
+        'resid_std': resid_std,
+        'next_x': next_x,
+        'prediction': prediction,
+        'lower': prediction - band,
+        'upper': prediction + band,
+    })
+
+
+# Linear trend forecasts for every site of a dataset over one date range.
+# fits, if given, are the per-target fits saved by an earlier engine.
+class ForecastEngine:
+    def __init__(self, dataset, start=None, end=None, fits=None):
+        n_sites = len(dataset.sites)
+        # Regress on real time (days since the dataset's first timestamp), not row number
+        self.origin = dataset.min_time
+        if fits is not None:
+            self.fits = fits
+            return
+        origin = np.datetime64(self.origin, "ns").astype(np.int64)
+
+        moments = {}
+        for segment in dataset.segments_between(start, end) or dataset.segments[:1]:
+            instrumentation.count("rows_scanned", segment.rows)
+            mask = segment.codes >= 0
+            if start is not None:
+                mask &= segment.timestamps >= np.datetime64(start, "ns")
+            if end is not None:
+                mask &= segment.timestamps <= np.datetime64(end, "ns")
+            x = (segment.timestamps[mask].view(np.int64) - origin).astype(np.float64) / NANOSECONDS_PER_DAY
+            codes = segment.codes[mask].astype(np.intp)
+            for target in FORECAST_TARGETS:
+                segment_moments = trend_moments(codes, x, segment.df[target].to_numpy()[mask], n_sites)
+                moments[target] = segment_moments if target not in moments else combine_moments(moments[target], segment_moments)
+
+        self.fits = {}
+        for target, target_moments in moments.items():
+            fits = fit_from_moments(target_moments)
+            fits.index = pd.Index(dataset.sites, name='site_id')
+            self.fits[target] = fits[fits['n'] > 0]
+
+    # Next-step prediction and 95% band per target, or None without enough data
+    def predict(self, site):
+        result = {}
+        for target, fits in self.fits.items():
+            if site not in fits.index or np.isnan(fits.at[site, 'prediction']):
+                return None
+            row = fits.loc[site]
+            result[target] = {
+                'prediction': float(row['prediction']),
+                'lower': float(row['lower']),
+                'upper': float(row['upper']),
+                'slope_per_day': float(row['slope_per_day']),
+            }
+        return result
+
+    # Sites ordered from the fastest predicted uptime decline
+    def uptime_degradation(self):
+        fits = self.fits['uptime']
+        return fits[['slope_per_day', 'prediction', 'lower', 'upper']].dropna(subset=['prediction']).sort_values('slope_per_day')
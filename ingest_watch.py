@@ -0,0 +1,86 @@
+# Watch a directory for new KPI interval files and append them to a store.
+# A file is appended once its size and modification time have stayed the same
+# across two consecutive scans, so the NMS may write files in place as long as
+# it finishes each one within a scan interval. With --interval 0 there is only
+# one scan and every file is taken as complete: write them elsewhere and move
+# them into the directory.
+import argparse
+import glob
+import os
+import time
+
+import alerts
+import kpi_store
+import snapshots
+
+
+# Modification time for ordering the scan; a file removed since the glob sorts
+# last and is skipped when its size is read
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return float("inf")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append new KPI interval CSV files from a directory to an existing KPI store.")
+    parser.add_argument("base", help="CSV the store was created from (as uploaded to the dashboard) or the store directory")
+    parser.add_argument("directory", help="Directory the NMS drops delta CSV files into")
+    parser.add_argument("--interval", type=float, default=60.0, help="Seconds between scans; 0 scans once and exits")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not precompute the dashboard snapshot after appending")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.base):
+        if not os.path.exists(os.path.join(args.base, kpi_store.META_FILE)):
+            parser.error(f"{args.base} is not a KPI store directory")
+        if not kpi_store.is_store(args.base):
+            parser.error(f"{args.base} was written by another version of the dashboard; pass the CSV it was created from to rebuild it")
+        path = args.base
+    else:
+        path = kpi_store.ingest_file(args.base)
+    seen = {}
+    scanned = {}
+    while True:
+        appended = False
+        for delta_path in sorted(glob.glob(os.path.join(args.directory, "*.csv")), key=_mtime):
+            try:
+                stat = os.stat(delta_path)
+            except OSError:
+                # Renamed or deleted by its writer; picked up again if it reappears
+                scanned.pop(delta_path, None)
+                continue
+            state = (stat.st_size, stat.st_mtime)
+            if seen.get(delta_path) == state:
+                continue
+            # Still being written, or new since the last scan
+            settled = scanned.get(delta_path) == state or args.interval <= 0
+            scanned[delta_path] = state
+            if not settled:
+                continue
+            try:
+                report = kpi_store.append_file(path, delta_path)
+            except OSError as e:
+                # Gone or unreadable since the scan; retried on the next one
+                print(f"{delta_path}: {e}")
+                scanned.pop(delta_path, None)
+                continue
+            except ValueError as e:
+                print(f"{delta_path}: {e}")
+            else:
+                if not report["already_ingested"]:
+                    appended = True
+                    print(f"{delta_path}: {report['appended']} rows appended, {report['duplicates']} duplicates and {report['bad_row_count']} invalid rows skipped")
+            seen[delta_path] = state
+
+        # Dashboards pick up the new version from its snapshot
+        if appended and not args.no_snapshot:
+            snapshots.build(kpi_store.KpiDataset(path), alerts.load_rules())
+
+        if args.interval <= 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Optional export of every recorded rerun: a .prom file gets Prometheus text
+# exposition format (cumulative per process), anything else JSON lines
+EXPORT_FILE = os.environ.get("KPI_METRICS_FILE")
+
+# Reruns kept per session for the diagnostics panel
+HISTORY_SIZE = 20
+
+# The rerun being recorded on the current script thread, if any
+_local = threading.local()
+
+_export_lock = threading.Lock()
+_totals = {"reruns": 0, "rerun_seconds": 0.0, "span_seconds": {}, "span_calls": {}, "counters": {}}
+
+
+# Returned by span() when the current thread is not recording
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# Adds its elapsed time to a rerun's span total on exit
+class _Span:
+    __slots__ = ("rerun", "name", "started")
+
+    def __init__(self, rerun, name):
+        self.rerun = rerun
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.rerun.add_span(self.name, time.perf_counter() - self.started)
+        return False
+
+
+# Timing spans and counters of one script run
+class Rerun:
+    def __init__(self, label=""):
+        self.label = label
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.spans = {}
+        self.span_calls = {}
+        self.counters = {}
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+        self.span_calls[name] = self.span_calls.get(name, 0) + 1
+
+    def as_dict(self):
+        return {
+            "time": datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+            "label": self.label,
+            "seconds": self.seconds,
+            "spans": dict(self.spans),
+            "span_calls": dict(self.span_calls),
+            "counters": dict(self.counters),
+        }
+
+
+# Time a block of the current rerun; a shared no-op when nothing is recorded
+def span(name):
+    rerun = getattr(_local, "rerun", None)
+    return _NULL_SPAN if rerun is None else _Span(rerun, name)
+
+
+# Add to a counter of the current rerun (rows scanned, bytes sent, ...)
+def count(name, value=1):
+    rerun = getattr(_local, "rerun", None)
+    if rerun is not None:
+        rerun.counters[name] = rerun.counters.get(name, 0) + value
+
+
+# Whether the current thread is recording, for counters that cost work to compute
+def active():
+    return getattr(_local, "rerun", None) is not None
+
+
+# Drop a rerun left open by a script run that ended early (st.stop, st.rerun)
+def clear():
+    _local.rerun = None
+
+
+# Records reruns of one session and keeps the last history_size of them
+class Recorder:
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.history = deque(maxlen=history_size)
+
+    def start(self, label=""):
+        _local.rerun = Rerun(label)
+        return _local.rerun
+
+    def finish(self, export_file=EXPORT_FILE):
+        rerun = getattr(_local, "rerun", None)
+        _local.rerun = None
+        if rerun is None:
+            return None
+        rerun.seconds = time.perf_counter() - rerun.started
+        record = rerun.as_dict()
+        self.history.append(record)
+        if export_file:
+            export(record, export_file)
+        return record
+
+    # One row per recorded rerun, newest first, with span times in ms
+    def frame(self):
+        import pandas as pd  # Not needed to render the login page
+
+        rows = []
+        for record in reversed(self.history):
+            row = {"time": record["time"], "label": record["label"], "total_ms": record["seconds"] * 1000}
+            row.update({f"{name}_ms": seconds * 1000 for name, seconds in record["spans"].items()})
+            row.update(record["counters"])
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+# Append a rerun record to a JSON-lines file, or fold it into the process
+# totals and rewrite a Prometheus text file
+def export(record, path):
+    with _export_lock:
+        if not path.endswith(".prom"):
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            return
+
+        _totals["reruns"] += 1
+        _totals["rerun_seconds"] += record["seconds"]
+        for name, seconds in record["spans"].items():
+            _totals["span_seconds"][name] = _totals["span_seconds"].get(name, 0.0) + seconds
+            _totals["span_calls"][name] = _totals["span_calls"].get(name, 0) + record["span_calls"][name]
+        for name, value in record["counters"].items():
+            _totals["counters"][name] = _totals["counters"].get(name, 0) + value
+
+        lines = [
+            "# TYPE kpi_dashboard_reruns_total counter",
+            f"kpi_dashboard_reruns_total {_totals['reruns']}",
+            "# TYPE kpi_dashboard_rerun_seconds_total counter",
+            f"kpi_dashboard_rerun_seconds_total {_totals['rerun_seconds']:.6f}",
+            "# TYPE kpi_dashboard_span_seconds_total counter",
+        ]
+        lines += [f'kpi_dashboard_span_seconds_total{{span="{name}"}} {seconds:.6f}' for name, seconds in sorted(_totals["span_seconds"].items())]
+        lines.append("# TYPE kpi_dashboard_span_calls_total counter")
+        lines += [f'kpi_dashboard_span_calls_total{{span="{name}"}} {calls}' for name, calls in sorted(_totals["span_calls"].items())]
+        lines.append("# TYPE kpi_dashboard_events_total counter")
+        lines += [f'kpi_dashboard_events_total{{name="{name}"}} {value}' for name, value in sorted(_totals["counters"].items())]
+
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, path)
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Additive per-site totals; store segments keep one set each so appends only
+# aggregate the new rows
+TOTAL_COLUMNS = ['uptime_sum', 'uptime_count', 'energy_sum', 'alarm_sum', 'signal_sum', 'signal_count', 'rows']
+
+# Alarm counts are stored as int32; a row with a blank count keeps this value
+# and is left out of alarm sums, alerts and anomalies
+MISSING_COUNT = np.iinfo(np.int32).min
+
+
+# KPI values as float64, with missing counts as NaN like missing float KPIs
+def kpi_values(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        return np.where(values == MISSING_COUNT, np.nan, values)
+    return values.astype(np.float64)
+
+
+# Per-group sum and count of the non-NaN values selected by mask
+def _group_sum_count(codes, values, mask, n_groups):
+    valid = mask & ~np.isnan(values)
+    sums = np.bincount(codes[valid], weights=values[valid].astype(np.float64), minlength=n_groups)
+    counts = np.bincount(codes[valid], minlength=n_groups)
+    return sums, counts
+
+
+# Per-site totals of the rows selected by mask, in one vectorized pass
+def site_totals(codes, frame, mask, n_sites):
+    mask = mask & (codes >= 0)
+    codes = np.where(mask, codes, 0).astype(np.intp)
+
+    uptime = frame['uptime'].to_numpy()
+    energy = frame['energy_consumption'].to_numpy()
+    alarms = frame['alarm_count'].to_numpy()
+    signal = frame['signal_strength'].to_numpy()
+
+    totals = {}
+    totals['uptime_sum'], totals['uptime_count'] = _group_sum_count(codes, uptime, mask, n_sites)
+    totals['energy_sum'], _ = _group_sum_count(codes, energy, mask, n_sites)
+    counted = mask & (alarms != MISSING_COUNT)
+    totals['alarm_sum'] = np.bincount(codes[counted], weights=alarms[counted], minlength=n_sites)
+    totals['signal_sum'], totals['signal_count'] = _group_sum_count(codes, signal, mask, n_sites)
+    totals['rows'] = np.bincount(codes[mask], minlength=n_sites)
+    return totals
+
+
+# Metric columns from per-site totals
+def _summarize(totals, index):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return pd.DataFrame({
+            'avg_uptime': totals['uptime_sum'] / totals['uptime_count'],
+            'total_energy': totals['energy_sum'],
+            'total_alarms': totals['alarm_sum'].astype(np.int64),
+            'avg_signal': totals['signal_sum'] / totals['signal_count'],
+            'rows': totals['rows'].astype(np.int64),
+        }, index=index)
+
+
+# Metrics of one site's filtered rows. Accumulates in float64 in row order like
+# fleet_summary, so the site view, fleet overview and batch report agree.
+def site_metrics(frame):
+    codes = np.zeros(len(frame), dtype=np.intp)
+    totals = site_totals(codes, frame, np.ones(len(frame), dtype=bool), 1)
+    summary = _summarize(totals, pd.RangeIndex(1))
+    return {name: summary[name].iloc[0] for name in summary.columns}
+
+
+# Avg uptime, total energy, total alarms, avg signal and, given an alert table,
+# the alert count per rule for every site with start <= timestamp <= end.
+# Segments inside the range contribute the totals they keep, segments outside
+# it are skipped, and only those straddling a bound are scanned.
+def fleet_summary(dataset, start=None, end=None, alert_table=None):
+    n_sites = len(dataset.sites)
+
+    totals = {name: np.zeros(n_sites) for name in TOTAL_COLUMNS}
+    for segment in dataset.segments_between(start, end):
+        if (start is None or start <= segment.min_time) and (end is None or end >= segment.max_time):
+            segment_totals = segment.totals()
+        else:
+            mask = np.ones(segment.rows, dtype=bool)
+            if start is not None:
+                mask &= segment.timestamps >= np.datetime64(start, "ns")
+            if end is not None:
+                mask &= segment.timestamps <= np.datetime64(end, "ns")
+            segment_totals = site_totals(segment.codes, segment.df, mask, n_sites)
+            instrumentation.count("rows_scanned", segment.rows)
+        for name in TOTAL_COLUMNS:
+            values = segment_totals[name]
+            totals[name][:len(values)] += values
+
+    summary = _summarize(totals, pd.Index(dataset.sites, name='site_id'))
+    if alert_table is not None:
+        summary = summary.join(alert_table.fleet_counts(start, end))
+    return summary[summary['rows'] > 0]
+
+
+# Location of each site's first row with start <= timestamp <= end
+def site_locations(dataset, start=None, end=None):
+    locations = pd.Series(pd.NA, index=pd.Index(dataset.sites, name='site_id'), dtype=object)
+    for segment in dataset.segments_between(start, end):
+        if 'location' not in segment.df.columns:
+            return locations
+        mask = segment.codes >= 0
+        if start is not None:
+            mask &= segment.timestamps >= np.datetime64(start, "ns")
+        if end is not None:
+            mask &= segment.timestamps <= np.datetime64(end, "ns")
+        rows = np.flatnonzero(mask)
+        codes, first = np.unique(segment.codes[rows], return_index=True)
+        missing = locations.iloc[codes].isna().to_numpy()
+        values = np.asarray(segment.df['location'].iloc[rows[first[missing]]], dtype=object)
+        locations.iloc[codes[missing]] = values
+    return locations
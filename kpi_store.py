@@ -0,0 +1,777 @@
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import warnings
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are serialized within one process only
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import kpi_metrics
+import rollups
+
+# Directory holding one columnar store per distinct uploaded file
+STORE_DIR = os.environ.get("KPI_STORE_DIR", "kpi_store")
+STORE_VERSION = 1
+META_FILE = "meta.json"
+LOCK_FILE = ".lock"
+OFFSETS_FILE = "offsets.npy"
+ROLLUP_DIR = "rollup_{freq}"
+TOTALS_DIR = "totals"
+SEGMENT_DIR = "seg-{name}"
+
+# Rows are partitioned into one segment per calendar month, so a date range
+# only maps the segments it overlaps. Appends add a segment per month they
+# touch; once there are more than MAX_SEGMENTS of those, each month with
+# several segments is merged back into one.
+MAX_SEGMENTS = int(os.environ.get("KPI_MAX_SEGMENTS", "16"))
+
+# Required columns and the compact dtype each KPI column is stored as
+EXPECTED_COLUMNS = ['site_id', 'timestamp', 'uptime', 'energy_consumption', 'alarm_count', 'signal_strength']
+CATEGORY_COLUMNS = ['site_id', 'location']
+FLOAT_COLUMNS = ['uptime', 'energy_consumption', 'signal_strength']
+INT_COLUMNS = ['alarm_count']
+INT_DTYPE = np.int32  # Blank counts are stored as kpi_metrics.MISSING_COUNT
+
+# Rows parsed and validated per chunk while ingesting, and the CSV bytes
+# read for one chunk (cut at the last complete line)
+CHUNK_ROWS = 200_000
+CHUNK_BYTES = 16 * 2**20
+MAX_REPORTED_BAD_ROWS = 100
+SPILL_DTYPES = {
+    'site_id': np.int32,
+    'location': np.int32,
+    'timestamp': "datetime64[ns]",
+    'uptime': np.float32,
+    'energy_consumption': np.float32,
+    'signal_strength': np.float32,
+    'alarm_count': INT_DTYPE,
+}
+
+
+# Open a Streamlit UploadedFile, a path or a file object for binary reading
+def open_upload(source):
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, "rb")
+    source.seek(0)
+    return source
+
+
+# Content hash used to name the store, so identical uploads share one copy
+def hash_upload(source, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    f = open_upload(source)
+    try:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    finally:
+        if f is not source:
+            f.close()
+    return digest.hexdigest()
+
+
+# Validate and downcast one parsed chunk. Returns the typed columns and, per
+# row, the reason it was rejected ("" for valid rows).
+def _encode_chunk(chunk, categories):
+    reasons = pd.Series("", index=chunk.index)
+
+    def reject(failed, reason):
+        nonlocal reasons
+        reasons = reasons.mask((reasons == "") & failed, reason)
+
+    columns = {}
+    missing_site = chunk['site_id'].isnull()
+    # Blank lines come through as rows with every field missing
+    reject(chunk[missing_site].isnull().all(axis=1).reindex(chunk.index, fill_value=False), "empty line")
+    reject(missing_site, "missing site_id")
+    timestamps = pd.to_datetime(chunk['timestamp'], format='ISO8601', errors='coerce')
+    reject(timestamps.isnull(), "timestamp could not be parsed as a date")
+    columns['timestamp'] = timestamps.to_numpy(dtype="datetime64[ns]")
+
+    for col in FLOAT_COLUMNS:
+        values = pd.to_numeric(chunk[col], errors='coerce')
+        reject(values.isnull() & chunk[col].notnull(), f"'{col}' is not numeric")
+        columns[col] = values.to_numpy(dtype=np.float32)
+    info = np.iinfo(INT_DTYPE)
+    for col in INT_COLUMNS:
+        values = pd.to_numeric(chunk[col], errors='coerce')
+        invalid = (values.isnull() & chunk[col].notnull()) | (values <= kpi_metrics.MISSING_COUNT) | (values > info.max) | (values % 1 > 0)
+        reject(invalid, f"'{col}' is not a valid count")
+        columns[col] = values.fillna(kpi_metrics.MISSING_COUNT).clip(info.min, info.max).to_numpy().astype(INT_DTYPE)
+
+    # Extend each category dictionary with values first seen in this chunk's
+    # valid rows; rejected rows are dropped later and keep code -1
+    valid = (reasons == "").to_numpy()
+    for col in CATEGORY_COLUMNS:
+        if col in chunk.columns:
+            known = categories.setdefault(col, [])
+            values = chunk[col][valid]
+            new_values = values.dropna().unique()
+            index = pd.Index(known)
+            known.extend(str(v) for v in new_values[~pd.Index(new_values).isin(index)])
+            codes = np.full(len(chunk), -1, dtype=np.int32)
+            codes[valid] = pd.Index(known).get_indexer(values)
+            columns[col] = codes
+    return columns, reasons.to_numpy()
+
+
+# Parse an upload in chunks of about CHUNK_BYTES. Yields each chunk's rows,
+# the file line number of every row, and (line, reason) for the lines that do
+# not split into the header's fields, which the parser skips. Chunks are cut
+# here rather than by read_csv's chunksize, so line numbers count blank lines
+# (kept as empty rows) and skipped lines exactly. Each chunk is parsed after a
+# copy of the header and an empty row, so the header, not the chunk's first
+# line, sets the expected field count.
+def _read_chunks(f):
+    header = f.readline().rstrip(b"\r\n") + b"\n"
+    field_count = len(pd.read_csv(io.BytesIO(header), nrows=0).columns)
+    first_line = 2  # Line 1 is the header
+    rest = b""
+    while True:
+        data = f.read(CHUNK_BYTES)
+        if data:
+            block = rest + data
+            cut = block.rfind(b"\n") + 1
+            block, rest = block[:cut], block[cut:]
+            if not block:
+                continue  # A line longer than CHUNK_BYTES so far
+        elif rest:
+            block, rest = rest + b"\n", b""  # Last line without a line break
+        else:
+            return
+        text = io.BytesIO()
+        text.write(header + b"," * (field_count - 1) + b"\n")
+        text.write(block)
+        text.seek(0)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", pd.errors.ParserWarning)
+            chunk = pd.read_csv(
+                text, dtype={col: str for col in CATEGORY_COLUMNS}, index_col=False,
+                skip_blank_lines=False, on_bad_lines="warn",
+            ).iloc[1:].reset_index(drop=True)
+        malformed = [
+            (first_line + int(match.group(1)) - 3, match.group(2))
+            for warning in caught
+            for match in re.finditer(r"Skipping line (\d+): (.*)", str(warning.message))
+        ]
+        line_count = block.count(b"\n")
+        row_lines = np.setdiff1d(np.arange(first_line, first_line + line_count), [line for line, _ in malformed])
+        yield chunk, row_lines, malformed
+        first_line += line_count
+
+
+# Parse the upload in bounded chunks, appending valid rows column by column to
+# spill files, one directory per calendar month. categories is extended in
+# place with new site/location values. Returns the stored column names, row
+# count and bad-row report.
+def _spill_chunks(source, spill_dir, categories, progress=None):
+    f = open_upload(source)
+    try:
+        f.seek(0, os.SEEK_END)
+        total_bytes = max(f.tell(), 1)
+        f.seek(0)
+
+        names = None
+        rows = 0
+        bad_rows = []
+        bad_row_count = 0
+        for chunk, lines, malformed in _read_chunks(f):
+            if names is None:
+                if 'timestamp' not in chunk.columns:
+                    raise ValueError("No 'timestamp' column found in the uploaded file.")
+                missing_columns = [col for col in EXPECTED_COLUMNS if col not in chunk.columns]
+                if missing_columns:
+                    raise ValueError(f"Missing required columns: {missing_columns}")
+                names = [col for col in chunk.columns if col in SPILL_DTYPES]
+
+            columns, reasons = _encode_chunk(chunk, categories)
+            bad = reasons != ""
+            bad_row_count += int(bad.sum()) + len(malformed)
+            reported = sorted(malformed + [(int(lines[offset]), reasons[offset]) for offset in np.flatnonzero(bad)])
+            bad_rows.extend([line, reason] for line, reason in reported[:MAX_REPORTED_BAD_ROWS - len(bad_rows)])
+            _spill(spill_dir, {name: columns[name][~bad] for name in names})
+            rows += int((~bad).sum())
+
+            if progress is not None:
+                progress(min(f.tell() / total_bytes, 1.0))
+    finally:
+        if f is not source:
+            f.close()
+
+    if names is None:
+        raise ValueError("No valid rows found in the uploaded file.")
+    return names, rows, bad_rows, bad_row_count
+
+
+# Append rows to the spill files of the months they fall in
+def _spill(spill_dir, columns):
+    months = _months(columns['timestamp'])
+    for month in np.unique(months):
+        in_month = months == month
+        month_dir = os.path.join(spill_dir, str(month))
+        os.makedirs(month_dir, exist_ok=True)
+        for name, values in columns.items():
+            with open(os.path.join(month_dir, name), "ab") as spill:
+                values[in_month].astype(SPILL_DTYPES[name]).tofile(spill)
+
+
+# Months spilled so far, oldest first, with their row counts
+def _spilled_months(spill_dir):
+    months = []
+    for month in sorted(os.listdir(spill_dir)):
+        size = os.path.getsize(os.path.join(spill_dir, month, 'timestamp'))
+        months.append((month, size // np.dtype(SPILL_DTYPES['timestamp']).itemsize))
+    return months
+
+
+# Memory-map one spilled column of a month
+def _spilled(month_dir, name, rows):
+    return np.memmap(os.path.join(month_dir, name), dtype=SPILL_DTYPES[name], mode="r", shape=(rows,))
+
+
+# Code width pandas picks for a category count, so categoricals map without a copy
+def _code_dtype(categories):
+    return pd.Categorical.from_codes([], categories=categories).codes.dtype
+
+
+# Calendar month of each timestamp as datetime64[M]; str() gives "YYYY-MM"
+def _months(timestamps):
+    return timestamps.astype("datetime64[M]")
+
+
+# Sort each spilled month by (site_id, timestamp) and write it as its own
+# segment directory under path, named after prefix and the month. Of rows
+# repeating a (site_id, timestamp), the first spilled is kept, and rows
+# already held by a segment of stored (a dataset of the same store) are
+# dropped, so one upload and the same rows appended in parts build the same
+# store. Only one month's sort keys are held in memory at a time; each column
+# is gathered through memory maps. Rows of site code i end up in
+# [offsets[i], offsets[i + 1]). Returns the segment names, oldest month
+# first, and the number of rows dropped as duplicates.
+def _write_partitions(path, prefix, spill_dir, names, categories, stored=None):
+    segment_names = []
+    duplicates = 0
+    for month, rows in _spilled_months(spill_dir):
+        month_dir = os.path.join(spill_dir, month)
+        codes = np.array(_spilled(month_dir, 'site_id', rows))
+        timestamps = np.array(_spilled(month_dir, 'timestamp', rows))
+        # Stable, so repeated rows keep their spill order
+        order = np.lexsort((timestamps, codes))
+        codes, timestamps = codes[order], timestamps[order]
+        keep = np.ones(rows, dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (timestamps[1:] != timestamps[:-1])
+        if stored is not None:
+            # Search only the affected sites of the stored segments of this month
+            existing = [segment for segment in stored.segments if segment.month == month]
+            bounds = np.searchsorted(codes, np.arange(codes.max() + 2)) if rows else []
+            for code in np.unique(codes):
+                lo, hi = bounds[code], bounds[code + 1]
+                for segment in existing:
+                    seg_lo, seg_hi = segment.bounds(code)
+                    if seg_lo == seg_hi:
+                        continue
+                    site_times = segment.timestamps[seg_lo:seg_hi]
+                    found = np.searchsorted(site_times, timestamps[lo:hi]).clip(0, len(site_times) - 1)
+                    keep[lo:hi] &= site_times[found] != timestamps[lo:hi]
+        duplicates += int(rows - keep.sum())
+        if not keep.any():
+            continue
+        order, codes = order[keep], codes[keep]
+        del timestamps
+
+        segment_name = SEGMENT_DIR.format(name=f"{prefix}-{month}")
+        segment_path = os.path.join(path, segment_name)
+        os.makedirs(segment_path, exist_ok=True)
+        offsets = np.searchsorted(codes, np.arange(len(categories['site_id']) + 1), side="left")
+        for name in names:
+            dtype = _code_dtype(categories[name]) if name in categories else SPILL_DTYPES[name]
+            values = _spilled(month_dir, name, rows)
+            out = np.lib.format.open_memmap(os.path.join(segment_path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(len(order),))
+            for first in range(0, len(order), CHUNK_ROWS):
+                out[first:first + CHUNK_ROWS] = values[order[first:first + CHUNK_ROWS]]
+            out.flush()
+            del out, values
+        np.save(os.path.join(segment_path, OFFSETS_FILE), offsets.astype(np.int64))
+        segment_names.append(segment_name)
+    return segment_names, duplicates
+
+
+# Save a set of columns and their offset table as .npy files in a directory
+def _save_columns(path, columns, offsets=None):
+    os.makedirs(path, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+    if offsets is not None:
+        np.save(os.path.join(path, OFFSETS_FILE), offsets)
+
+
+# Build the rollups and per-site totals of a sorted segment. Returns the
+# segment's entry for the store metadata.
+def _write_aggregates(path, name, names, n_sites):
+    columns = {col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode="r") for col in names}
+    offsets = np.load(os.path.join(path, OFFSETS_FILE))
+    for freq in rollups.ROLLUP_FREQUENCIES:
+        rollup, rollup_offsets = rollups.build_rollup(columns, n_sites, freq)
+        _save_columns(os.path.join(path, ROLLUP_DIR.format(freq=freq)), rollup, rollup_offsets)
+
+    frame = pd.DataFrame(columns, copy=False)
+    codes = columns['site_id'].astype(np.intp)
+    totals = kpi_metrics.site_totals(codes, frame, np.ones(len(codes), dtype=bool), n_sites)
+    _save_columns(os.path.join(path, TOTALS_DIR), totals)
+
+    # Rows are time-ordered within each site, so the extremes sit at the offsets
+    timestamps = columns['timestamp']
+    present = offsets[:-1] < offsets[1:]
+    return {
+        "name": name,
+        "month": str(_months(timestamps[:1])[0]) if len(timestamps) else None,
+        "rows": int(len(codes)),
+        "min_time": str(timestamps[offsets[:-1][present]].min()) if present.any() else None,
+        "max_time": str(timestamps[offsets[1:][present] - 1].max()) if present.any() else None,
+    }
+
+
+# Read and atomically replace a store's metadata
+def _read_meta(path):
+    with open(os.path.join(path, META_FILE), "r") as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp_file = os.path.join(path, f".{META_FILE}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(path, META_FILE))
+
+
+# Check whether a complete store exists at path
+def is_store(path):
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return False
+    return _read_meta(path).get("version") == STORE_VERSION
+
+
+_append_lock = threading.Lock()
+
+
+# Serialize appends and compactions of one store across threads and processes
+@contextlib.contextmanager
+def _store_lock(path):
+    with _append_lock:
+        with open(os.path.join(path, LOCK_FILE), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Stream an uploaded CSV into a columnar store under its content hash and
+# return the store path. progress, if given, is called with the fraction of
+# the file read so far. The store is built in a temporary directory and moved
+# into place in one rename.
+def ingest_file(source, key=None, progress=None):
+    key = key or hash_upload(source)
+    path = os.path.join(STORE_DIR, key)
+    if is_store(path):
+        return path
+    if os.path.isdir(path) and _read_meta(path).get("deltas"):
+        # Appended rows exist only in the store; rebuilding from the upload would drop them
+        raise ValueError(f"Store {path} was written by another version of the dashboard and holds appended rows; it cannot be rebuilt from the upload.")
+
+    os.makedirs(STORE_DIR, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".ingest-", dir=STORE_DIR)
+    try:
+        spill_dir = os.path.join(tmp_path, "spill")
+        os.makedirs(spill_dir)
+        categories = {}
+        names, rows, bad_rows, bad_row_count = _spill_chunks(source, spill_dir, categories, progress)
+        if rows == 0:
+            raise ValueError("No valid rows found in the uploaded file.")
+        segment_names, duplicates = _write_partitions(tmp_path, key, spill_dir, names, categories)
+        shutil.rmtree(spill_dir)
+        segments = [
+            _write_aggregates(os.path.join(tmp_path, segment_name), segment_name, names, len(categories['site_id']))
+            for segment_name in segment_names
+        ]
+
+        _write_meta(tmp_path, {
+            "version": STORE_VERSION,
+            "key": key,
+            "data_version": key,
+            "columns": names,
+            "categories": categories,
+            "segments": segments,
+            "deltas": [],
+            "bad_rows": bad_rows,
+            "bad_row_count": bad_row_count,
+            "duplicate_count": duplicates,
+        })
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)  # Another version without appends, rebuilt from the upload
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another session finished ingesting the same file first
+            if not is_store(path):
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+# Append a delta CSV of new KPI intervals to an existing store. Only rows whose
+# (site_id, timestamp) is not stored yet are kept; they become a new segment
+# per month with its own rollups and per-site totals, so the cost scales with
+# the delta. Returns a report dict with the rows appended and rejected.
+def append_file(path, source, progress=None):
+    delta_key = hash_upload(source)
+    with _store_lock(path):
+        meta = _read_meta(path)
+        if delta_key in meta["deltas"]:
+            return {"appended": 0, "duplicates": 0, "bad_rows": [], "bad_row_count": 0, "already_ingested": True}
+
+        tmp_path = tempfile.mkdtemp(prefix=".append-", dir=path)
+        try:
+            categories = {col: list(values) for col, values in meta["categories"].items()}
+            names, _, bad_rows, bad_row_count = _spill_chunks(source, tmp_path, categories, progress)
+            if set(names) != set(meta["columns"]):
+                raise ValueError(f"Delta columns {names} do not match the stored columns {meta['columns']}.")
+
+            # Rows repeated within the delta or already stored are dropped; a
+            # delta whose rows were all rejected only adds to the bad row report
+            data_version = hashlib.blake2b(f"{meta['data_version']}:{delta_key}".encode(), digest_size=16).hexdigest()
+            segment_names, duplicates = _write_partitions(path, data_version, tmp_path, names, categories, stored=KpiDataset(path))
+            new_segments = [
+                _write_aggregates(os.path.join(path, segment_name), segment_name, names, len(categories['site_id']))
+                for segment_name in segment_names
+            ]
+
+            meta["deltas"].append(delta_key)
+            meta["categories"] = categories
+            meta["bad_row_count"] += bad_row_count
+            meta["bad_rows"] = (meta["bad_rows"] + bad_rows)[:MAX_REPORTED_BAD_ROWS]
+            if new_segments:
+                meta["segments"] += new_segments
+                meta["data_version"] = data_version
+            _write_meta(path, meta)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # Alert evaluation carries each site's state from one segment of a
+        # month to the next. A backfill that lands before rows already stored
+        # for a site breaks that order, so its month is merged right away.
+        if len(meta["segments"]) - len({info["month"] for info in meta["segments"]}) > MAX_SEGMENTS:
+            _compact(path, meta)
+        elif new_segments:
+            dataset = KpiDataset(path)
+            appended = {info["month"] for info in new_segments}
+            unordered = {
+                month for month in appended
+                if not _in_time_order([segment for segment in dataset.segments if segment.month == month], len(dataset.sites))
+            }
+            if unordered:
+                _compact(path, meta, unordered)
+    return {"appended": sum(info["rows"] for info in new_segments), "duplicates": duplicates, "bad_rows": bad_rows, "bad_row_count": bad_row_count, "already_ingested": False}
+
+
+# Whether every site's rows run forward in time through segments, taken in
+# the given order: each site's first row in a segment comes after its last
+# row in the segments before it
+def _in_time_order(segments, n_sites):
+    last = np.full(n_sites, np.datetime64("NaT"), dtype="datetime64[ns]")
+    for segment in segments:
+        offsets = np.asarray(segment.offsets)
+        present = np.flatnonzero(offsets[:-1] < offsets[1:])
+        first = segment.timestamps[offsets[present]]
+        seen = ~np.isnat(last[present])
+        if (first[seen] <= last[present][seen]).any():
+            return False
+        last[present] = segment.timestamps[offsets[present + 1] - 1]
+    return True
+
+
+# Merge the segments of each month that has several into one. Cost is
+# proportional to those months, so it only runs once MAX_SEGMENTS deltas have
+# piled up, or for a month a backfill left out of time order.
+def compact(path):
+    with _store_lock(path):
+        meta = _read_meta(path)
+        if len(meta["segments"]) > len({info["month"] for info in meta["segments"]}):
+            _compact(path, meta)
+
+
+# months limits the merge to those months ("YYYY-MM"); None merges all
+def _compact(path, meta, months=None):
+    dataset = KpiDataset(path)
+    by_month = {}
+    for segment in dataset.segments:
+        if months is None or segment.month in months:
+            by_month.setdefault(segment.month, []).append(segment)
+    merged = [segments for segments in by_month.values() if len(segments) > 1]
+
+    new_segments = []
+    for segments in merged:
+        tmp_path = tempfile.mkdtemp(prefix=".compact-", dir=path)
+        try:
+            for segment in segments:
+                for first in range(0, segment.rows, CHUNK_ROWS):
+                    frame = segment.df.iloc[first:first + CHUNK_ROWS]
+                    _spill(tmp_path, {
+                        name: frame[name].cat.codes.to_numpy() if name in meta["categories"] else frame[name].to_numpy()
+                        for name in meta["columns"]
+                    })
+
+            segment_names, _ = _write_partitions(path, f"{meta['data_version']}-compact", tmp_path, meta["columns"], meta["categories"])
+            new_segments += [
+                _write_aggregates(os.path.join(path, segment_name), segment_name, meta["columns"], len(dataset.sites))
+                for segment_name in segment_names
+            ]
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    # Datasets opened before keep reading the old segments through the files
+    # they mapped when they were opened (Segment maps every file up front);
+    # the new data version makes sessions reload on their next rerun. One
+    # still opening finds a segment gone and opens the new version instead.
+    old_names = {segment.name for segments in merged for segment in segments}
+    meta["segments"] = [info for info in meta["segments"] if info["name"] not in old_names] + new_segments
+    meta["data_version"] = hashlib.blake2b(f"{meta['data_version']}:compact".encode(), digest_size=16).hexdigest()
+    _write_meta(path, meta)
+    for name in old_names:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+# Memory-map the columns saved in a directory as a read-only DataFrame
+def _load_columns(path, names, categories):
+    data = {}
+    for name in names:
+        values = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        if name in categories:
+            values = pd.Categorical.from_codes(values, categories=categories[name], validate=False)
+        data[name] = values
+    return pd.DataFrame(data, copy=False)
+
+
+# One sorted, immutable run of rows with its own site index, rollups and totals
+class Segment:
+    def __init__(self, path, info, columns, categories):
+        self.path = path
+        self.name = info["name"]
+        self.month = info["month"]
+        self.rows = info["rows"]
+        # Time bounds from the store metadata, used to skip segments without reading them
+        self.min_time = pd.Timestamp(info["min_time"])
+        self.max_time = pd.Timestamp(info["max_time"])
+        self.categories = categories
+        self.df = _load_columns(path, columns, categories)
+        self.codes = self.df['site_id'].cat.codes.to_numpy()
+        self.timestamps = self.df['timestamp'].to_numpy()
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self.span = (0, self.rows)  # Row range of the segment files this object covers
+        self.site_range = None
+        # Rollups and totals are mapped now rather than on first use: a
+        # compaction removes superseded segment directories, and only files
+        # already mapped stay readable for datasets that still hold them
+        self._rollups = {freq: self._map_rollup(freq) for freq in rollups.ROLLUP_FREQUENCIES}
+        totals_path = os.path.join(path, TOTALS_DIR)
+        self._totals = {name: np.load(os.path.join(totals_path, f"{name}.npy"), mmap_mode="r") for name in kpi_metrics.TOTAL_COLUMNS}
+
+    # Row range [lo, hi) of a site code; sites added later are empty here
+    def bounds(self, code, offsets=None):
+        offsets = self.offsets if offsets is None else offsets
+        if code is None or code + 1 >= len(offsets):
+            return 0, 0
+        return int(offsets[code]), int(offsets[code + 1])
+
+    # Rows of one site code with start <= timestamp <= end, as a zero-copy slice
+    def select(self, code, start, end, frame=None, timestamps=None, offsets=None):
+        frame = self.df if frame is None else frame
+        timestamps = self.timestamps if timestamps is None else timestamps
+        lo, hi = self.bounds(code, offsets)
+        site_times = timestamps[lo:hi]
+        first = lo + np.searchsorted(site_times, np.datetime64(start, "ns"), side="left")
+        last = lo + np.searchsorted(site_times, np.datetime64(end, "ns"), side="right")
+        return frame.iloc[first:last]
+
+    def _map_rollup(self, freq):
+        path = os.path.join(self.path, ROLLUP_DIR.format(freq=freq))
+        names = ['site_id', 'timestamp', 'rows', 'uptime', 'uptime_count', 'uptime_min', 'uptime_max', 'energy_consumption', 'alarm_count']
+        frame = _load_columns(path, names, {'site_id': self.categories['site_id']})
+        return frame, np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+
+    # Day/week/month rollup table and its per-site offsets
+    def rollup(self, freq):
+        return self._rollups[freq]
+
+    # Per-site totals over the whole segment (see kpi_metrics.site_totals)
+    def totals(self):
+        totals = dict(self._totals)
+        if self.site_range is not None:
+            first, last = self.site_range
+            for name, values in totals.items():
+                partial = np.zeros_like(values)
+                partial[first:last] = values[first:last]
+                totals[name] = partial
+        return totals
+
+    # Zero-copy view of the rows of site codes [first, last). Site codes stay
+    # global; sites outside the range are empty in the view.
+    def partition(self, first, last):
+        n_sites = len(self.offsets) - 1
+        lo, hi = int(self.offsets[min(first, n_sites)]), int(self.offsets[min(last, n_sites)])
+        part = copy.copy(self)
+        part.df = self.df.iloc[lo:hi]
+        part.codes = self.codes[lo:hi]
+        part.timestamps = self.timestamps[lo:hi]
+        part.offsets = np.clip(np.asarray(self.offsets) - lo, 0, hi - lo)
+        part.rows = hi - lo
+        part.span = (self.span[0] + lo, self.span[0] + hi)
+        part.site_range = (first, last)
+        return part
+
+
+# Memory-mapped, read-only view of a store: its segments plus the site/time
+# index used by the sidebar filter
+class KpiDataset:
+    def __init__(self, path):
+        meta = _read_meta(path)
+        while True:
+            try:
+                self._open(path, meta)
+                return
+            except FileNotFoundError:
+                # A compaction removed segments listed in the metadata read
+                # before it; open the version it wrote instead
+                fresh = _read_meta(path)
+                if fresh["data_version"] == meta["data_version"]:
+                    raise
+                meta = fresh
+
+    def _open(self, path, meta):
+        self.path = path
+        self.store_key = meta["key"]
+        self.key = meta["data_version"]  # Changes with every append
+        self.categories = meta["categories"]
+        self.bad_rows = meta.get("bad_rows", [])
+        self.bad_row_count = meta.get("bad_row_count", 0)
+        self.duplicate_count = meta.get("duplicate_count", 0)
+
+        self.sites = pd.Index(self.categories['site_id'])
+        # Oldest first; month partitions do not overlap, deltas of one month may
+        infos = sorted(meta["segments"], key=lambda info: (info["min_time"], info["max_time"]))
+        self.segments = [
+            Segment(os.path.join(path, info["name"]), info, meta["columns"], self.categories)
+            for info in infos
+        ]
+        self.rows = sum(segment.rows for segment in self.segments)
+        self.min_time = min(segment.min_time for segment in self.segments)
+        self.max_time = max(segment.max_time for segment in self.segments)
+        self._memory_usage = None
+        self._nbytes = None
+
+    # Bytes mapped by the segments, used for cache budgeting. Computed once;
+    # the dataset never changes.
+    @property
+    def nbytes(self):
+        if self._nbytes is None:
+            self._nbytes = int(sum(segment.df.memory_usage(deep=True).sum() + segment.offsets.nbytes for segment in self.segments))
+        return self._nbytes
+
+    # Bytes per column as stored, next to what the same rows take in a frame
+    # read with pd.read_csv defaults (object strings, float64/int64). Computed
+    # once; the dataset never changes.
+    def memory_usage(self):
+        if self._memory_usage is not None:
+            return self._memory_usage
+        usage = {}
+        for segment in self.segments:
+            for name in segment.df.columns:
+                values = segment.df[name]
+                if name in self.categories:
+                    codes = values.cat.codes.to_numpy()
+                    sizes = np.array([sys.getsizeof(value) for value in values.cat.categories] + [sys.getsizeof(np.nan)])
+                    counts = np.bincount(np.where(codes >= 0, codes, len(sizes) - 1), minlength=len(sizes))
+                    dtype, stored, as_objects = f"{codes.dtype} codes", codes.nbytes, 8 * len(codes) + int(counts @ sizes)
+                else:
+                    dtype, stored, as_objects = str(values.dtype), values.to_numpy().nbytes, 8 * len(values)
+                entry = usage.setdefault(name, {'dtype': dtype, 'bytes': 0, 'object_bytes': 0})
+                entry['bytes'] += stored
+                entry['object_bytes'] += as_objects
+        self._memory_usage = pd.DataFrame.from_dict(usage, orient="index")
+        return self._memory_usage
+
+    # Whether another process or session appended to the store since loading
+    def is_stale(self):
+        try:
+            return _read_meta(self.path)["data_version"] != self.key
+        except (OSError, ValueError, KeyError):
+            return False
+
+    # Read-only view of the sites with codes [first, last), used to split
+    # fleet-wide work across processes. Time bounds stay those of the dataset.
+    def partition(self, first, last):
+        part = copy.copy(self)
+        part.segments = [segment.partition(first, last) for segment in self.segments]
+        part.rows = sum(segment.rows for segment in part.segments)
+        part._memory_usage = None
+        part._nbytes = None
+        return part
+
+    def site_code(self, site):
+        return self.sites.get_loc(site) if site in self.sites else None
+
+    # Segments with rows in [start, end], from their metadata alone; None
+    # leaves that side open
+    def segments_between(self, start=None, end=None):
+        return [
+            segment for segment in self.segments
+            if (start is None or segment.max_time >= start) and (end is None or segment.min_time <= end)
+        ]
+
+    # Rows of one site with start <= timestamp <= end. A zero-copy slice when
+    # the range falls within one segment.
+    def select(self, site, start, end):
+        code = self.site_code(site)
+        frames = [segment.select(code, start, end) for segment in self.segments_between(start, end)] or [self.segments[0].df.iloc[:0]]
+        instrumentation.count("rows_scanned", sum(len(frame) for frame in frames))
+        if len(frames) == 1:
+            return frames[0]
+        frames = [frame for frame in frames if len(frame)] or frames[:1]
+        if len(frames) == 1:
+            return frames[0]
+        # Column-wise, reusing the categorical dtypes; pd.concat re-checks them per frame
+        frame = pd.DataFrame({
+            name: pd.Categorical.from_codes(np.concatenate([f[name].cat.codes.to_numpy() for f in frames]), dtype=frames[0][name].dtype)
+            if name in self.categories else np.concatenate([f[name].to_numpy() for f in frames])
+            for name in frames[0].columns
+        }, copy=False)
+        if not frame['timestamp'].is_monotonic_increasing:
+            frame = frame.sort_values('timestamp', ignore_index=True)
+        return frame
+
+    # Rollup rows of one site whose bucket overlaps [start, end]
+    def select_rollup(self, freq, site, start, end):
+        code = self.site_code(site)
+        start = rollups.bucket_starts(np.array([np.datetime64(start, "ns")]), freq)[0]
+        frames = []
+        for segment in self.segments_between(pd.Timestamp(start), end) or self.segments[:1]:
+            frame, offsets = segment.rollup(freq)
+            frames.append(segment.select(code, start, end, frame, frame['timestamp'].to_numpy(), offsets))
+        return rollups.combine_rollups(frames)
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+import kpi_metrics
+
+# Rollup resolutions, finest first, and the label shown in chart titles
+ROLLUP_FREQUENCIES = {"day": "daily", "week": "weekly", "month": "monthly"}
+
+# Upper bound on points sent to the browser per chart trace
+MAX_CHART_POINTS = 2000
+
+
+# Start of the day/week/month bucket of each timestamp
+def bucket_starts(timestamps, freq):
+    days = timestamps.astype("datetime64[D]")
+    if freq == "day":
+        buckets = days
+    elif freq == "week":
+        # 1970-01-01 was a Thursday; shift so buckets start on Monday
+        buckets = days - ((days.view(np.int64) + 3) % 7).astype("timedelta64[D]")
+    elif freq == "month":
+        buckets = timestamps.astype("datetime64[M]")
+    else:
+        raise ValueError(f"Unknown rollup frequency: {freq}")
+    return buckets.astype("datetime64[ns]")
+
+
+# Aggregate columns sorted by (site_id, timestamp) into one row per
+# (site, bucket): mean/min/max uptime and summed energy and alarms.
+# Returns the rollup columns and their per-site offset table.
+def build_rollup(columns, n_sites, freq):
+    codes = columns['site_id']
+    buckets = bucket_starts(columns['timestamp'], freq)
+
+    if len(codes) == 0:
+        starts = np.zeros(0, dtype=np.intp)
+    else:
+        changed = (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1])
+        starts = np.flatnonzero(np.concatenate(([True], changed)))
+
+    uptime = columns['uptime'].astype(np.float64)
+    valid = ~np.isnan(uptime)
+    rollup = {
+        'site_id': codes[starts],
+        'timestamp': buckets[starts],
+        'rows': np.diff(np.append(starts, len(codes))).astype(np.int32),
+    }
+    if len(starts):
+        uptime_count = np.add.reduceat(valid.astype(np.int64), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rollup['uptime'] = (np.add.reduceat(np.where(valid, uptime, 0.0), starts) / uptime_count).astype(np.float32)
+        rollup['uptime_count'] = uptime_count.astype(np.int32)
+        rollup['uptime_min'] = np.fmin.reduceat(columns['uptime'], starts)
+        rollup['uptime_max'] = np.fmax.reduceat(columns['uptime'], starts)
+        rollup['energy_consumption'] = np.add.reduceat(np.nan_to_num(columns['energy_consumption'].astype(np.float64)), starts).astype(np.float32)
+        alarms = columns['alarm_count'].astype(np.int64)
+        rollup['alarm_count'] = np.add.reduceat(np.where(alarms != kpi_metrics.MISSING_COUNT, alarms, 0), starts)
+    else:
+        for name, dtype in [('uptime', np.float32), ('uptime_count', np.int32), ('uptime_min', np.float32), ('uptime_max', np.float32), ('energy_consumption', np.float32), ('alarm_count', np.int64)]:
+            rollup[name] = np.zeros(0, dtype=dtype)
+
+    offsets = np.searchsorted(rollup['site_id'], np.arange(n_sites + 1), side="left").astype(np.int64)
+    return rollup, offsets
+
+
+# Merge rollup rows of one site taken from several store segments, combining
+# rows that fall in the same bucket
+def combine_rollups(frames):
+    non_empty = [frame for frame in frames if len(frame)]
+    if len(non_empty) <= 1:
+        return non_empty[0] if non_empty else frames[0]
+    frame = pd.concat(non_empty, ignore_index=True)
+    frame['uptime_total'] = frame['uptime'].astype(np.float64).fillna(0) * frame['uptime_count']
+    combined = frame.groupby('timestamp', sort=True).agg(
+        site_id=('site_id', 'first'),
+        rows=('rows', 'sum'),
+        uptime_total=('uptime_total', 'sum'),
+        uptime_count=('uptime_count', 'sum'),
+        uptime_min=('uptime_min', 'min'),
+        uptime_max=('uptime_max', 'max'),
+        energy_consumption=('energy_consumption', 'sum'),
+        alarm_count=('alarm_count', 'sum'),
+    ).reset_index()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        combined['uptime'] = (combined['uptime_total'] / combined['uptime_count']).astype(np.float32)
+    return combined.drop(columns='uptime_total')[frames[0].columns]
+
+
+# Indices of n_out points chosen by Largest-Triangle-Three-Buckets
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket is the third triangle vertex
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[previous] - avg_x) * (y[lo:hi] - y[previous]) - (x[previous] - x[lo:hi]) * (avg_y - y[previous]))
+        previous = lo + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+
+# Frame to plot for one site and date range with its resolution label.
+# "auto" keeps raw rows when they fit in max_points, otherwise uses the finest
+# rollup that does; "raw" downsamples with LTTB when there are too many rows.
+def chart_frame(dataset, site, start, end, resolution="auto", max_points=MAX_CHART_POINTS):
+    raw = dataset.select(site, start, end)
+    if resolution == "raw" or (resolution == "auto" and len(raw) <= max_points):
+        if len(raw) <= max_points:
+            return raw, "raw"
+        x = raw['timestamp'].to_numpy().view(np.int64)
+        keep = lttb_indices(x, raw['uptime'].to_numpy(), max_points)
+        return raw.iloc[keep], "downsampled"
+
+    for freq in ROLLUP_FREQUENCIES if resolution == "auto" else [resolution]:
+        frame = dataset.select_rollup(freq, site, start, end)
+        if resolution != "auto" or len(frame) <= max_points:
+            return frame, ROLLUP_FREQUENCIES[freq]
+    return frame, ROLLUP_FREQUENCIES[freq]
@@ -0,0 +1,168 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import alerts
+import anomalies
+import forecast
+import kpi_metrics
+
+# Results for a dataset version's default view (its first to last day), kept
+# in the store directory so a fresh server or session shows the fleet
+# overview and metric cards without scanning rows. One directory per data
+# version; each part in it is written to a temporary directory and renamed
+# into place, so readers see a whole part or none.
+SNAPSHOT_DIR = "snapshot-{version}"
+SNAPSHOT_VERSION = 2
+PART_META = "part.json"
+
+
+# Date range the dashboard selects by default, which the snapshot covers
+def default_range(dataset):
+    return pd.Timestamp(dataset.min_time.date()), pd.Timestamp(dataset.max_time.date())
+
+
+def _part_path(dataset, name, version=None):
+    return os.path.join(dataset.path, SNAPSHOT_DIR.format(version=version or dataset.key), name)
+
+
+# Columns of a saved part (of the current data version unless another is
+# given), or None when it is missing or from another snapshot format. columns
+# limits which are loaded.
+def _read_part(dataset, name, version=None, columns=None):
+    path = _part_path(dataset, name, version)
+    try:
+        with open(os.path.join(path, PART_META), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != SNAPSHOT_VERSION:
+            return None
+        return {column: np.load(os.path.join(path, f"{column}.npy")) for column in meta["columns"] if columns is None or column in columns}
+    except (OSError, ValueError):
+        return None  # Missing, or removed by a newer version while being read
+
+
+# Save a part of the current data version and drop snapshots of older
+# versions. The latest older anomaly table stays until this version has its
+# own, which continues it. Results of a version that has since been appended
+# to are not saved.
+def _write_part(dataset, name, columns):
+    if dataset.is_stale():
+        return
+    snapshot_path = os.path.dirname(_part_path(dataset, name))
+    os.makedirs(snapshot_path, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f".{name}-", dir=snapshot_path)
+    try:
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_path, f"{column}.npy"), values)
+        with open(os.path.join(tmp_path, PART_META), "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "columns": list(columns)}, f)
+        try:
+            os.rename(tmp_path, _part_path(dataset, name))
+        except OSError:
+            pass  # Another session saved the same part first
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    current = os.path.basename(snapshot_path)
+    older = [entry for entry in os.listdir(dataset.path) if entry.startswith(SNAPSHOT_DIR.format(version="")) and entry != current]
+    kept = None
+    if not os.path.isdir(_part_path(dataset, "anomalies")):
+        saved = [entry for entry in older if os.path.isdir(os.path.join(dataset.path, entry, "anomalies"))]
+        kept = max(saved, key=lambda entry: os.path.getmtime(os.path.join(dataset.path, entry, "anomalies")), default=None)
+    for entry in older:
+        if entry != kept:
+            shutil.rmtree(os.path.join(dataset.path, entry), ignore_errors=True)
+            continue
+        for part in os.listdir(os.path.join(dataset.path, entry)):
+            if part != "anomalies":
+                shutil.rmtree(os.path.join(dataset.path, entry, part), ignore_errors=True)
+
+
+# A per-site frame as columns, its site_id index stored as site codes
+def _frame_columns(dataset, frame):
+    columns = {'site_code': dataset.sites.get_indexer(frame.index).astype(np.int32)}
+    columns.update({name: frame[name].to_numpy() for name in frame.columns})
+    return columns
+
+
+def _columns_frame(dataset, columns):
+    index = pd.Index(dataset.sites[columns.pop('site_code')], name='site_id')
+    return pd.DataFrame(columns, index=index)
+
+
+# Anomalies of every site; they do not depend on the date range. A new data
+# version continues the table saved for an older one, so after an append
+# only the appended rows are evaluated.
+def anomaly_table(dataset):
+    columns = _read_part(dataset, "anomalies", columns=anomalies.TABLE_COLUMNS)
+    if columns is not None:
+        return anomalies.AnomalyTable(dataset, columns)
+    table = anomalies.AnomalyTable(dataset, resume=_older_anomalies(dataset))
+    _write_part(dataset, "anomalies", table.saved())
+    return table
+
+
+# Saved anomaly tables of older data versions, with their carried state
+def _older_anomalies(dataset):
+    prefix = SNAPSHOT_DIR.format(version="")
+    for entry in os.listdir(dataset.path):
+        if entry.startswith(prefix) and entry != SNAPSHOT_DIR.format(version=dataset.key):
+            state = _read_part(dataset, "anomalies", entry[len(prefix):])
+            if state is not None:
+                yield state
+
+
+# Trend fits over the default range
+def forecast_engine(dataset):
+    fits = {}
+    for target in forecast.FORECAST_TARGETS:
+        columns = _read_part(dataset, f"forecast-{target}")
+        if columns is None:
+            break
+        fits[target] = _columns_frame(dataset, columns)
+    else:
+        return forecast.ForecastEngine(dataset, *default_range(dataset), fits=fits)
+
+    engine = forecast.ForecastEngine(dataset, *default_range(dataset))
+    for target, fits in engine.fits.items():
+        _write_part(dataset, f"forecast-{target}", _frame_columns(dataset, fits))
+    return engine
+
+
+# fleet_summary() over the default range with the alert counts of a rule set.
+# alert_table is called for the AlertTable only when the part is not saved yet.
+def fleet_summary(dataset, rules, alert_table):
+    name = f"summary-{rules.key}"
+    columns = _read_part(dataset, name)
+    if columns is not None:
+        return _columns_frame(dataset, columns)
+    summary = kpi_metrics.fleet_summary(dataset, *default_range(dataset), alert_table())
+    _write_part(dataset, name, _frame_columns(dataset, summary))
+    return summary
+
+
+# site_locations() over the default range, saved as location codes
+def site_locations(dataset):
+    columns = _read_part(dataset, "locations")
+    if columns is not None:
+        codes = columns['location']
+        values = np.asarray(dataset.categories.get('location', []) + [pd.NA], dtype=object)[codes]
+        return pd.Series(values, index=pd.Index(dataset.sites, name='site_id'), dtype=object)
+    locations = kpi_metrics.site_locations(dataset, *default_range(dataset))
+    categories = pd.Index(dataset.categories.get('location', []))
+    codes = categories.get_indexer(locations.fillna("").to_numpy())
+    _write_part(dataset, "locations", {'location': np.where(codes >= 0, codes, len(categories)).astype(np.int32)})
+    return locations
+
+
+# Compute and save every part of a dataset version's snapshot, so the first
+# session after an append does not have to
+def build(dataset, rules):
+    anomaly_table(dataset)
+    forecast_engine(dataset)
+    site_locations(dataset)
+    fleet_summary(dataset, rules, lambda: alerts.AlertTable(dataset, rules))
@@ -1,40 +1,30 @@
-import pandas as pd
 import streamlit as st
+import streamlit.components.v1 as components
 
-import plotly.express as px
-from sklearn.linear_model import LinearRegression
-import numpy as np
+import functools
 import os
-import json
 import re  # For password strength check
 
-# File to store user data
-USER_FILE = "users.json"
-REMEMBER_FILE = "remember.json"
+from user_store import REMEMBER_DAYS, USER_STORE
+import instrumentation
 
-# Load existing users or initialize an empty dictionary
-if os.path.exists(USER_FILE):
-    with open(USER_FILE, "r") as f:
-        users = json.load(f)
-else:
-    users = {}
+# pandas, Plotly and the analytics modules are imported where they are first
+# needed, so the login page of a freshly started server renders without them
 
-# Load remembered user
-if os.path.exists(REMEMBER_FILE):
-    with open(REMEMBER_FILE, "r") as f:
-        remembered = json.load(f)
-else:
-    remembered = {}
+# Browser cookie holding this browser's remember-me token
+REMEMBER_COOKIE = "kpi_remember"
 
-# Save users to file
-def save_users():
-    with open(USER_FILE, "w") as f:
-        json.dump(users, f)
+# Site view results memoized across reruns and sessions
+VIEW_CACHE_ENTRIES = int(os.environ.get("KPI_VIEW_CACHE_ENTRIES", "512"))
 
-# Save remember me choice
-def save_remember():
-    with open(REMEMBER_FILE, "w") as f:
-        json.dump(remembered, f)
+# Columns of a site's anomaly table
+ANOMALY_COLUMN_CONFIG = {
+    "timestamp": st.column_config.DatetimeColumn("Time"),
+    "kpi": "KPI",
+    "detector": "Detector",
+    "value": st.column_config.NumberColumn("Value", format="%.2f"),
+    "score": st.column_config.NumberColumn("Score", format="%.1f"),
+}
 
 # Function to check password strength
 def check_password_strength(password):
@@ -44,17 +34,124 @@ def check_password_strength(password):
         return "Password must contain at least one special character."
     return None
 
+# Import the plaintext user files of earlier versions, once per server process
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_users():
+    USER_STORE.migrate_legacy()
+
+migrate_legacy_users()
+
 # Initialize session state for login/logout and data
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
     st.session_state.username = None
     st.session_state.role = None
     st.session_state.uploaded_file = None
-    st.session_state.df = pd.DataFrame()
-    st.session_state.filtered_df = pd.DataFrame()
+    st.session_state.dataset = None
     st.session_state.selected_site = None
     st.session_state.date_range = None
 
+# Initialize view state
+if "view_mode" not in st.session_state:
+    st.session_state.view_mode = "Single Site"
+if "compare_sites" not in st.session_state:
+    st.session_state.compare_sites = []
+
+# Time this rerun while the admin diagnostics panel is open or metrics are exported
+instrumentation.clear()
+if "rerun_recorder" not in st.session_state:
+    st.session_state.rerun_recorder = instrumentation.Recorder()
+if st.session_state.get("diagnostics") or instrumentation.EXPORT_FILE:
+    st.session_state.rerun_recorder.start(st.session_state.get("username") or "")
+
+# Switch from the fleet overview to one site's view
+def open_site(site):
+    st.session_state.selected_site = site
+    st.session_state.view_mode = "Single Site"
+
+# Select every site of a location for the comparison view, up to its limit
+def compare_location(locations, location):
+    st.session_state.compare_sites = locations.index[locations == location][:comparison.MAX_COMPARE_SITES].tolist()
+
+# Trend fits for every site, cached per dataset and date range. The default
+# range comes from the dataset version's snapshot.
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_forecast(_dataset, dataset_key, start, end):
+    if (start, end) == snapshots.default_range(_dataset):
+        return snapshots.forecast_engine(_dataset)
+    return forecast.ForecastEngine(_dataset, start, end)
+
+# Alert table for a dataset version and rule set, shared by all sessions
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_alerts(_dataset, dataset_key, _rules, rules_key):
+    return alerts.AlertTable(_dataset, _rules)
+
+# Anomalies of every site and KPI for a dataset version, shared by all sessions
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_anomalies(_dataset, dataset_key):
+    return snapshots.anomaly_table(_dataset)
+
+# Default-range fleet summary with alert counts, from the dataset version's
+# snapshot; the alert table is only evaluated when the snapshot lacks it
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_summary(_dataset, dataset_key, _rules, rules_key):
+    return snapshots.fleet_summary(_dataset, _rules, lambda: get_alerts(_dataset, dataset_key, _rules, rules_key))
+
+# Location of every site, from the dataset version's snapshot
+@st.cache_resource(max_entries=8, show_spinner=False)
+def get_locations(_dataset, dataset_key):
+    return snapshots.site_locations(_dataset)
+
+# Results of one site view (rows, metrics, alerts, prediction, figures), kept
+# per dataset version, site, date range and role. Reruns that keep the
+# selection reuse them; an append changes the dataset key, so stale entries
+# are never hit and age out of the LRU.
+@st.cache_resource(max_entries=VIEW_CACHE_ENTRIES, show_spinner=False)
+def memoized(view_key, name, _compute):
+    instrumentation.count("view_cache_misses")
+    return _compute()
+
+# Build a Plotly figure (once per view) and send it to the browser, counting its size while instrumented
+def show_chart(view_key, name, plot, *args, **kwargs):
+    with instrumentation.span("figure_build"):
+        fig = memoized(view_key, name, lambda: plot(*args, **kwargs))
+    if instrumentation.active():
+        instrumentation.count("figures")
+        instrumentation.count("figure_bytes", len(fig.to_json()))
+    with instrumentation.span("figure_send"):
+        st.plotly_chart(fig, use_container_width=True)
+
+# Chart of one KPI with the site's anomalies marked
+def kpi_chart(plot, chart_df, y, resolution, site_anomalies, **kwargs):
+    fig = plot(chart_df, x='timestamp', y=y, **kwargs)
+    markers = anomalies.chart_markers(site_anomalies, chart_df, y, resolution)
+    if not markers.empty:
+        fig.add_scatter(
+            x=markers['timestamp'], y=markers['value'], mode="markers", name="Anomaly",
+            marker=dict(color="red", size=9, symbol="x"), text=markers['detectors'],
+            hovertemplate="%{x}<br>%{y}<br>%{text}<extra>Anomaly</extra>",
+        )
+    return fig
+
+# A page section that re-executes on its own when one of its widgets changes.
+# Its inputs are its arguments, kept from the last full run; changing those
+# (dataset, site, dates) reruns the whole page, where unchanged results come
+# from memoized(). Section reruns are timed while diagnostics are on.
+def section(func):
+    @st.fragment
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        recorder = None
+        if not instrumentation.active() and (st.session_state.get("diagnostics") or instrumentation.EXPORT_FILE):
+            recorder = st.session_state.rerun_recorder
+            recorder.start(f"{st.session_state.get('username') or ''}:{func.__name__}")
+        try:
+            func(*args, **kwargs)
+        finally:
+            if recorder is not None:
+                recorder.finish()
+    return run
+
 # Initialize theme state
 if "theme" not in st.session_state:
     st.session_state.theme = "light"
@@ -62,129 +159,292 @@ if "theme" not in st.session_state:
 def toggle_theme():
     st.session_state.theme = "dark" if st.session_state.theme == "light" else "light"
 
-st.sidebar.button("Toggle Light/Dark Mode", on_click=toggle_theme)
-
-# Apply theme
-if st.session_state.theme == "dark":
-    st.markdown(
-        """
-        <style>
-        body {
-            color: white;
-            background-color: #1a1a1a;
-        }
-        .stApp {
-            background-color: #1a1a1a;
-        }
-        .stSidebar {
-            background-color: #262730;
-            color: white;
-        }
-        .stButton>button {
-            color: white;
-            background-color: #4a4a59;
-            border-color: #4a4a59;
-        }
-        .stTextInput>div>div>input {
-            color: white;
-            background-color: #333333;
-            border-color: #555555;
-        }
-        .stSelectbox>div>div>div>div {
-            color: white;
-            background-color: #333333;
-            border-color: #555555;
-        }
-        .stError {
-            color: #e87979;
-        }
-        .stSuccess {
-            color: #68d391;
-        }
-        .stWarning {
-            color: #f6e05e;
-        }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-else:
-    st.markdown(
-        """
-        <style>
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
-
-# Registration Form
-st.sidebar.header(" Register")
-new_username = st.sidebar.text_input("New Username", key="reg_username")
-new_password = st.sidebar.text_input("New Password", type="password", key="reg_password")
-new_role = st.sidebar.selectbox("Role", ["admin", "engineer", "manager"], key="reg_role")
-
-if st.sidebar.button("Register"):
-    password_strength_error = check_password_strength(new_password)
-    if password_strength_error:
-        st.sidebar.error(password_strength_error)
-    elif new_username and new_password:
-        if new_username in users:
-            st.sidebar.error("Username already exists!")
-        else:
-            users[new_username] = {"password": new_password, "role": new_role}
-            save_users()
-            st.sidebar.success("Registration successful! You can now log in.")
-
-# Login Form
-st.sidebar.header(" Login")
-username = st.sidebar.text_input("Username", key="login_username", value=remembered.get("username", ""))
-password = st.sidebar.text_input("Password", type="password", key="login_password", value=remembered.get("password", ""))
-remember_me = st.sidebar.checkbox("Remember me", value=bool(remembered))
-
-if st.sidebar.button("Login"):
-    if username and password:
-        if username in users and users[username]["password"] == password:
-            st.session_state.logged_in = True
-            st.session_state.username = username
-            st.session_state.role = users[username]["role"]
-            st.sidebar.success(f"Logged in as {st.session_state.role.upper()}")
-            if remember_me:
-                remembered["username"] = username
-                remembered["password"] = password
+# Theme toggle and its CSS; toggling re-executes only this section
+@section
+def theme_section():
+    st.button("Toggle Light/Dark Mode", on_click=toggle_theme)
+
+    # Apply theme
+    if st.session_state.theme == "dark":
+        st.markdown(
+            """
+            <style>
+            body {
+                color: white;
+                background-color: #1a1a1a;
+            }
+            .stApp {
+                background-color: #1a1a1a;
+            }
+            .stSidebar {
+                background-color: #262730;
+                color: white;
+            }
+            .stButton>button {
+                color: white;
+                background-color: #4a4a59;
+                border-color: #4a4a59;
+            }
+            .stTextInput>div>div>input {
+                color: white;
+                background-color: #333333;
+                border-color: #555555;
+            }
+            .stSelectbox>div>div>div>div {
+                color: white;
+                background-color: #333333;
+                border-color: #555555;
+            }
+            .stError {
+                color: #e87979;
+            }
+            .stSuccess {
+                color: #68d391;
+            }
+            .stWarning {
+                color: #f6e05e;
+            }
+            </style>
+            """,
+            unsafe_allow_html=True,
+        )
+    else:
+        st.markdown(
+            """
+            <style>
+            </style>
+            """,
+            unsafe_allow_html=True,
+        )
+
+with st.sidebar:
+    theme_section()
+
+# Registration Form: typing and registering re-execute only this section
+@section
+def register_section():
+    st.header(" Register")
+    new_username = st.text_input("New Username", key="reg_username")
+    new_password = st.text_input("New Password", type="password", key="reg_password")
+    new_role = st.selectbox("Role", ["admin", "engineer", "manager"], key="reg_role")
+
+    if st.button("Register"):
+        password_strength_error = check_password_strength(new_password)
+        if password_strength_error:
+            st.error(password_strength_error)
+        elif new_username and new_password:
+            with st.spinner("Registering..."):
+                created = USER_STORE.create_user(new_username, new_password, new_role)
+            if not created:
+                st.error("Username already exists!")
             else:
-                remembered.pop("username", None)
-                remembered.pop("password", None)
-            save_remember()
-            st.rerun() # Rerun to update the UI
+                st.success("Registration successful! You can now log in.")
+
+with st.sidebar:
+    register_section()
+
+# Login Form: a successful login reruns the whole page
+@section
+def login_section():
+    st.header(" Login")
+    username = st.text_input("Username", key="login_username")
+    password = st.text_input("Password", type="password", key="login_password")
+    remember_me = st.checkbox("Remember me")
+
+    if st.button("Login"):
+        if username and password:
+            # Verified in this session's script thread rather than off it:
+            # each session's script has a thread of its own and scrypt
+            # releases the GIL, so other sessions keep rendering meanwhile
+            with st.spinner("Logging in..."):
+                role = USER_STORE.authenticate(username, password)
+            if role is not None:
+                st.session_state.logged_in = True
+                st.session_state.username = username
+                st.session_state.role = role
+                st.success(f"Logged in as {st.session_state.role.upper()}")
+                if remember_me:
+                    st.session_state.remember_token = USER_STORE.remember(username)
+                    st.session_state.remember_cookie = st.session_state.remember_token
+                st.rerun() # Rerun to update the UI
+            else:
+                st.error("Invalid credentials")
         else:
-            st.sidebar.error("Invalid credentials")
-    else:
-        st.sidebar.warning("Please enter both username and password.")
+            st.warning("Please enter both username and password.")
+
+with st.sidebar:
+    login_section()
+
+# Set (or with an empty token, delete) this browser's remember-me cookie.
+# Streamlit can only read cookies, so a script in a zero-height frame writes it.
+def write_remember_cookie(token):
+    max_age = REMEMBER_DAYS * 86400 if token else 0
+    components.html(
+        f"<script>parent.document.cookie = '{REMEMBER_COOKIE}={token}; Max-Age={max_age}; Path=/; SameSite=Strict';</script>",
+        height=0,
+    )
 
-# Auto-login if "remember me" was checked and details are saved
-if not st.session_state.logged_in and remembered.get("username") and remembered.get("password"):
-    if remembered["username"] in users and users[remembered["username"]]["password"] == remembered["password"]:
+# Cookie change queued by the last login or logout
+if "remember_cookie" in st.session_state:
+    write_remember_cookie(st.session_state.pop("remember_cookie"))
+
+# Auto-login when this browser sent a remember-me token that is still valid
+if not st.session_state.logged_in:
+    remembered_login = USER_STORE.remembered_login(st.context.cookies.get(REMEMBER_COOKIE))
+    if remembered_login is not None:
         st.session_state.logged_in = True
-        st.session_state.username = remembered["username"]
-        st.session_state.role = users[remembered["username"]]["role"]
+        st.session_state.username, st.session_state.role = remembered_login
         st.sidebar.success(f"Logged in automatically as {st.session_state.role.upper()}")
         st.rerun() # Rerun to update the UI
 
 # Logout Button
 if st.session_state.logged_in:
     if st.sidebar.button("Logout"):
+        # Revoke this browser's token, otherwise the remembered login signs straight back in
+        USER_STORE.forget(st.session_state.pop("remember_token", None) or st.context.cookies.get(REMEMBER_COOKIE))
+        st.session_state.remember_cookie = ""
         st.session_state.logged_in = False
         st.session_state.username = None
         st.session_state.role = None
         st.session_state.uploaded_file = None
-        st.session_state.df = pd.DataFrame()
-        st.session_state.filtered_df = pd.DataFrame()
+        st.session_state.dataset = None
         st.session_state.selected_site = None
         st.session_state.date_range = None
         st.rerun()  # Restart the app to reflect logout and reset data
 
+# Admin: append delta files. Picking files re-executes only this section; an
+# append reruns the whole page on the new dataset version.
+@section
+def append_section():
+    append_messages = st.session_state.pop("append_messages", [])
+    with st.expander("➕ Append New KPI Intervals", expanded=bool(append_messages)):
+        for level, message in append_messages:
+            getattr(st, level)(message)
+        delta_files = st.file_uploader("Upload delta CSV files", type=["csv"], accept_multiple_files=True, key="delta_uploader")
+        if st.button("Append") and delta_files:
+            append_messages = []
+            for delta_file in delta_files:
+                try:
+                    report = DATASET_CACHE.append(st.session_state.dataset, delta_file)
+                except ValueError as e:
+                    append_messages.append(("error", f"{delta_file.name}: {e}"))
+                    continue
+                if report["already_ingested"]:
+                    append_messages.append(("info", f"{delta_file.name} was already appended."))
+                else:
+                    append_messages.append(("success", f"{delta_file.name}: {report['appended']} rows appended, {report['duplicates']} duplicates and {report['bad_row_count']} invalid rows skipped."))
+            st.session_state.append_messages = append_messages
+            st.session_state.dataset = DATASET_CACHE.refresh(st.session_state.dataset)
+            st.rerun()
+
+# Fleet table, re-sorted without rerunning the page
+@section
+def fleet_table_section(summary, alert_rules):
+    rank_by = st.selectbox("Rank sites by", alert_rules.names + ["avg_uptime", "total_energy", "total_alarms", "avg_signal"])
+    summary = summary.sort_values(rank_by, ascending=(rank_by in ("avg_uptime", "avg_signal")))
+    st.dataframe(
+        summary.reset_index(),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "site_id": "Site",
+            "avg_uptime": st.column_config.NumberColumn("Avg Uptime (%)", format="%.2f"),
+            "total_energy": st.column_config.NumberColumn("Total Energy (kWh)", format="%.1f"),
+            "total_alarms": "Total Alarms",
+            "avg_signal": st.column_config.NumberColumn("Avg Signal (dBm)", format="%.1f"),
+            "rows": "Rows",
+            **{rule["name"]: rule["label"] for rule in alert_rules.rules},
+        },
+    )
+
+# Drill down into the per-site view; opening it reruns the whole page
+@section
+def drill_down_section(sites):
+    drill_site = st.selectbox("Drill down into site", options=sites)
+    if st.button("Open Site View", on_click=open_site, args=(drill_site,)):
+        st.rerun()
+
+# Chart resolution picker, used by the site and comparison charts
+def chart_resolution_select():
+    return st.selectbox("Chart Resolution", ["Auto", "Raw", "Day", "Week", "Month"], key="chart_resolution")
+
+# Site charts: raw rows, or the rollup that keeps the point count bounded.
+# They are drawn once the toggle is on, so the default view is served from
+# the snapshot alone. Changing the toggle or resolution re-executes only
+# this section.
+@section
+def site_charts_section(dataset, view_key, site, start, end, site_anomalies, uptime_title):
+    if not st.toggle("📈 Show charts", key="show_site_charts"):
+        return
+    with instrumentation.span("imports"):
+        import plotly.express as px
+    chart_resolution = chart_resolution_select()
+    with instrumentation.span("chart_data"):
+        chart_df, resolution = memoized(view_key, f"chart_data:{chart_resolution}", lambda: rollups.chart_frame(
+            dataset, site, start, end, chart_resolution.lower()
+        ))
+    suffix = "" if resolution == "raw" else f" ({resolution})"
+    hover_data = ['uptime_min', 'uptime_max'] if 'uptime_min' in chart_df.columns else None
+    col1, col2 = st.columns(2)
+    with col1:
+        show_chart(view_key, f"uptime_chart:{chart_resolution}", kpi_chart, px.line, chart_df, 'uptime', resolution, site_anomalies, title=uptime_title + suffix, hover_data=hover_data)
+    with col2:
+        show_chart(view_key, f"energy_chart:{chart_resolution}", kpi_chart, px.bar, chart_df, 'energy_consumption', resolution, site_anomalies, title='⚡ Energy Consumption Over Time' + suffix)
+
+# Comparison charts; picking another KPI or resolution re-executes only this section
+@section
+def compare_chart_section(dataset, compare_key, compare_sites, start, end):
+    with instrumentation.span("imports"):
+        import plotly.express as px
+    compare_kpis = {"Uptime (%)": "uptime", "Energy Consumption (kWh)": "energy_consumption", "Alarm Count": "alarm_count", "Signal Strength (dBm)": "signal_strength"}
+    col1, col2 = st.columns(2)
+    with col1:
+        compare_label = st.selectbox("KPI", list(compare_kpis))
+    with col2:
+        chart_resolution = chart_resolution_select()
+    compare_column = compare_kpis[compare_label]
+    with instrumentation.span("chart_data"):
+        matrix, resolution = memoized(compare_key, f"compare:{compare_column}:{chart_resolution}", lambda: comparison.site_matrix(
+            dataset, compare_sites, start, end, compare_column, chart_resolution.lower()
+        ))
+    suffix = "" if resolution == "raw" else f" ({resolution})"
+    if matrix.empty:
+        st.info("No data to display for the selected sites and date range.")
+        return
+    show_chart(compare_key, f"compare_chart:{compare_column}:{chart_resolution}", px.line, matrix, title=f"{compare_label} by Site" + suffix, labels={"value": compare_label}, render_mode="webgl")
+    tab1, tab2 = st.tabs(["Correlation", "Heatmap"])
+    with tab1:
+        show_chart(compare_key, f"compare_corr:{compare_column}:{chart_resolution}", lambda frame, **kwargs: px.imshow(frame.corr(), **kwargs), matrix, zmin=-1, zmax=1, color_continuous_scale="RdBu", title=f"{compare_label} Correlation" + suffix)
+    with tab2:
+        show_chart(compare_key, f"compare_heatmap:{compare_column}:{chart_resolution}", px.imshow, matrix.T, aspect="auto", labels={"color": compare_label}, title=f"{compare_label} Heatmap" + suffix)
+
+# Admin diagnostics panel. A plain fragment rather than a section, so reading
+# the timings does not record a rerun of its own.
+@st.fragment
+def diagnostics_section():
+    if st.checkbox("Diagnostics", key="diagnostics"):
+        with st.expander("⏱️ Rerun Timings", expanded=True):
+            history = st.session_state.rerun_recorder.frame()
+            if history.empty:
+                st.caption("Timings appear from the next rerun.")
+            else:
+                st.dataframe(history, hide_index=True, use_container_width=True)
+
 # Main App
 if st.session_state.logged_in:
+    # Loaded once per server process, on the first logged-in run
+    with instrumentation.span("imports"):
+        import pandas as pd
+
+        from dataset_cache import DATASET_CACHE
+        import alerts
+        import anomalies
+        import comparison
+        import kpi_metrics
+        import forecast
+        import rollups
+        import snapshots
+
     role = st.session_state.role
     st.title(f"📡 Telecom Site Monitoring Dashboard ({role.capitalize()})")
 
@@ -195,44 +455,64 @@ if st.session_state.logged_in:
         if st.session_state.uploaded_file != uploaded_file:
             st.session_state.uploaded_file = uploaded_file
             try:
-                # Load data
-                st.session_state.df = pd.read_csv(uploaded_file)
-
-                # Parse the 'timestamp' column as datetime
-                if 'timestamp' in st.session_state.df.columns:
-                    st.session_state.df['timestamp'] = pd.to_datetime(st.session_state.df['timestamp'], format='ISO8601', errors='coerce')
-                    if st.session_state.df['timestamp'].isnull().any():
-                        st.error("Some rows in the 'timestamp' column could not be parsed as dates. Please check the data.")
-                        st.session_state.df = pd.DataFrame() # Reset df on error
-                else:
-                    st.error("No 'timestamp' column found in the uploaded file.")
-                    st.session_state.df = pd.DataFrame() # Reset df on error
-                    st.stop()
+                # Shared across sessions: ingested once per distinct file content
+                progress_bar = st.progress(0.0, text="Ingesting data...")
+                with instrumentation.span("load_data"):
+                    st.session_state.dataset = DATASET_CACHE.get(
+                        uploaded_file,
+                        progress=lambda fraction: progress_bar.progress(fraction, text=f"Ingesting data... {fraction:.0%}")
+                    )
+                progress_bar.empty()
+            except ValueError as e:
+                st.error(str(e))
+                st.session_state.dataset = None # Reset dataset on error
+                st.stop()
             except Exception as e:
                 st.error(f"Error loading data: {e}")
-                st.session_state.df = pd.DataFrame() # Reset df on error
+                st.session_state.dataset = None # Reset dataset on error
                 st.stop()
+        elif st.session_state.dataset is not None:
+            # Pick up KPI intervals appended since this session loaded the data
+            with instrumentation.span("load_data"):
+                st.session_state.dataset = DATASET_CACHE.refresh(st.session_state.dataset)
 
-            # Validate required columns
-            expected_columns = ['site_id', 'timestamp', 'uptime', 'energy_consumption', 'alarm_count', 'signal_strength']
-            missing_columns = [col for col in expected_columns if col not in st.session_state.df.columns]
-            if missing_columns:
-                st.error(f"Missing required columns: {missing_columns}")
-                st.session_state.df = pd.DataFrame() # Reset df on error
-                st.stop()
-        else:
-            df = st.session_state.df # Use cached df
+        if st.session_state.dataset is not None:
+            # Admin: append new KPI intervals without reloading the history
+            if role == "admin":
+                append_section()
+
+            # Rows rejected by validation during ingest
+            if st.session_state.dataset.bad_row_count:
+                with st.expander(f"⚠️ {st.session_state.dataset.bad_row_count} rows skipped during upload"):
+                    st.dataframe(
+                        pd.DataFrame(st.session_state.dataset.bad_rows, columns=["Line", "Reason"]),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+            if st.session_state.dataset.duplicate_count:
+                st.caption(f"{st.session_state.dataset.duplicate_count} rows repeating an earlier row's site and timestamp were skipped during upload.")
 
-        if not st.session_state.df.empty:
             # Sidebar filters
             st.sidebar.header(" Filter Data")
-            all_sites = st.session_state.df['site_id'].unique()
+            st.sidebar.radio("View", ["Single Site", "Fleet Overview", "Compare Sites"], key="view_mode")
+            all_sites = st.session_state.dataset.sites.to_numpy()
             default_site = st.session_state.selected_site if st.session_state.selected_site in all_sites else all_sites[0] if len(all_sites) > 0 else None
             st.session_state.selected_site = st.sidebar.selectbox("Select Site", options=all_sites, index=all_sites.tolist().index(default_site) if default_site else 0)
-
-            if not st.session_state.df.empty:
-                min_date = st.session_state.df['timestamp'].min().date()
-                max_date = st.session_state.df['timestamp'].max().date()
+            if st.session_state.view_mode == "Compare Sites":
+                # Sites missing from this dataset are dropped; an empty selection starts from the selected site
+                st.session_state.compare_sites = [site for site in st.session_state.compare_sites if site in st.session_state.dataset.sites] or [st.session_state.selected_site]
+                st.sidebar.multiselect("Compare Sites", options=all_sites, max_selections=comparison.MAX_COMPARE_SITES, key="compare_sites")
+                locations = get_locations(st.session_state.dataset, st.session_state.dataset.key)
+                location_names = sorted(locations.dropna().unique())
+                if location_names:
+                    compare_location_name = st.sidebar.selectbox("Location", location_names)
+                    st.sidebar.button("Compare All Sites In Location", on_click=compare_location, args=(locations, compare_location_name))
+
+            filtered_df = pd.DataFrame()
+            snapshot_view = False
+            if st.session_state.dataset.rows > 0:
+                min_date = st.session_state.dataset.min_time.date()
+                max_date = st.session_state.dataset.max_time.date()
                 default_dates = st.session_state.date_range if st.session_state.date_range and len(st.session_state.date_range) == 2 else [min_date, max_date]
 
                 st.session_state.date_range = st.sidebar.date_input(
@@ -242,184 +522,293 @@ if st.session_state.logged_in:
 
                 if len(st.session_state.date_range) == 2:
                     start_date, end_date = st.session_state.date_range
-                    # Filter dataset
-                    st.session_state.filtered_df = st.session_state.df[
-                        (st.session_state.df['site_id'] == st.session_state.selected_site) &
-                        (st.session_state.df['timestamp'] >= pd.to_datetime(start_date)) &
-                        (st.session_state.df['timestamp'] <= pd.to_datetime(end_date))
-                    ].copy() # Use .copy() to avoid SettingWithCopyWarning
-                    filtered_df = st.session_state.filtered_df
+                    view_key = (st.session_state.dataset.key, st.session_state.selected_site, start_date, end_date, role)
+                    # The default range is served from the dataset version's snapshot
+                    snapshot_view = (pd.to_datetime(start_date), pd.to_datetime(end_date)) == snapshots.default_range(st.session_state.dataset)
+                    if not snapshot_view:
+                        # Filter dataset: binary search within the site's rows, no copy
+                        with instrumentation.span("filter"):
+                            filtered_df = memoized(view_key, "rows", lambda: st.session_state.dataset.select(
+                                st.session_state.selected_site,
+                                pd.to_datetime(start_date),
+                                pd.to_datetime(end_date)
+                            ))
                 else:
                     st.warning("Please select a valid date range.")
-                    filtered_df = pd.DataFrame()
-            else:
-                filtered_df = pd.DataFrame()
 
-            # Role-Based Interface Customization
+            # Shared dataset cache counters
             if role == "admin":
+                with st.sidebar.expander("Dataset Cache"):
+                    st.json(DATASET_CACHE.stats())
+                    memory = st.session_state.dataset.memory_usage()
+                    st.caption(f"This dataset: {memory['bytes'].sum() / 2**20:.2f} MiB mapped, {memory['object_bytes'].sum() / memory['bytes'].sum():.1f}x smaller than an object/float64 frame")
+                    st.dataframe(memory, use_container_width=True)
+
+            # Alerts for every site, evaluated once per dataset version and rule set
+            try:
+                alert_rules = alerts.load_rules()
+            except ValueError as e:
+                st.error(f"Alert rules could not be loaded, using the default thresholds: {e}")
+                alert_rules = alerts.default_rules()
+            site_location = None
+            site_metrics = None
+            if snapshot_view:
+                # Metric cards and alert counts from the snapshot, without reading the site's rows
+                with instrumentation.span("site_metrics"):
+                    snapshot_summary = get_summary(st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key)
+                    if st.session_state.selected_site in snapshot_summary.index:
+                        site_metrics = {name: snapshot_summary.at[st.session_state.selected_site, name] for name in snapshot_summary.columns}
+                        site_location = get_locations(st.session_state.dataset, st.session_state.dataset.key).get(st.session_state.selected_site)
+                        site_location = None if pd.isna(site_location) else site_location
+            elif not filtered_df.empty:
+                if 'location' in filtered_df.columns:
+                    site_location = filtered_df['location'].iloc[0]
+                with instrumentation.span("site_metrics"):
+                    site_metrics = memoized(view_key, "metrics", lambda: kpi_metrics.site_metrics(filtered_df))
+
+            alert_messages = []
+            if st.session_state.view_mode == "Single Site" and site_metrics is not None:
+                with instrumentation.span("alerts"):
+                    if snapshot_view:
+                        alert_messages = alerts.messages(alert_rules, site_metrics, st.session_state.selected_site, site_location)
+                    else:
+                        alert_messages = memoized(view_key, f"alerts:{alert_rules.key}", lambda: get_alerts(
+                            st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key
+                        ).messages(st.session_state.selected_site, pd.to_datetime(start_date), pd.to_datetime(end_date), site_location))
+
+            if st.session_state.view_mode == "Fleet Overview":
+                # Fleet Overview: every site ranked from one vectorized pass
+                st.markdown("### Fleet Overview")
+                if st.session_state.date_range and len(st.session_state.date_range) == 2:
+                    start_date, end_date = st.session_state.date_range
+                    fleet_start, fleet_end = pd.to_datetime(start_date), pd.to_datetime(end_date)
+                else:
+                    fleet_start, fleet_end = None, None
+                with instrumentation.span("fleet_summary"):
+                    if (fleet_start, fleet_end) == snapshots.default_range(st.session_state.dataset):
+                        summary = get_summary(st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key)
+                    else:
+                        alert_table = get_alerts(st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key)
+                        summary = kpi_metrics.fleet_summary(st.session_state.dataset, fleet_start, fleet_end, alert_table)
+
+                if not summary.empty:
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Sites", f"{len(summary)}")
+                    col2.metric("Sites With Alerts", f"{(summary[alert_rules.names].sum(axis=1) > 0).sum()}")
+                    col3.metric("Total Alerts", f"{summary[alert_rules.names].to_numpy().sum()}")
+
+                    fleet_table_section(summary, alert_rules)
+
+                    # Anomalies across the fleet, worst first
+                    st.subheader("🔍 Anomalies")
+                    with instrumentation.span("anomalies"):
+                        fleet_anomalies = get_anomalies(st.session_state.dataset, st.session_state.dataset.key).fleet_list(fleet_start, fleet_end)
+                    if fleet_anomalies.empty:
+                        st.caption("No anomalies in the selected date range.")
+                    else:
+                        st.dataframe(fleet_anomalies, hide_index=True, use_container_width=True, column_config={
+                            "site_id": "Site",
+                            "kpi": "KPI",
+                            "anomalies": "Anomalies",
+                            "detectors": "Detectors",
+                            "last_seen": st.column_config.DatetimeColumn("Last Seen"),
+                            "max_score": st.column_config.NumberColumn("Max |Score|", format="%.1f"),
+                        })
+
+                    # Admin: sites ranked by predicted uptime degradation
+                    if role == "admin":
+                        st.subheader("🔮 Predicted Uptime Degradation")
+                        with instrumentation.span("forecast"):
+                            degradation = get_forecast(st.session_state.dataset, st.session_state.dataset.key, fleet_start, fleet_end).uptime_degradation()
+                        st.dataframe(
+                            degradation.reset_index(),
+                            hide_index=True,
+                            use_container_width=True,
+                            column_config={
+                                "site_id": "Site",
+                                "slope_per_day": st.column_config.NumberColumn("Uptime Trend (%/day)", format="%.3f"),
+                                "prediction": st.column_config.NumberColumn("Predicted Uptime (%)", format="%.2f"),
+                                "lower": st.column_config.NumberColumn("95% Lower", format="%.2f"),
+                                "upper": st.column_config.NumberColumn("95% Upper", format="%.2f"),
+                            },
+                        )
+
+                    drill_down_section(summary.index.to_numpy())
+                else:
+                    st.info("No data to display for the selected date range.")
+
+            elif st.session_state.view_mode == "Compare Sites":
+                # Compare Sites: the selected sites aligned on one time axis
+                st.markdown("### Compare Sites")
+                compare_sites = tuple(st.session_state.compare_sites)
+                if st.session_state.date_range and len(st.session_state.date_range) == 2 and compare_sites:
+                    compare_start, compare_end = pd.to_datetime(start_date), pd.to_datetime(end_date)
+                    compare_key = (st.session_state.dataset.key, compare_sites, start_date, end_date, role)
+
+                    # Same metrics and alert counts as the site view and fleet overview
+                    with instrumentation.span("fleet_summary"):
+                        if snapshot_view:
+                            summary = get_summary(st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key).reindex(list(compare_sites))
+                        else:
+                            summary = memoized(compare_key, f"summary:{alert_rules.key}", lambda: kpi_metrics.fleet_summary(
+                                st.session_state.dataset, compare_start, compare_end,
+                                get_alerts(st.session_state.dataset, st.session_state.dataset.key, alert_rules, alert_rules.key)
+                            ).reindex(list(compare_sites)))
+                    st.dataframe(
+                        summary.reset_index(),
+                        hide_index=True,
+                        use_container_width=True,
+                        column_config={
+                            "site_id": "Site",
+                            "avg_uptime": st.column_config.NumberColumn("Avg Uptime (%)", format="%.2f"),
+                            "total_energy": st.column_config.NumberColumn("Total Energy (kWh)", format="%.1f"),
+                            "total_alarms": "Total Alarms",
+                            "avg_signal": st.column_config.NumberColumn("Avg Signal (dBm)", format="%.1f"),
+                            "rows": "Rows",
+                            **{rule["name"]: rule["label"] for rule in alert_rules.rules},
+                        },
+                    )
+
+                    # Managers get summary views only, as in the single-site view
+                    if role != "manager":
+                        compare_chart_section(st.session_state.dataset, compare_key, compare_sites, compare_start, compare_end)
+                else:
+                    st.info("Select sites and a valid date range to compare.")
+
+            # Role-Based Interface Customization
+            elif role == "admin":
                 # Admin View: Full access
-                if not filtered_df.empty:
+                if site_metrics is not None:
                     st.markdown(f"### Site: **{st.session_state.selected_site}**")
 
                     # Metrics
                     col1, col2 = st.columns(2)
-                    avg_uptime = filtered_df['uptime'].mean()
+                    avg_uptime = site_metrics['avg_uptime']
                     col1.metric("Avg Uptime (%)", f"{avg_uptime:.2f}" if not pd.isna(avg_uptime) else "N/A")
 
-                    total_energy = filtered_df['energy_consumption'].sum()
+                    total_energy = site_metrics['total_energy']
                     col2.metric("⚡ Total Energy Consumption (kWh)", f"{total_energy:.1f}" if not pd.isna(total_energy) else "N/A")
 
                     col3, col4 = st.columns(2)
-                    total_alarms = filtered_df['alarm_count'].sum()
+                    total_alarms = site_metrics['total_alarms']
                     col3.metric("🚨 Total Alarms", f"{total_alarms}" if not pd.isna(total_alarms) else "N/A")
 
-                    avg_signal = filtered_df['signal_strength'].mean()
+                    avg_signal = site_metrics['avg_signal']
                     col4.metric(" Avg Signal Strength (dBm)", f"{avg_signal:.1f}" if not pd.isna(avg_signal) else "N/A")
 
                     # Alerts Section
                     st.subheader("🚨 Alerts")
-                    uptime_threshold = 95.0
-                    energy_consumption_threshold = 700.0
-                    alarm_count_threshold = 5
-
-                    low_uptime = filtered_df[filtered_df['uptime'] < uptime_threshold]
-                    high_energy = filtered_df[filtered_df['energy_consumption'] > energy_consumption_threshold]
-                    high_alarms = filtered_df[filtered_df['alarm_count'] > alarm_count_threshold]
-
-                    if not low_uptime.empty:
-                        st.warning(f" Low Uptime Detected: {len(low_uptime)} occurrences below {uptime_threshold}%")
-                    if not high_energy.empty:
-                        st.warning(f"High Energy Consumption Detected: {len(high_energy)} occurrences above {energy_consumption_threshold} kWh")
-                    if not high_alarms.empty:
-                        st.warning(f"High Alarm Count Detected: {len(high_alarms)} occurrences above {alarm_count_threshold}")
+                    for message in alert_messages:
+                        st.warning(message)
+
+                    # Anomalies: departures from the site's own history that no fixed threshold catches
+                    with instrumentation.span("anomalies"):
+                        site_anomalies = memoized(view_key, "anomalies", lambda: get_anomalies(st.session_state.dataset, st.session_state.dataset.key).rows(
+                            st.session_state.selected_site,
+                            pd.to_datetime(start_date),
+                            pd.to_datetime(end_date)
+                        ))
+                    if not site_anomalies.empty:
+                        with st.expander(f"🔍 {len(site_anomalies)} Anomalies Detected"):
+                            st.dataframe(site_anomalies, hide_index=True, use_container_width=True, column_config=ANOMALY_COLUMN_CONFIG)
 
                     # Predictive Analytics Section
                     st.subheader("🔮 Predictive Analytics")
 
-                    if len(filtered_df) > 1:
-                        X = np.array(range(len(filtered_df))).reshape(-1, 1)
-                        y_uptime = filtered_df['uptime'].values
-                        y_energy = filtered_df['energy_consumption'].values
-
-                        model_uptime = LinearRegression().fit(X, y_uptime)
-                        model_energy = LinearRegression().fit(X, y_energy)
-
-                        next_index = len(filtered_df)
-                        predicted_uptime = model_uptime.predict(np.array([[next_index]]))[0]
-                        predicted_energy = model_energy.predict(np.array([[next_index]]))[0]
+                    with instrumentation.span("forecast"):
+                        prediction = memoized(view_key, "prediction", lambda: get_forecast(st.session_state.dataset, st.session_state.dataset.key, pd.to_datetime(start_date), pd.to_datetime(end_date)).predict(st.session_state.selected_site))
+                    if prediction is not None:
+                        uptime_forecast = prediction['uptime']
+                        energy_forecast = prediction['energy_consumption']
 
                         col1, col2 = st.columns(2)
-                        col1.metric("Predicted Uptime (%)", f"{predicted_uptime:.2f}")
-                        col2.metric("Predicted Energy Consumption (kWh)", f"{predicted_energy:.1f}")
+                        col1.metric("Predicted Uptime (%)", f"{uptime_forecast['prediction']:.2f}")
+                        col2.metric("Predicted Energy Consumption (kWh)", f"{energy_forecast['prediction']:.1f}")
+                        # Two rows fit a line exactly and leave no residuals for a band
+                        if not pd.isna(uptime_forecast['lower']):
+                            col1.caption(f"95% band: {uptime_forecast['lower']:.2f} to {uptime_forecast['upper']:.2f}")
+                        if not pd.isna(energy_forecast['lower']):
+                            col2.caption(f"95% band: {energy_forecast['lower']:.1f} to {energy_forecast['upper']:.1f}")
                     else:
                         st.warning("Not enough data for predictive analytics.")
 
-                    # Charts
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.plotly_chart(
-                            px.line(filtered_df, x='timestamp', y='uptime', title='Uptime Over Time'),
-                            use_container_width=True
-                        )
-                    with col2:
-                        st.plotly_chart(
-                            px.bar(filtered_df, x='timestamp', y='energy_consumption', title='⚡ Energy Consumption Over Time'),
-                            use_container_width=True
-                        )
+                    site_charts_section(st.session_state.dataset, view_key, st.session_state.selected_site, pd.to_datetime(start_date), pd.to_datetime(end_date), site_anomalies, 'Uptime Over Time')
                 else:
                     st.info("No data to display for the selected site and date range.")
 
             elif role == "engineer":
                 # Engineer View: Detailed metrics but limited to their site
-                if not filtered_df.empty:
+                if site_metrics is not None:
                     st.markdown(f"### Site: **{st.session_state.selected_site}**")
 
                     # Metrics
                     col1, col2 = st.columns(2)
-                    avg_uptime = filtered_df['uptime'].mean()
+                    avg_uptime = site_metrics['avg_uptime']
                     col1.metric("🔌 Avg Uptime (%)", f"{avg_uptime:.2f}" if not pd.isna(avg_uptime) else "N/A")
 
-                    total_energy = filtered_df['energy_consumption'].sum()
+                    total_energy = site_metrics['total_energy']
                     col2.metric("⚡ Total Energy Consumption (kWh)", f"{total_energy:.1f}" if not pd.isna(total_energy) else "N/A")
 
                     col3, col4 = st.columns(2)
-                    total_alarms = filtered_df['alarm_count'].sum()
+                    total_alarms = site_metrics['total_alarms']
                     col3.metric("🚨 Total Alarms", f"{total_alarms}" if not pd.isna(total_alarms) else "N/A")
 
-                    avg_signal = filtered_df['signal_strength'].mean()
+                    avg_signal = site_metrics['avg_signal']
                     col4.metric(" Avg Signal Strength (dBm)", f"{avg_signal:.1f}" if not pd.isna(avg_signal) else "N/A")
 
-# Alerts Section
+                    # Alerts Section
                     st.subheader("🚨 Alerts")
-                    uptime_threshold = 95.0
-                    energy_consumption_threshold = 700.0
-                    alarm_count_threshold = 5
-
-                    low_uptime = filtered_df[filtered_df['uptime'] < uptime_threshold]
-                    high_energy = filtered_df[filtered_df['energy_consumption'] > energy_consumption_threshold]
-                    high_alarms = filtered_df[filtered_df['alarm_count'] > alarm_count_threshold]
-
-                    if not low_uptime.empty:
-                        st.warning(f"Low Uptime Detected: {len(low_uptime)} occurrences below {uptime_threshold}%")
-                    if not high_energy.empty:
-                        st.warning(f"High Energy Consumption Detected: {len(high_energy)} occurrences above {energy_consumption_threshold} kWh")
-                    if not high_alarms.empty:
-                        st.warning(f"High Alarm Count Detected: {len(high_alarms)} occurrences above {alarm_count_threshold}")
-
-                    # Charts
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.plotly_chart(
-                            px.line(filtered_df, x='timestamp', y='uptime', title=' Uptime Over Time'),
-                            use_container_width=True
-                        )
-                    with col2:
-                        st.plotly_chart(
-                            px.bar(filtered_df, x='timestamp', y='energy_consumption', title='⚡ Energy Consumption Over Time'),
-                            use_container_width=True
-                        )
+                    for message in alert_messages:
+                        st.warning(message)
+
+                    # Anomalies: departures from the site's own history that no fixed threshold catches
+                    with instrumentation.span("anomalies"):
+                        site_anomalies = memoized(view_key, "anomalies", lambda: get_anomalies(st.session_state.dataset, st.session_state.dataset.key).rows(
+                            st.session_state.selected_site,
+                            pd.to_datetime(start_date),
+                            pd.to_datetime(end_date)
+                        ))
+                    if not site_anomalies.empty:
+                        with st.expander(f"🔍 {len(site_anomalies)} Anomalies Detected"):
+                            st.dataframe(site_anomalies, hide_index=True, use_container_width=True, column_config=ANOMALY_COLUMN_CONFIG)
+
+                    site_charts_section(st.session_state.dataset, view_key, st.session_state.selected_site, pd.to_datetime(start_date), pd.to_datetime(end_date), site_anomalies, ' Uptime Over Time')
                 else:
                     st.info("No data to display for the selected site and date range.")
 
             elif role == "manager":
                 # Manager View: Summary metrics only
-                if not filtered_df.empty:
+                if site_metrics is not None:
                     st.markdown(f"### Site: **{st.session_state.selected_site}**")
 
                     # Metrics
                     col1, col2 = st.columns(2)
-                    avg_uptime = filtered_df['uptime'].mean()
+                    avg_uptime = site_metrics['avg_uptime']
                     col1.metric(" Avg Uptime (%)", f"{avg_uptime:.2f}" if not pd.isna(avg_uptime) else "N/A")
 
-                    total_energy = filtered_df['energy_consumption'].sum()
+                    total_energy = site_metrics['total_energy']
                     col2.metric("⚡ Total Energy Consumption (kWh)", f"{total_energy:.1f}" if not pd.isna(total_energy) else "N/A")
 
                     col3, col4 = st.columns(2)
-                    total_alarms = filtered_df['alarm_count'].sum()
+                    total_alarms = site_metrics['total_alarms']
                     col3.metric("🚨 Total Alarms", f"{total_alarms}" if not pd.isna(total_alarms) else "N/A")
 
-                    avg_signal = filtered_df['signal_strength'].mean()
+                    avg_signal = site_metrics['avg_signal']
                     col4.metric("Avg Signal Strength (dBm)", f"{avg_signal:.1f}" if not pd.isna(avg_signal) else "N/A")
 
                     # Alerts Section
                     st.subheader("🚨 Alerts")
-                    uptime_threshold = 95.0
-                    energy_consumption_threshold = 700.0
-                    alarm_count_threshold = 5
-
-                    low_uptime = filtered_df[filtered_df['uptime'] < uptime_threshold]
-                    high_energy = filtered_df[filtered_df['energy_consumption'] > energy_consumption_threshold]
-                    high_alarms = filtered_df[filtered_df['alarm_count'] > alarm_count_threshold]
-
-                    if not low_uptime.empty:
-                        st.warning(f"Low Uptime Detected: {len(low_uptime)} occurrences below {uptime_threshold}%")
-                    if not high_energy.empty:
-                        st.warning(f" High Energy Consumption Detected: {len(high_energy)} occurrences above {energy_consumption_threshold} kWh")
-                    if not high_alarms.empty:
-                        st.warning(f"High Alarm Count Detected: {len(high_alarms)} occurrences above {alarm_count_threshold}")
+                    for message in alert_messages:
+                        st.warning(message)
                 else:
                     st.info("No data to display for the selected site and date range.")
         else:
             st.info("Please upload a valid CSV file to proceed.")
 else:
-    st.info("Please log in to proceed.")
\ No newline at end of file
+    st.info("Please log in to proceed.")
+
+# Admin diagnostics: stage timings of this session's last reruns
+st.session_state.rerun_recorder.finish()
+if st.session_state.logged_in and st.session_state.role == "admin":
+    with st.sidebar:
+        diagnostics_section()
\ No newline at end of file
@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import alerts  # noqa: E402
+import kpi_store  # noqa: E402
+
+# Rules that carry state from one segment to the next: runs of consecutive
+# rows and changes from the previous row
+CARRIED_RULES = {
+    "rules": [
+        {"name": "low_uptime", "column": "uptime", "op": "<", "threshold": 95.0, "min_consecutive": 2},
+        {"name": "energy_jump", "column": "energy_consumption", "op": ">", "threshold": 150.0, "type": "rate_of_change"},
+        {"name": "alarm_runs", "column": "alarm_count", "op": ">", "threshold": 3, "min_consecutive": 3},
+        {"name": "signal_drop", "column": "signal_strength", "op": "<", "threshold": -10, "type": "rate_of_change", "min_consecutive": 2},
+    ],
+    "overrides": {"sites": {"S3": {"low_uptime": {"threshold": 97}}}, "locations": {}},
+}
+
+
+@pytest.fixture
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(kpi_store, "STORE_DIR", str(tmp_path / "store"))
+    return tmp_path
+
+
+@pytest.fixture
+def rules():
+    return alerts.AlertRules(CARRIED_RULES)
+
+
+# Hourly rows of eight sites from January to March 2024, with a daily cycle
+# and a few spikes for the anomaly detectors
+@pytest.fixture(scope="session")
+def kpi_rows():
+    rng = np.random.default_rng(7)
+    times = pd.date_range("2024-01-01", "2024-03-31 23:00", freq="h")
+    frames = []
+    for i in range(8):
+        n = len(times)
+        cycle = np.sin(2 * np.pi * times.hour.to_numpy() / 24)
+        frame = pd.DataFrame({
+            'site_id': f"S{i}",
+            'location': "North" if i % 2 else "South",
+            'timestamp': times,
+            'uptime': (97 + cycle + rng.normal(0, 1.5, n)).clip(80, 100),
+            'energy_consumption': 550 + 80 * cycle + rng.normal(0, 60, n),
+            'alarm_count': rng.poisson(2, n),
+            'signal_strength': -75 + 3 * cycle + rng.normal(0, 4, n),
+        })
+        spikes = rng.choice(n, 12, replace=False)
+        frame.loc[spikes, 'energy_consumption'] += 900
+        frame.loc[spikes[:4], 'alarm_count'] += 25
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture
+def write_csv(tmp_path):
+    def write(frame, name):
+        path = tmp_path / f"{name}.csv"
+        frame.to_csv(path, index=False)
+        return str(path)
+    return write
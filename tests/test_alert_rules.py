@@ -0,0 +1,72 @@
+import copy
+import json
+
+import pytest
+
+import alerts
+import kpi_metrics
+import kpi_store
+
+
+def rules_with(**changes):
+    config = copy.deepcopy(alerts.DEFAULT_RULES)
+    config["rules"][0].update(changes)
+    return config
+
+
+@pytest.mark.parametrize("changes, error", [
+    ({"column": "uptme"}, "unknown column 'uptme'"),
+    ({"threshold": "95"}, "threshold '95' is not a number"),
+    ({"op": "=="}, "unknown operator"),
+    ({"min_consecutive": 0.5}, "min_consecutive 0.5 is not a whole number"),
+    ({"min_consecutive": 0}, "min_consecutive 0 is not a whole number"),
+    ({"message": "{count} alerts at {site}"}, "may only use"),
+])
+def test_invalid_rules_are_rejected(changes, error):
+    with pytest.raises(ValueError, match=error):
+        alerts.AlertRules(rules_with(**changes))
+
+
+def test_duplicate_rule_names_are_rejected():
+    config = copy.deepcopy(alerts.DEFAULT_RULES)
+    config["rules"].append(dict(config["rules"][0], threshold=90.0))
+    with pytest.raises(ValueError, match="'low_uptime' is defined more than once"):
+        alerts.AlertRules(config)
+
+
+@pytest.mark.parametrize("overrides, error", [
+    ({"sites": {"S1": {"low_uptme": {"threshold": 97}}}}, "unknown alert rule 'low_uptme'"),
+    ({"sites": ["S1"]}, "overrides.sites must be an object"),
+    ({"locations": {"North": ["low_uptime"]}}, "location 'North' must be an object"),
+    ({"sites": {"S1": {"low_uptime": 97}}}, "rule 'low_uptime' must be an object"),
+    ({"sites": {"S1": {"low_uptime": {"min_consecutive": 1.5}}}}, "min_consecutive 1.5 is not a whole number"),
+    ([], "overrides must be an object"),
+])
+def test_invalid_overrides_are_rejected(overrides, error):
+    config = copy.deepcopy(alerts.DEFAULT_RULES)
+    config["overrides"] = overrides
+    with pytest.raises(ValueError, match=error):
+        alerts.AlertRules(config)
+
+
+# An empty rule set evaluates to an empty table rather than failing
+def test_empty_rule_set(store_dir, kpi_rows, write_csv):
+    dataset = kpi_store.KpiDataset(kpi_store.ingest_file(write_csv(kpi_rows, "full")))
+    rules = alerts.AlertRules({"rules": []})
+    table = alerts.AlertTable(dataset, rules)
+    assert len(table) == 0
+    assert table.fleet_counts().shape == (len(dataset.sites), 0)
+    assert table.messages("S1", dataset.min_time, dataset.max_time) == []
+    summary = kpi_metrics.fleet_summary(dataset, None, None, table)
+    assert list(summary.index) == list(dataset.sites)
+
+
+def test_rules_file_errors_name_the_file(tmp_path):
+    path = tmp_path / "alert_rules.json"
+    path.write_text('{"rules": [')
+    with pytest.raises(ValueError, match=str(path)):
+        alerts.load_rules(str(path))
+
+    path.write_text(json.dumps(rules_with(column="uptme")))
+    with pytest.raises(ValueError, match=f"{path}: .*unknown column"):
+        alerts.load_rules(str(path))
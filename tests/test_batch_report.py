@@ -0,0 +1,29 @@
+import json
+
+import pandas as pd
+import pytest
+
+import alerts
+import batch_report
+import kpi_metrics
+import kpi_store
+import snapshots
+
+
+# With no date range the report shows the dashboard's default view, which ends
+# at midnight of the last day and leaves out that day's later hourly rows
+@pytest.mark.parametrize("workers", [1, 2])
+def test_default_range_matches_dashboard(store_dir, kpi_rows, write_csv, tmp_path, workers):
+    rules_path = tmp_path / "alert_rules.json"
+    rules_path.write_text(json.dumps(alerts.DEFAULT_RULES))
+    path = kpi_store.ingest_file(write_csv(kpi_rows, "full"))
+    dataset = kpi_store.KpiDataset(path)
+    start, end = snapshots.default_range(dataset)
+    assert end < dataset.max_time
+
+    report = batch_report.build_report(path, rules_path=str(rules_path), workers=workers)
+    expected = kpi_metrics.fleet_summary(dataset, start, end, alerts.AlertTable(dataset, alerts.load_rules(str(rules_path))))
+    pd.testing.assert_frame_equal(report[expected.columns].sort_index(), expected.sort_index(), check_names=False)
+
+    every_row = batch_report.build_report(path, rules_path=str(rules_path), workers=workers, all_rows=True)
+    assert every_row['rows'].sum() == len(kpi_rows) > report['rows'].sum()
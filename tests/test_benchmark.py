@@ -0,0 +1,37 @@
+import json
+import sys
+
+import pytest
+
+import benchmark
+
+
+def result_file(tmp_path, name, rows, seconds):
+    path = tmp_path / f"{name}.json"
+    path.write_text(json.dumps({
+        'runs': [{'rows': rows, 'stages': [{'stage': "filter", 'seconds_per_call': seconds}]}],
+        'startup': [],
+    }))
+    return str(path)
+
+
+def test_compare_flags_regressions(tmp_path, monkeypatch):
+    baseline = result_file(tmp_path, "baseline", 10_000, 0.010)
+    current = result_file(tmp_path, "current", 10_000, 0.015)
+    monkeypatch.setattr(sys, "argv", ["benchmark.py", "compare", baseline, current])
+    with pytest.raises(SystemExit) as exit_info:
+        benchmark.main()
+    assert exit_info.value.code == 1
+
+
+# Runs with different --rows share no stage to compare
+def test_compare_without_overlap(tmp_path, monkeypatch, capsys):
+    baseline = result_file(tmp_path, "baseline", 10_000, 0.010)
+    current = result_file(tmp_path, "current", 1_000_000, 0.500)
+    table = benchmark.compare(json.loads(open(baseline).read()), json.loads(open(current).read()))
+    assert table.empty
+    assert list(table.columns) == benchmark.COMPARE_COLUMNS
+
+    monkeypatch.setattr(sys, "argv", ["benchmark.py", "compare", baseline, current])
+    benchmark.main()
+    assert "No comparable stages" in capsys.readouterr().err
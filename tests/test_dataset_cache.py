@@ -0,0 +1,27 @@
+import dataset_cache
+import kpi_store
+
+
+# The running total follows inserts, replacements on refresh and evictions
+def test_used_bytes_tracks_entries(store_dir, kpi_rows, write_csv):
+    times = kpi_rows['timestamp']
+    first = write_csv(kpi_rows[times < "2024-02-01"], "first")
+    second = write_csv(kpi_rows[times >= "2024-02-01"], "second")
+    cache = dataset_cache.DatasetCache(budget_bytes=2**40)
+
+    a = cache.get(first)
+    b = cache.get(second)
+    assert cache.get(first) is a
+    assert cache.used_bytes() == a.nbytes + b.nbytes
+
+    cache.append(a, write_csv(kpi_rows[(times >= "2024-02-01") & (times < "2024-02-05")], "delta"))
+    fresh = cache.refresh(a)
+    assert fresh is not a and fresh.rows > a.rows
+    assert cache.used_bytes() == fresh.nbytes + b.nbytes
+
+    # b is least recently used
+    cache.budget_bytes = fresh.nbytes
+    cache._evict(keep=kpi_store.hash_upload(first))
+    assert cache.stats()["entries"] == 1
+    assert cache.used_bytes() == fresh.nbytes
+    assert cache.evictions == 1
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+import alerts
+import comparison
+import kpi_metrics
+import kpi_store
+
+
+# A blank alarm_count keeps the row for the other KPIs, like a blank float KPI
+def test_blank_alarm_count_keeps_row(store_dir, tmp_path):
+    path = tmp_path / "blank_alarms.csv"
+    path.write_text(
+        "site_id,timestamp,uptime,energy_consumption,alarm_count,signal_strength\n"
+        "S1,2024-01-01 00:00,99.0,500,2,-70\n"
+        "S1,2024-01-01 01:00,90.0,600,,-71\n"
+        "S1,2024-01-01 02:00,98.0,550,9,-72\n"
+        "S1,2024-01-01 03:00,97.0,520,x,-73\n"
+    )
+    dataset = kpi_store.KpiDataset(kpi_store.ingest_file(str(path)))
+    assert dataset.rows == 3
+    assert dataset.bad_rows == [[5, "'alarm_count' is not a valid count"]]
+
+    summary = kpi_metrics.fleet_summary(dataset, None, None)
+    assert np.isclose(summary.at["S1", 'avg_uptime'], (99.0 + 90.0 + 98.0) / 3)
+    assert summary.at["S1", 'total_energy'] == 1650
+    assert summary.at["S1", 'total_alarms'] == 11
+
+    day = dataset.select_rollup("day", "S1", dataset.min_time, dataset.max_time)
+    assert day['alarm_count'].tolist() == [11]
+
+    matrix, _ = comparison.site_matrix(dataset, ["S1"], dataset.min_time, dataset.max_time, 'alarm_count')
+    assert np.isnan(matrix["S1"].iloc[1])
+
+    # The blank count is not a drop from 2 alarms to none
+    drop = alerts.AlertRules({"rules": [
+        {"name": "alarm_drop", "column": "alarm_count", "op": "<", "threshold": -1, "type": "rate_of_change"},
+        {"name": "no_alarms", "column": "alarm_count", "op": "<", "threshold": 1},
+    ]})
+    table = alerts.AlertTable(dataset, drop)
+    assert len(table) == 0
+    # Its low uptime still alerts
+    assert len(alerts.AlertTable(dataset, alerts.default_rules())) == 2
+
+
+def test_large_alarm_counts_are_kept(store_dir, kpi_rows, write_csv):
+    rows = kpi_rows.head(48).copy()
+    rows.loc[rows.index[:3], 'alarm_count'] = [40_000, 2_000_000, 5]
+    dataset = kpi_store.KpiDataset(kpi_store.ingest_file(write_csv(rows, "large_counts")))
+    assert dataset.rows == 48
+    assert dataset.bad_row_count == 0
+    summary = kpi_metrics.fleet_summary(dataset, None, None)
+    assert summary.at["S0", 'total_alarms'] == rows['alarm_count'].sum()
+
+
+# Rows repeating a (site_id, timestamp) keep the first one, in one upload as
+# across appends
+def test_duplicates_match_appends(store_dir, kpi_rows, write_csv):
+    times = kpi_rows['timestamp']
+    base = kpi_rows[times < "2024-02-15"]
+    delta = kpi_rows[times >= "2024-02-10"].copy()
+    delta['uptime'] = 50.0  # The repeated days differ from the stored rows
+    upload = pd.concat([base, delta], ignore_index=True)
+
+    one_shot = kpi_store.KpiDataset(kpi_store.ingest_file(write_csv(upload, "upload")))
+    path = kpi_store.ingest_file(write_csv(base, "base"))
+    report = kpi_store.append_file(path, write_csv(delta, "delta"))
+    appended = kpi_store.KpiDataset(path)
+
+    repeated = len(upload) - len(kpi_rows)
+    assert one_shot.duplicate_count == repeated == report["duplicates"]
+    assert one_shot.rows == appended.rows == len(kpi_rows)
+    pd.testing.assert_frame_equal(kpi_metrics.fleet_summary(one_shot, None, None), kpi_metrics.fleet_summary(appended, None, None))
+    for site in one_shot.sites:
+        pd.testing.assert_frame_equal(
+            one_shot.select(site, one_shot.min_time, one_shot.max_time).reset_index(drop=True),
+            appended.select(site, appended.min_time, appended.max_time).reset_index(drop=True),
+        )
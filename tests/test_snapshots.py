@@ -0,0 +1,60 @@
+import numpy as np
+
+import anomalies
+import kpi_store
+import snapshots
+
+
+def assert_same_anomalies(actual, expected):
+    assert len(expected) > 0
+    for name in anomalies.TABLE_COLUMNS:
+        if name in ('value', 'score'):
+            np.testing.assert_allclose(actual.columns[name], expected.columns[name], rtol=1e-5)
+        else:
+            np.testing.assert_array_equal(actual.columns[name], expected.columns[name])
+
+
+# Record the segments a table evaluates rather than resumes
+def evaluated_segments(monkeypatch):
+    names = []
+    evaluate = anomalies._evaluate_segment
+
+    def record(segment, *args):
+        names.append(segment.name)
+        return evaluate(segment, *args)
+
+    monkeypatch.setattr(anomalies, "_evaluate_segment", record)
+    return names
+
+
+def test_resumed_anomaly_table_matches_rebuild(store_dir, kpi_rows, write_csv, monkeypatch):
+    times = kpi_rows['timestamp']
+    path = kpi_store.ingest_file(write_csv(kpi_rows[times < "2024-03-01"], "base"))
+    snapshots.anomaly_table(kpi_store.KpiDataset(path))
+    old_names = {segment.name for segment in kpi_store.KpiDataset(path).segments}
+
+    kpi_store.append_file(path, write_csv(kpi_rows[times >= "2024-03-01"], "delta"))
+    dataset = kpi_store.KpiDataset(path)
+    evaluated = evaluated_segments(monkeypatch)
+    resumed = snapshots.anomaly_table(dataset)
+    # Only the appended segment is scanned
+    assert evaluated == [segment.name for segment in dataset.segments if segment.name not in old_names]
+    assert len(evaluated) == 1
+
+    monkeypatch.undo()
+    assert_same_anomalies(resumed, anomalies.AnomalyTable(dataset))
+    # The next session reads the table the resume saved
+    assert_same_anomalies(snapshots.anomaly_table(kpi_store.KpiDataset(path)), resumed)
+
+
+def test_anomaly_table_rebuilds_after_compaction(store_dir, kpi_rows, write_csv):
+    times = kpi_rows['timestamp']
+    backfill = (kpi_rows['site_id'] == "S4") & (times >= "2024-01-10") & (times < "2024-01-11")
+    path = kpi_store.ingest_file(write_csv(kpi_rows[~backfill], "base"))
+    snapshots.anomaly_table(kpi_store.KpiDataset(path))
+
+    # The compaction renames January's segment, so the saved table no longer
+    # matches the store and the new version's table is built from scratch
+    kpi_store.append_file(path, write_csv(kpi_rows[backfill], "backfill"))
+    dataset = kpi_store.KpiDataset(path)
+    assert_same_anomalies(snapshots.anomaly_table(dataset), anomalies.AnomalyTable(dataset))
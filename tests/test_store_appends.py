@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+import alerts
+import anomalies
+import kpi_metrics
+import kpi_store
+import rollups
+
+
+def assert_columns_equal(actual, expected, approx=()):
+    assert actual.keys() == expected.keys()
+    for name in expected:
+        if name in approx:
+            np.testing.assert_allclose(actual[name], expected[name], rtol=1e-5)
+        else:
+            np.testing.assert_array_equal(actual[name], expected[name])
+
+
+# The store built from one upload and the one built from a base file plus
+# appends hold the same rows, so everything derived from them must agree
+def assert_same_results(appended, one_shot, rules):
+    assert appended.rows == one_shot.rows
+    assert list(appended.sites) == list(one_shot.sites)
+
+    appended_alerts = alerts.AlertTable(appended, rules)
+    one_shot_alerts = alerts.AlertTable(one_shot, rules)
+    assert len(one_shot_alerts) > 0
+    assert_columns_equal(appended_alerts.columns, one_shot_alerts.columns, approx=('value',))
+
+    for start, end in ((None, None), (pd.Timestamp("2024-01-15 06:00"), pd.Timestamp("2024-03-10 18:00"))):
+        pd.testing.assert_frame_equal(
+            kpi_metrics.fleet_summary(appended, start, end, appended_alerts),
+            kpi_metrics.fleet_summary(one_shot, start, end, one_shot_alerts),
+        )
+
+    for freq in rollups.ROLLUP_FREQUENCIES:
+        for site in one_shot.sites:
+            pd.testing.assert_frame_equal(
+                appended.select_rollup(freq, site, one_shot.min_time, one_shot.max_time).reset_index(drop=True),
+                one_shot.select_rollup(freq, site, one_shot.min_time, one_shot.max_time).reset_index(drop=True),
+            )
+
+    appended_anomalies = anomalies.AnomalyTable(appended)
+    one_shot_anomalies = anomalies.AnomalyTable(one_shot)
+    assert len(one_shot_anomalies) > 0
+    assert_columns_equal(appended_anomalies.columns, one_shot_anomalies.columns, approx=('value', 'score'))
+
+
+def test_appends_match_one_shot_ingest(store_dir, kpi_rows, write_csv, rules):
+    times = kpi_rows['timestamp']
+    backfill = kpi_rows['site_id'].isin(["S1", "S2"]) & (times >= "2024-01-20") & (times < "2024-01-22")
+    base = kpi_rows[~backfill & (times < "2024-02-10")]
+    # The first delta repeats the base file's last day
+    first = kpi_rows[(times >= "2024-02-09") & (times < "2024-03-05")]
+    second = kpi_rows[times >= "2024-03-05"]
+
+    one_shot = kpi_store.KpiDataset(kpi_store.ingest_file(write_csv(kpi_rows, "full")))
+    without_backfill = kpi_store.KpiDataset(kpi_store.ingest_file(write_csv(kpi_rows[~backfill], "without_backfill")))
+    path = kpi_store.ingest_file(write_csv(base, "base"))
+
+    report = kpi_store.append_file(path, write_csv(first, "first"))
+    assert report["duplicates"] == (first['timestamp'] < "2024-02-10").sum()
+    assert report["appended"] == len(first) - report["duplicates"]
+    kpi_store.append_file(path, write_csv(second, "second"))
+    assert kpi_store.append_file(path, write_csv(second, "second"))["already_ingested"]
+    assert_same_results(kpi_store.KpiDataset(path), without_backfill, rules)
+
+    # The backfill lands before rows already stored for its sites, so its
+    # month is compacted into one segment straight away
+    before = kpi_store.KpiDataset(path)
+    report = kpi_store.append_file(path, write_csv(kpi_rows[backfill], "backfill"))
+    assert report["appended"] == backfill.sum()
+    appended = kpi_store.KpiDataset(path)
+    assert [segment.month for segment in appended.segments].count("2024-01") == 1
+    assert_same_results(appended, one_shot, rules)
+
+    # A dataset opened before the compaction still reads its old segments
+    kpi_metrics.fleet_summary(before)
+    before.select_rollup("week", "S1", before.min_time, before.max_time)
+
+
+def test_delta_with_only_invalid_rows(store_dir, kpi_rows, write_csv):
+    path = kpi_store.ingest_file(write_csv(kpi_rows.head(500), "base"))
+    delta = kpi_rows.iloc[500:502].copy()
+    delta['timestamp'] = "not a date"
+    delta.loc[delta.index[0], 'site_id'] = "S99"
+
+    report = kpi_store.append_file(path, write_csv(delta, "delta"))
+    assert report["appended"] == 0
+    assert report["bad_row_count"] == 2
+    assert not report["already_ingested"]
+    # Rejected rows do not add sites
+    assert "S99" not in kpi_store.KpiDataset(path).sites
+
+
+# A dataset whose metadata was read before a compaction removed the segments
+# it lists opens the compacted version instead
+def test_open_racing_a_compaction(store_dir, kpi_rows, write_csv, monkeypatch):
+    times = kpi_rows['timestamp']
+    path = kpi_store.ingest_file(write_csv(kpi_rows[times < "2024-03-10"], "base"))
+    kpi_store.append_file(path, write_csv(kpi_rows[(times >= "2024-03-10") & (times < "2024-03-20")], "first"))
+    kpi_store.append_file(path, write_csv(kpi_rows[times >= "2024-03-20"], "second"))
+    stale = kpi_store._read_meta(path)
+    kpi_store.compact(path)
+
+    read_meta = kpi_store._read_meta
+    results = [stale]
+    monkeypatch.setattr(kpi_store, "_read_meta", lambda p: results.pop() if results else read_meta(p))
+    dataset = kpi_store.KpiDataset(path)
+    assert dataset.key == read_meta(path)["data_version"] != stale["data_version"]
+    assert dataset.rows == len(kpi_rows)
@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+import user_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return user_store.UserStore(str(tmp_path / "users.db"), hash_workers=2)
+
+
+def test_password_hash_round_trip():
+    encoded = user_store.hash_password("s3cret!Pass")
+    assert "s3cret" not in encoded
+    assert user_store.verify_password("s3cret!Pass", encoded)
+    assert not user_store.verify_password("s3cret!pass", encoded)
+    # Salted: the same password hashes differently every time
+    assert user_store.hash_password("s3cret!Pass") != encoded
+
+
+def test_authenticate(store):
+    assert store.create_user("alice", "s3cret!Pass", "engineer")
+    assert store.authenticate("alice", "s3cret!Pass") == "engineer"
+    assert store.authenticate("alice", "wrong") is None
+    assert store.authenticate("bob", "s3cret!Pass") is None
+
+
+def test_duplicate_registration(store):
+    assert store.create_user("alice", "s3cret!Pass", "engineer")
+    assert not store.create_user("alice", "other!Pass1", "admin")
+    assert store.authenticate("alice", "s3cret!Pass") == "engineer"
+
+
+def test_remember_tokens(store, monkeypatch):
+    store.create_user("alice", "s3cret!Pass", "manager")
+    token = store.remember("alice")
+    assert store.remembered_login(token) == ("alice", "manager")
+    assert store.remembered_login("not-a-token") is None
+
+    store.forget(token)
+    assert store.remembered_login(token) is None
+
+    token = store.remember("alice")
+    now = time.time()
+    monkeypatch.setattr(user_store.time, "time", lambda: now + user_store.REMEMBER_DAYS * 86400 + 1)
+    assert store.remembered_login(token) is None
+
+
+def test_migrate_legacy(store, tmp_path):
+    user_file = tmp_path / "users.json"
+    remember_file = tmp_path / "remember.json"
+    user_file.write_text(json.dumps({
+        "alice": {"password": "s3cret!Pass", "role": "admin"},
+        "bob": {"password": "hunter2!Pass", "role": "engineer"},
+    }))
+    remember_file.write_text(json.dumps({"username": "alice", "password": "s3cret!Pass"}))
+
+    store.migrate_legacy(str(user_file), str(remember_file))
+    assert not user_file.exists()
+    assert not remember_file.exists()
+    assert store.authenticate("alice", "s3cret!Pass") == "admin"
+    assert store.authenticate("bob", "hunter2!Pass") == "engineer"
+
+    # A second run finds nothing to migrate and keeps the accounts
+    store.migrate_legacy(str(user_file), str(remember_file))
+    assert store.authenticate("alice", "s3cret!Pass") == "admin"
+
+    # A legacy file reappearing does not overwrite existing accounts
+    user_file.write_text(json.dumps({"alice": {"password": "changed!Pass1", "role": "manager"}}))
+    store.migrate_legacy(str(user_file), str(remember_file))
+    assert store.authenticate("alice", "s3cret!Pass") == "admin"
+    assert not user_file.exists()
@@ -0,0 +1,177 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+# SQLite database holding accounts and remember-me tokens
+USER_DB = os.environ.get("KPI_USER_DB", "users.db")
+
+# Plaintext stores of earlier versions, migrated by migrate_legacy()
+LEGACY_USER_FILE = "users.json"
+LEGACY_REMEMBER_FILE = "remember.json"
+
+# scrypt cost: n * r * 128 bytes (16 MiB) of memory per hash
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_MAXMEM = 64 * 2**20
+
+# Concurrent hashes are capped so a burst of logins cannot exhaust memory
+HASH_WORKERS = int(os.environ.get("KPI_HASH_WORKERS", str(os.cpu_count() or 2)))
+
+REMEMBER_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remember_tokens (
+    token_hash TEXT PRIMARY KEY,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+# Salted scrypt hash, encoded with its parameters so they can change later
+def hash_password(password, salt=None):
+    salt = salt or secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, maxmem=SCRYPT_MAXMEM)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, encoded):
+    algorithm, n, r, p, salt, digest = encoded.split("$")
+    if algorithm != "scrypt":
+        raise ValueError(f"Unknown password hash: {algorithm}")
+    candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p), maxmem=SCRYPT_MAXMEM)
+    return hmac.compare_digest(candidate.hex(), digest)
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Accounts and remember-me tokens in SQLite. Each thread gets its own
+# connection; writes are single transactions, so concurrent registrations
+# of one name cannot both succeed. Password hashing runs in the calling
+# thread, at most hash_workers at a time.
+class UserStore:
+    def __init__(self, path, hash_workers=HASH_WORKERS):
+        self.path = path
+        self._local = threading.local()
+        self._hash_slots = threading.BoundedSemaphore(hash_workers)
+        # A well-formed hash to check against for unknown users, so timing does
+        # not reveal them. Verifying costs the same whatever it holds, so it
+        # is not computed here, where it would delay every server start.
+        self._dummy_hash = f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${bytes(16).hex()}${bytes(64).hex()}"
+        self._connection().executescript(SCHEMA)
+
+    # This thread's connection, in autocommit mode; writes use _write()
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            self._local.db = db
+        return db
+
+    def _write(self):
+        return _Transaction(self._connection())
+
+    # Deployments of earlier versions: import users.json once, hashing its
+    # plaintext passwords, then remove it. The remember file they shared
+    # between all browsers held a plaintext password and is removed as well.
+    # Run by the dashboard on start, not on import, since it deletes files in
+    # the working directory.
+    def migrate_legacy(self, user_file=LEGACY_USER_FILE, remember_file=LEGACY_REMEMBER_FILE):
+        try:
+            os.remove(remember_file)
+        except FileNotFoundError:
+            pass
+        if not os.path.exists(user_file):
+            return
+        with open(user_file, "r") as f:
+            legacy = json.load(f)
+        hashed = [(name, hash_password(entry["password"]), entry["role"], time.time()) for name, entry in legacy.items()]
+        with self._write() as db:
+            db.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)", hashed)
+        try:
+            os.remove(user_file)
+        except FileNotFoundError:
+            pass  # Another process migrated it at the same time
+
+    # Register a user; False when the name is taken
+    def create_user(self, username, password, role):
+        with self._hash_slots:
+            password_hash = hash_password(password)
+        try:
+            with self._write() as db:
+                db.execute("INSERT INTO users VALUES (?, ?, ?, ?)", (username, password_hash, role, time.time()))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def _check(self, username, password):
+        row = self._connection().execute("SELECT password_hash, role FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            verify_password(password, self._dummy_hash)
+            return None
+        return row[1] if verify_password(password, row[0]) else None
+
+    # The user's role, or None for bad credentials
+    def authenticate(self, username, password):
+        with self._hash_slots:
+            return self._check(username, password)
+
+    # Issue a remember-me token for username. The caller keeps it in the
+    # user's browser (a cookie); only its hash is stored here.
+    def remember(self, username):
+        token = secrets.token_urlsafe(32)
+        with self._write() as db:
+            db.execute("DELETE FROM remember_tokens WHERE expires_at < ?", (time.time(),))
+            db.execute("INSERT INTO remember_tokens VALUES (?, ?, ?)", (_token_hash(token), username, time.time() + REMEMBER_DAYS * 86400))
+        return token
+
+    # Revoke a remember-me token, so a copy left in a browser stops working
+    def forget(self, token):
+        if token:
+            with self._write() as db:
+                db.execute("DELETE FROM remember_tokens WHERE token_hash = ?", (_token_hash(token),))
+
+    # (username, role) of a valid remember-me token, else None
+    def remembered_login(self, token):
+        if not token:
+            return None
+        row = self._connection().execute(
+            "SELECT users.username, users.role FROM remember_tokens JOIN users USING (username) WHERE token_hash = ? AND expires_at >= ?",
+            (_token_hash(token), time.time()),
+        ).fetchone()
+        return tuple(row) if row else None
+
+
+# One transaction on a connection: BEGIN IMMEDIATE takes the write lock up
+# front, so concurrent writers wait on busy_timeout instead of failing midway
+class _Transaction:
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, *exc):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+# Shared instance; modules are imported once per Streamlit server process
+USER_STORE = UserStore(USER_DB)